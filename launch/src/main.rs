@@ -10,9 +10,19 @@ const PYTHON_PATH: &str = "Python\\pythonw.exe";
 const PYTHON_PATH: &str = "Python\\python.exe";
 
 
+// pkvenv_main 根据启动程序的文件名选择要运行的入口
+fn entry_point_name() -> String {
+    std::env::current_exe()
+        .ok()
+        .and_then(|path| path.file_stem().map(|stem| stem.to_string_lossy().into_owned()))
+        .unwrap_or_default()
+}
+
+
 fn main() {
     let status = Command::new(PYTHON_PATH)
             .args(&["-m", "pkvenv_main"])
+            .env("PKVENV_ENTRY_POINT", entry_point_name())
             .stdout(Stdio::piped())
             .stderr(Stdio::piped())
             .status()
@@ -1,2 +1,20 @@
+import sys
 
 __version__ = "0.0.9"
+
+__all__ = ["build", "BuildConfig", "BuildOptions", "BuildResult", "PkvenvError", "ConfigError", "BuildError",
+           "SizeBudgetError"]
+
+
+def __getattr__(name):
+    # 按需导入api: `import pkvenv.daemon` 等不需要加载api及requests
+    if name in __all__:
+        from . import api
+        return getattr(api, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if sys.version_info < (3, 7):
+    # python 3.6 不支持模块的__getattr__
+    from .api import build, BuildConfig, BuildOptions, BuildResult, PkvenvError, ConfigError, BuildError, \
+        SizeBudgetError
@@ -0,0 +1,531 @@
+import os
+import threading
+import subprocess
+from collections import OrderedDict
+from contextlib import ExitStack, redirect_stdout
+from .main import (PYTHON_ARCNAME, TARGETS, ARCHS, read_configs, get_trace_configs, parse_venv_configs,
+                   get_py_version_from_str, get_site_packages_arcname, get_source_date_epoch, is_cross_build,
+                   get_new_requirements, fetch_standalone_python, fetch_embeddable_python, fetch_get_pip,
+                   get_runtime_layer, gen_pth_file, copy_files, gen_launch_file, gen_fork_server_files,
+                   minimize_from_trace, zip_files, FORK_SERVER_IDLE_TIMEOUT)
+from .onefile import ONEFILE_CHUNKS, write_onefile
+from .import_archive import write_import_archive
+from .bundle import BundleTree
+from .strip import strip_files, get_strip_rules
+from .size import parse_size, analyze_tree, check_size_budget, print_size_report
+from .pipeline import Pipeline
+from .metrics import span, tracer, report
+from .archive import CompressionPolicy, ZIP_DEFLATED
+
+# 全局的tracer/report记录的是"当前构建", 同一进程内的构建依次执行
+_build_lock = threading.Lock()
+
+
+class PkvenvError(Exception):
+    """Base class of the errors raised by ``pkvenv.build``."""
+
+
+class ConfigError(PkvenvError, ValueError):
+    """The project config or the build options are invalid."""
+
+
+class BuildError(PkvenvError):
+    """A build stage failed; ``stage`` is the name of the failed stage."""
+
+    def __init__(self, message, stage=None):
+        super(BuildError, self).__init__(message)
+        self.stage = stage
+
+
+class SizeBudgetError(BuildError):
+    """The zip was built but is over the `size_budget`; ``errors`` lists the exceeded limits."""
+
+    def __init__(self, errors, zip_file):
+        super(SizeBudgetError, self).__init__("size budget exceeded:\n  " + "\n  ".join(errors), "size")
+        self.errors = errors
+        self.zip_file = zip_file
+
+
+class BuildVariant(object):
+    """One bundle of the build: an architecture and a python version of the target.
+
+    Builds with a `targets` matrix have several variants, named like `3.9.13-win32`.
+    """
+
+    def __init__(self, target, arch, python_version, python_standalone=None, matrix=False):
+        self.target = target
+        self.arch = arch
+        self.python_version = python_version
+        self.python_standalone = python_standalone
+        self.matrix = matrix
+        self.cross_build = is_cross_build(target, arch)
+
+    @property
+    def name(self):
+        return "%s-%s" % (self.python_version, self.arch)
+
+    def __repr__(self):
+        return "<BuildVariant %s %s>" % (self.target, self.name)
+
+
+class BuildConfig(object):
+    """Validated content of a ``pkvenv.json``, with paths resolved against ``project_dir``."""
+
+    def __init__(self, project_dir, name, venv, include, entry_points, pip_args=(), target="windows",
+                 python_standalone=None, strip="none", trace=None, compression=None, size_budget=None,
+                 targets=None, fork_server=None, onefile=None, import_archive=None):
+        self.project_dir = os.path.abspath(project_dir)
+        self.name = name
+        self.venv_path = os.path.abspath(os.path.join(self.project_dir, venv))
+        self.include_files = [os.path.abspath(os.path.join(self.project_dir, item)) for item in include]  # TODO: dir
+        self.entry_points = entry_points
+        self.pip_args = list(pip_args)
+        self.target = target
+        self.python_standalone = self._get_standalone_path(python_standalone)
+        # [{"arch": .., "python": .., "python_standalone": ..}], None表示只构建venv的python版本和默认架构
+        self.targets = None
+        if targets is not None:
+            self.targets = [dict(item, python_standalone=self._get_standalone_path(item.get("python_standalone")))
+                            for item in targets]
+        self.strip = strip
+        self.trace_file, self.keep_patterns = get_trace_configs(self.project_dir, {"trace": trace} if trace else {})
+        self.compression = compression
+        self.size_budget = size_budget
+        self.fork_server = fork_server  # None 或 {"idle_timeout": 秒}
+        self.onefile = onefile  # None 或 {"chunks": 分块数}
+        self.import_archive = import_archive  # None 或 {"exclude": [顶层包名]}
+
+    @property
+    def build_path(self):
+        return os.path.join(self.project_dir, "build")
+
+    @property
+    def zip_file(self):
+        return os.path.join(self.build_path, "%s.zip" % self.name)
+
+    def _get_standalone_path(self, python_standalone):
+        if python_standalone and "://" not in python_standalone:
+            return os.path.abspath(os.path.join(self.project_dir, python_standalone))
+        return python_standalone
+
+    def get_variants(self, venv_version):
+        """Return the ``BuildVariant`` list of the `targets` matrix; python defaults to ``venv_version``."""
+        if self.targets is None:
+            return [BuildVariant(self.target, ARCHS[self.target][0], venv_version, self.python_standalone)]
+        variants = []
+        for item in self.targets:
+            variant = BuildVariant(self.target, item.get("arch") or ARCHS[self.target][0],
+                                   item.get("python") or venv_version,
+                                   item.get("python_standalone") or self.python_standalone, True)
+            if any(other.name == variant.name for other in variants):
+                raise ConfigError("duplicate item `%s` in `targets`" % variant.name)
+            variants.append(variant)
+        return variants
+
+    def get_zip_file(self, variant):
+        if not variant.matrix:
+            return self.zip_file
+        return os.path.join(self.build_path, "%s-%s.zip" % (self.name, variant.name))
+
+    def get_onefile_file(self, variant):
+        return os.path.splitext(self.get_zip_file(variant))[0] + ".run"
+
+    @classmethod
+    def from_configs(cls, configs, project_dir):
+        """Validate a parsed config dict, raise ``ConfigError`` on invalid values."""
+        name = configs["name"] if "name" in configs else None
+        args = configs["entry_point"] if "entry_point" in configs else None
+        venv = configs["venv"] if "venv" in configs else None
+        include = configs["include"] if "include" in configs else None
+        gui = bool(configs["gui"]) if "gui" in configs else False
+        entry_points = configs["entry_points"] if "entry_points" in configs else None
+        if name is None:
+            raise ConfigError("`name` is missing in config file!")
+        if args is None and not entry_points:
+            raise ConfigError("`args` is missing in config file!")
+        if venv is None:
+            raise ConfigError("`venv` is missing in config file!")
+        if include is None:
+            raise ConfigError("`include` is missing in config file!")
+
+        if entry_points:
+            items = []
+            for entry_point in entry_points:
+                if "name" not in entry_point or "entry_point" not in entry_point:
+                    raise ConfigError("`name` and `entry_point` are required for each item of `entry_points`!")
+                items.append(dict(entry_point, gui=bool(entry_point["gui"]) if "gui" in entry_point else False))
+            entry_points = items
+        else:
+            entry_points = [{"name": name, "entry_point": args, "gui": gui}]
+        pip_args = configs["pip_args"] if "pip_args" in configs else []
+        if not isinstance(pip_args, list):
+            raise ConfigError("`pip_args` must be a list of arguments!")
+        target = configs["target"] if "target" in configs else "windows"
+        if target not in TARGETS:
+            raise ConfigError("unknown target `%s`, available: %s" % (target, ", ".join(TARGETS)))
+        targets = configs["targets"] if "targets" in configs else None
+        if targets is not None:
+            if not isinstance(targets, list) or not targets or not all(isinstance(item, dict) for item in targets):
+                raise ConfigError("`targets` must be a list of {\"arch\": .., \"python\": ..}!")
+            for item in targets:
+                if item.get("arch") and item["arch"] not in ARCHS[target]:
+                    raise ConfigError("unknown arch `%s` of target %s, available: %s"
+                                      % (item["arch"], target, ", ".join(ARCHS[target])))
+                if item.get("python"):
+                    try:
+                        get_py_version_from_str(str(item["python"]))
+                    except ValueError as e:
+                        raise ConfigError(str(e))
+
+        fork_server = configs["fork_server"] if "fork_server" in configs else None
+        if fork_server is not None and fork_server is not False:
+            if target != "linux":
+                raise ConfigError("`fork_server` is only supported by the linux target!")
+            if fork_server is True:
+                fork_server = {}
+            if not isinstance(fork_server, dict):
+                raise ConfigError("`fork_server` must be true or {\"idle_timeout\": seconds}!")
+            idle_timeout = fork_server.get("idle_timeout", FORK_SERVER_IDLE_TIMEOUT)
+            if not isinstance(idle_timeout, int) or idle_timeout < 0:
+                raise ConfigError("`idle_timeout` of `fork_server` must be a number of seconds!")
+            fork_server = dict(fork_server, idle_timeout=idle_timeout)
+        else:
+            fork_server = None
+
+        onefile = configs["onefile"] if "onefile" in configs else None
+        if onefile is not None and onefile is not False:
+            if target != "linux":
+                raise ConfigError("`onefile` is only supported by the linux target!")
+            if onefile is True:
+                onefile = {}
+            if not isinstance(onefile, dict):
+                raise ConfigError("`onefile` must be true or {\"chunks\": number}!")
+            chunks = onefile.get("chunks", ONEFILE_CHUNKS)
+            if not isinstance(chunks, int) or chunks < 1:
+                raise ConfigError("`chunks` of `onefile` must be a positive number!")
+            onefile = dict(onefile, chunks=chunks)
+        else:
+            onefile = None
+
+        import_archive = configs["import_archive"] if "import_archive" in configs else None
+        if import_archive is not None and import_archive is not False:
+            if import_archive is True:
+                import_archive = {}
+            if not isinstance(import_archive, dict):
+                raise ConfigError("`import_archive` must be true or {\"exclude\": [package names]}!")
+            exclude = import_archive.get("exclude", [])
+            if not isinstance(exclude, list) or not all(isinstance(item, str) for item in exclude):
+                raise ConfigError("`exclude` of `import_archive` must be a list of top-level package names!")
+            import_archive = dict(import_archive, exclude=exclude)
+        else:
+            import_archive = None
+
+        # 提前检查, 避免下载和pip install之后才失败
+        strip = configs["strip"] if "strip" in configs else "none"
+        size_budget = configs["size_budget"] if "size_budget" in configs else None
+        try:
+            if strip != "none":
+                get_strip_rules(strip)
+            for release in (False, True):
+                CompressionPolicy.from_configs(configs.get("compression"), release)
+            if size_budget:
+                check_size_budget({"compressed": 0, "children": {}}, size_budget)
+                for key, limit in size_budget.items():
+                    for value in (limit.values() if key == "distributions" else [limit]):
+                        parse_size(value)
+        except ValueError as e:
+            raise ConfigError(str(e))
+        return cls(project_dir, name, venv, include, entry_points, pip_args, target,
+                   configs.get("python_standalone"), strip, configs.get("trace"), configs.get("compression"),
+                   size_budget, targets, fork_server, onefile, import_archive)
+
+    @classmethod
+    def load(cls, project_dir):
+        """Read and validate ``<project_dir>/pkvenv.json``."""
+        project_dir = os.path.abspath(project_dir)
+        try:
+            configs = read_configs(project_dir)
+        except ValueError as e:
+            raise ConfigError(str(e))
+        return cls.from_configs(configs, project_dir)
+
+
+class BuildOptions(object):
+    """Per-build options, the same as the flags of the ``pkvenv`` command.
+
+    ``chrome_trace`` and ``prometheus`` are output files; ``quiet`` discards the build log on stdout.
+    ``requirements_file`` is a frozen requirements file of the venv used instead of running `pip freeze`.
+    ``stage_only`` only writes the bundle trees to ``stage_dir``, without the zips and the build report.
+    """
+
+    def __init__(self, no_trace=False, jobs=None, incremental=False, release=False, strip_dry_run=False,
+                 reproducible=False, stage_dir=None, chrome_trace=None, prometheus=None, quiet=False,
+                 requirements_file=None, stage_only=False):
+        self.no_trace = no_trace
+        self.jobs = jobs
+        self.incremental = incremental
+        self.release = release
+        self.strip_dry_run = strip_dry_run
+        self.reproducible = reproducible
+        self.stage_dir = stage_dir
+        self.chrome_trace = chrome_trace
+        self.prometheus = prometheus
+        self.quiet = quiet
+        self.requirements_file = requirements_file
+        self.stage_only = stage_only
+
+
+class BuildResult(object):
+    """Artifacts and statistics of a successful build; ``report`` is the content of ``report_file``.
+
+    ``zip_files`` maps the variant names to their zips, ``zip_file`` is the first one;
+    ``onefile_files`` are the single-file executables of the `onefile` builds.
+    """
+
+    def __init__(self, zip_files, report_file, report, stage_dir=None, chrome_trace=None, values=None,
+                 onefile_files=None):
+        values = values or {}
+        self.zip_files = zip_files
+        self.zip_file = list(zip_files.values())[0]
+        self.onefile_files = onefile_files or {}
+        self.report_file = report_file
+        self.report = report
+        self.stage_dir = stage_dir
+        self.chrome_trace = chrome_trace
+        self.requirements_file = values.get("requirements_file")
+        self.python_file = values.get("python_zip_file")
+        self.runtime_layer = values.get("runtime_layer")
+
+    @property
+    def seconds(self):
+        return self.report["seconds"]
+
+    @property
+    def timings(self):
+        """{stage: seconds}"""
+        return self.report["stages"]
+
+    @property
+    def cache(self):
+        """{cache name: {"hits": n, "misses": n}}"""
+        return self.report["cache"]
+
+    def __repr__(self):
+        return "<BuildResult %s %.2fs>" % (self.zip_file, self.seconds)
+
+
+def build(config, options=None, progress=None):
+    """Build the bundle zip of a project and return a ``BuildResult``.
+
+    ``config`` is a ``BuildConfig`` or a project directory. ``progress(event, stage)`` is
+    called with event start/finish/error from the thread running the stage.
+    Raises ``ConfigError`` for invalid configs and ``BuildError`` when a stage fails.
+    """
+    if not isinstance(config, BuildConfig):
+        config = BuildConfig.load(config)
+    options = options or BuildOptions()
+    with _build_lock, ExitStack() as stack:
+        if options.quiet:
+            stack.enter_context(redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        return _build(config, options, progress)
+
+
+def _build(config, options, progress):
+    tracer.reset()
+    report.reset()
+    try:
+        compression = CompressionPolicy.from_configs(config.compression, options.release)
+        venv_configs = parse_venv_configs(config.venv_path)
+    except ValueError as e:
+        raise ConfigError(str(e))
+    if "version" not in venv_configs:
+        raise ConfigError("Can not find python version is venv config file!")
+    if options.requirements_file and not os.path.isfile(options.requirements_file):
+        raise ConfigError("requirements file %s does not exist" % options.requirements_file)
+    if options.stage_only and not options.stage_dir:
+        raise ConfigError("`stage_only` requires `stage_dir`")
+    print("Found venv configs:", venv_configs, config.venv_path)
+
+    target = config.target
+    project_dir = config.project_dir
+    build_path = config.build_path
+    os.makedirs(build_path, exist_ok=True)
+    variants = config.get_variants(venv_configs['version'])
+    source_date_epoch = get_source_date_epoch(options.reproducible)
+    stage_dir = os.path.abspath(os.path.join(project_dir, options.stage_dir)) if options.stage_dir else None
+    zip_files = OrderedDict((variant.name, config.get_zip_file(variant)) for variant in variants)
+    onefile_files = OrderedDict((variant.name, config.get_onefile_file(variant))
+                                for variant in variants if config.onefile is not None)
+    pipeline = Pipeline(callback=progress)
+
+    # 构建流程是一个DAG, 互不依赖的stage(下载, pip freeze, 复制项目文件)并发执行.
+    # 与架构和python版本无关的stage(freeze, 项目文件)只执行一次, 各个variant的runtime并发构建
+    def freeze():
+        if options.requirements_file:
+            # build-all 已经freeze了共享的venv
+            print("Use requirements file:", options.requirements_file)
+            return os.path.abspath(options.requirements_file)
+        requirements_file = get_new_requirements(config.venv_path, build_path,
+                                                 get_py_version_from_str(venv_configs['version']))
+        print("Found new requirements file:", requirements_file)
+        return requirements_file
+
+    def app_files(site_packages):
+        app_tree = BundleTree()
+        copy_files(config.include_files, app_tree, config.entry_points, site_packages, target,
+                   config.fork_server is not None)
+        gen_launch_file(app_tree, config.entry_points, site_packages)
+        return app_tree
+
+    pipeline.add("freeze", freeze, outputs=["requirements_file"], resource="cpu")
+    need_get_pip = target == "windows" and any(not variant.cross_build for variant in variants)
+    pipeline.add("fetch_get_pip", lambda: fetch_get_pip() if need_get_pip else None, outputs=["get_pip_file"],
+                 resource="network")
+    app_trees = {}  # site-packages路径 -> app_tree, linux下与python版本有关
+    for variant in variants:
+        site_packages = get_site_packages_arcname(target, get_py_version_from_str(variant.python_version))
+        if site_packages not in app_trees:
+            suffix = ":%s" % variant.name if app_trees else ""
+            app_trees[site_packages] = "app_tree" + suffix
+            pipeline.add("app_files" + suffix, lambda site_packages=site_packages: app_files(site_packages),
+                         outputs=[app_trees[site_packages]], resource="disk")
+        _add_variant_stages(pipeline, config, options, variant, site_packages, app_trees[site_packages],
+                            compression, source_date_epoch, zip_files[variant.name], stage_dir,
+                            onefile_files.get(variant.name))
+
+    status = "failed"
+    values = None
+    chrome_trace = os.path.abspath(options.chrome_trace) if options.chrome_trace else None
+    report_file = os.path.join(build_path, "%s.report.json" % config.name)
+    try:
+        values = pipeline.run()
+        status = "success"
+    except PkvenvError:
+        raise
+    # requests.RequestException 是 OSError 的子类, 不在这里导入 requests
+    except (ValueError, OSError, subprocess.CalledProcessError) as e:
+        raise BuildError("stage `%s` failed: %s" % (pipeline.failed_stage, e), pipeline.failed_stage) from e
+    finally:
+        if chrome_trace:
+            tracer.write_chrome_trace(chrome_trace)
+            print("Build trace:", chrome_trace)
+        build_report = report.to_dict(config.name, status, tracer.get_durations("stage"))
+        if not options.stage_only:  # 不覆盖上一次构建zip的报告
+            report.write_json(report_file, build_report)
+        if options.prometheus:
+            report.write_prometheus(os.path.abspath(options.prometheus), build_report)
+    return BuildResult(zip_files, report_file, build_report, stage_dir, chrome_trace, values, onefile_files)
+
+
+def _add_variant_stages(pipeline, config, options, variant, site_packages, app_tree_name, compression,
+                        source_date_epoch, zip_file, stage_dir, onefile_file=None):
+    target = config.target
+    # 只有一个variant时stage和值的名称不带后缀, 与之前的trace和报告保持一致
+    suffix = ":" + variant.name if variant.matrix else ""
+    if variant.matrix and stage_dir:
+        stage_dir = os.path.join(stage_dir, variant.name)
+
+    def fetch_python():
+        if target == "linux":
+            python_zip_file = fetch_standalone_python(variant.python_version, variant.python_standalone, variant.arch)
+            print("Fetch standalone python:", python_zip_file)
+        else:
+            python_zip_file = fetch_embeddable_python(variant.python_version, variant.arch)
+            print("Fetch embed python:", python_zip_file)
+        return python_zip_file
+
+    def runtime_layer(python_zip_file, requirements_file, get_pip_file):
+        return get_runtime_layer(python_zip_file, requirements_file, config.build_path, source_date_epoch,
+                                 None if variant.cross_build else get_pip_file, variant.cross_build,
+                                 config.pip_args, target, variant.arch)
+
+    def runtime_tree(runtime_layer, python_zip_file, requirements_file):
+        # 打包目录只是一个虚拟的文件映射, 直接写入zip
+        tree = BundleTree()
+        tree.add_tree(PYTHON_ARCNAME, os.path.join(runtime_layer, PYTHON_ARCNAME))
+        if target == "windows":
+            pth_filename, pth_content = gen_pth_file(python_zip_file)
+            tree.add_bytes(PYTHON_ARCNAME + "/" + pth_filename, pth_content)
+        tree.add_file("requirements.txt", requirements_file)
+        return tree
+
+    def assemble(runtime_tree, app_tree, runtime_layer):
+        tree = runtime_tree
+        tree.update(app_tree)
+        if config.strip != "none":
+            with span("strip", profile=config.strip if isinstance(config.strip, str) else "custom") as args:
+                files = len(tree)
+                strip_files(tree, PYTHON_ARCNAME, site_packages, config.strip, options.strip_dry_run)
+                args["removed_files"] = files - len(tree)
+        if not options.no_trace and os.path.exists(config.trace_file):
+            with span("minimize") as args:
+                files = len(tree)
+                minimize_from_trace(tree, config.trace_file, config.keep_patterns, site_packages)
+                args["removed_files"] = files - len(tree)
+        if config.import_archive is not None:
+            # 在fork server之前生成, 归档的内容包含在fork server的hash中
+            write_import_archive(tree, site_packages, os.path.splitext(zip_file)[0] + ".pka",
+                                 get_py_version_from_str(variant.python_version), config.import_archive["exclude"])
+        if config.fork_server is not None:
+            with span("fork server"):
+                gen_fork_server_files(tree, config.entry_points, site_packages, runtime_layer,
+                                      config.fork_server["idle_timeout"])
+        return tree
+
+    def zip_bundle(tree):
+        zip_files(tree, zip_file, options.jobs, compression, options.incremental, source_date_epoch, variant.name)
+        if variant.matrix:
+            report.set("variants", **{variant.name: {"zip_file": zip_file, "arch": variant.arch,
+                                                     "python": variant.python_version,
+                                                     "compressed_bytes": os.path.getsize(zip_file)}})
+        return zip_file
+
+    def onefile(tree):
+        # 与zip阶段并发, 各自读取同一个tree
+        level = compression.level if compression.method == ZIP_DEFLATED and compression.level else 6
+        return write_onefile(tree, onefile_file, config.name, config.entry_points, site_packages,
+                             config.fork_server is not None, config.onefile["chunks"], options.jobs, level,
+                             source_date_epoch)
+
+    def check_size(tree, zip_file):
+        # 原始大小来自打包的tree, 压缩后的大小来自zip
+        size_tree = analyze_tree(tree, zip_file)
+        errors = check_size_budget(size_tree, config.size_budget)
+        if errors:
+            print_size_report(size_tree)
+            raise SizeBudgetError(errors, zip_file)
+
+    def stage(tree):
+        print("Stage bundle to", stage_dir)
+        with span("materialize", files=len(tree)):
+            tree.materialize(stage_dir)
+
+    pipeline.add("fetch_python" + suffix, fetch_python, outputs=["python_zip_file" + suffix], resource="network")
+    pipeline.add("runtime_layer" + suffix,
+                 lambda **values: runtime_layer(values["python_zip_file" + suffix], values["requirements_file"],
+                                                values["get_pip_file"]),
+                 inputs=["python_zip_file" + suffix, "requirements_file", "get_pip_file"],
+                 outputs=["runtime_layer" + suffix], resource="cpu")
+    pipeline.add("runtime_tree" + suffix,
+                 lambda **values: runtime_tree(values["runtime_layer" + suffix], values["python_zip_file" + suffix],
+                                               values["requirements_file"]),
+                 inputs=["runtime_layer" + suffix, "python_zip_file" + suffix, "requirements_file"],
+                 outputs=["runtime_tree" + suffix], resource="disk")
+    pipeline.add("assemble" + suffix,
+                 lambda **values: assemble(values["runtime_tree" + suffix], values[app_tree_name],
+                                           values["runtime_layer" + suffix]),
+                 inputs=["runtime_tree" + suffix, app_tree_name, "runtime_layer" + suffix], outputs=["tree" + suffix],
+                 resource="cpu")
+    if stage_dir:
+        pipeline.add("stage" + suffix, lambda **values: stage(values["tree" + suffix]), inputs=["tree" + suffix],
+                     resource="disk")
+    if options.stage_only:
+        return
+    pipeline.add("zip" + suffix, lambda **values: zip_bundle(values["tree" + suffix]), inputs=["tree" + suffix],
+                 outputs=["zip_file" + suffix], resource="cpu")
+    if onefile_file:
+        pipeline.add("onefile" + suffix, lambda **values: onefile(values["tree" + suffix]), inputs=["tree" + suffix],
+                     outputs=["onefile_file" + suffix], resource="cpu")
+    if config.size_budget:
+        pipeline.add("size" + suffix, lambda **values: check_size(values["tree" + suffix], values["zip_file" + suffix]),
+                     inputs=["tree" + suffix, "zip_file" + suffix], resource="disk")
@@ -0,0 +1,580 @@
+import os
+import bz2
+import time
+import zlib
+import json
+import shutil
+import struct
+import hashlib
+import zipfile
+import tempfile
+import functools
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# 并行压缩的zip写入器: 文件(大文件按块)在线程池中DEFLATE压缩(zlib压缩时会释放GIL),
+# 再按顺序写入同一个标准zip文件, 支持Zip64. 同时在途的块数有上限, 内存占用有界.
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_BZIP2 = 12
+ZIP_LZMA = 14
+
+COMPRESSION_METHODS = {
+    "store": ZIP_STORED,
+    "deflate": ZIP_DEFLATED,
+    "bzip2": ZIP_BZIP2,
+    "lzma": ZIP_LZMA,
+}
+METHOD_VERSIONS = {
+    ZIP_STORED: 20,
+    ZIP_DEFLATED: 20,
+    ZIP_BZIP2: 46,
+    ZIP_LZMA: 63,
+}
+
+# 已经压缩过的文件格式, 再压缩只会浪费CPU
+DEFAULT_STORE_EXTENSIONS = (
+    ".zip", ".whl", ".egg", ".jar", ".gz", ".tgz", ".bz2", ".xz", ".lzma", ".7z", ".zst",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico", ".mp3", ".mp4", ".ogg", ".webm", ".avi", ".mkv",
+    ".woff", ".woff2",
+)
+PROBE_SIZE = 1 << 16
+# 压缩后至少要减少3%, 否则直接存储
+PROBE_RATIO = 0.97
+
+# 增量压缩时记录每个条目源文件内容hash的索引文件
+MANIFEST_SUFFIX = ".manifest.json"
+
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_FILECOUNT_LIMIT = (1 << 16) - 1
+
+CHUNK_SIZE = 1 << 20
+DICT_SIZE = 1 << 15
+
+LOCAL_HEADER_STRUCT = struct.Struct("<4s2B4HL2L2H")
+CENTRAL_DIR_STRUCT = struct.Struct("<4s4B4HL2L5H2L")
+END_CENTRAL_DIR_STRUCT = struct.Struct("<4s4H2LH")
+END_CENTRAL_DIR64_STRUCT = struct.Struct("<4sQ2H2L4Q")
+END_CENTRAL_DIR64_LOCATOR_STRUCT = struct.Struct("<4sLQL")
+
+
+def _gf2_matrix_times(mat, vec):
+    result = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            result ^= mat[i]
+        vec >>= 1
+        i += 1
+    return result
+
+
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, mat[n]) for n in range(32)]
+
+
+@functools.lru_cache(maxsize=32)
+def _crc32_zeros_operator(length):
+    # 矩阵: 将crc延伸length个0字节 (zlib crc32_combine 的矩阵形式, 按长度缓存)
+    odd = [0xedb88320] + [1 << n for n in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+    result = [1 << n for n in range(32)]
+    while True:
+        even = _gf2_matrix_square(odd)
+        if length & 1:
+            result = [_gf2_matrix_times(even, column) for column in result]
+        length >>= 1
+        if not length:
+            break
+        odd = _gf2_matrix_square(even)
+        if length & 1:
+            result = [_gf2_matrix_times(odd, column) for column in result]
+        length >>= 1
+        if not length:
+            break
+    return result
+
+
+def crc32_combine(crc1, crc2, len2):
+    """Return the CRC-32 of A+B given crc32(A), crc32(B) and len(B)."""
+    if len2 <= 0:
+        return crc1
+    if not crc1:
+        return crc2
+    return _gf2_matrix_times(_crc32_zeros_operator(len2), crc1) ^ crc2
+
+
+def _dos_date_time(timestamp, utc=False):
+    t = time.gmtime(timestamp) if utc else time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0x21, 0  # 1980-01-01 00:00:00
+    date = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return date, dos_time
+
+
+def _is_incompressible(data):
+    return len(zlib.compress(data[:PROBE_SIZE], 1)) > min(len(data), PROBE_SIZE) * PROBE_RATIO
+
+
+def _compress_chunk(path, offset, size, method, level, is_last, probe):
+    """Read and DEFLATE (or store) one chunk of a file, runs in the worker pool."""
+    with open(path, "rb") as f:
+        zdict = None
+        if offset and method == ZIP_DEFLATED:
+            # 使用前一块的末尾32K作为字典, 压缩率与整体压缩基本一致
+            dict_offset = max(0, offset - DICT_SIZE)
+            f.seek(dict_offset)
+            zdict = f.read(offset - dict_offset)
+        else:
+            f.seek(offset)
+        data = f.read(size)
+    crc = zlib.crc32(data)
+    if method == ZIP_STORED:
+        return crc, len(data), data, ZIP_STORED
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH)
+    if probe and len(compressed) > len(data) * PROBE_RATIO:
+        # 只有不分块的文件才会在这里决定存储, 大文件在添加时已经抽样探测过
+        return crc, len(data), data, ZIP_STORED
+    return crc, len(data), compressed, ZIP_DEFLATED
+
+
+def _compress_file(path, method, level, probe, spool_size):
+    """Compress a whole file with bzip2 or LZMA, spooling large outputs to disk."""
+    if method == ZIP_BZIP2:
+        compressor = bz2.BZ2Compressor(min(max(level, 1), 9))
+    else:
+        # 与zipfile写入的格式一致(带LZMA属性头)
+        compressor = zipfile.LZMACompressor()
+    output = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    crc, size = 0, 0
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(spool_size)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            output.write(compressor.compress(data))
+    output.write(compressor.flush())
+    if probe and size <= spool_size and output.tell() > size * PROBE_RATIO:
+        output.close()
+        with open(path, "rb") as f:
+            return crc, size, f.read(), ZIP_STORED
+    output.seek(0)
+    return crc, size, output, method
+
+
+def _compress_data(data, method, level, probe):
+    """Compress in-memory content as a single entry."""
+    crc = zlib.crc32(data)
+    if method == ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    elif method == ZIP_BZIP2:
+        compressor = bz2.BZ2Compressor(min(max(level, 1), 9))
+    elif method == ZIP_LZMA:
+        compressor = zipfile.LZMACompressor()
+    else:
+        return crc, len(data), data, ZIP_STORED
+    compressed = compressor.compress(data) + compressor.flush()
+    if probe and len(compressed) > len(data) * PROBE_RATIO:
+        return crc, len(data), data, ZIP_STORED
+    return crc, len(data), compressed, method
+
+
+# 进程内按路径缓存文件的hash, daemon中连续增量构建时未变化的文件不需要重新计算
+_hash_cache = {}  # path -> (mtime, size, sha256)
+_hash_cache_lock = threading.Lock()
+
+
+def _hash_file(path):
+    st = os.stat(path)
+    with _hash_cache_lock:
+        cached = _hash_cache.get(path)
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    with _hash_cache_lock:
+        _hash_cache[path] = (st.st_mtime_ns, st.st_size, h.hexdigest())
+    return h.hexdigest()
+
+
+class _RegionReader(object):
+    """File-like object reading ``size`` bytes starting at ``offset`` of a file."""
+
+    def __init__(self, path, offset, size):
+        self.f = open(path, "rb")
+        self.f.seek(offset)
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def _copy_entry(path, header_offset, crc, file_size, compress_size, method):
+    """Return the compressed bytes of an entry of an existing zip file without decompressing them."""
+    with open(path, "rb") as f:
+        f.seek(header_offset)
+        header = LOCAL_HEADER_STRUCT.unpack(f.read(LOCAL_HEADER_STRUCT.size))
+    data_offset = header_offset + LOCAL_HEADER_STRUCT.size + header[10] + header[11]
+    return crc, file_size, _RegionReader(path, data_offset, compress_size), method
+
+
+class ZipEntry(object):
+
+    def __init__(self, arcname, path, mtime, mode, file_size, method, level=0, probe=False, data=None):
+        self.arcname = arcname
+        self.path = path
+        self.data = data
+        self.mtime = mtime
+        self.mode = mode
+        self.file_size = file_size
+        self.method = method
+        self.level = level
+        self.probe = probe
+        self.requested = (method, level)  # 探测之前由压缩策略决定的压缩方式
+        self.sha256 = None
+        self.reuse = None
+        self.crc = 0
+        self.compress_size = 0
+        self.header_offset = 0
+
+    @property
+    def is_dir(self):
+        return self.arcname.endswith("/")
+
+    @property
+    def zip64(self):
+        # 压缩后可能略大于原始大小, 与zipfile一致留出余量
+        return self.file_size * 1.05 > ZIP64_LIMIT
+
+    @property
+    def flags(self):
+        flags = 0x02 if self.method == ZIP_LZMA else 0  # LZMA使用EOS标记
+        try:
+            self.arcname.encode("ascii")
+        except UnicodeEncodeError:
+            flags |= 0x800
+        return flags
+
+    @property
+    def version(self):
+        return max(METHOD_VERSIONS[self.method], 45 if self.zip64 else 0)
+
+
+class CompressionPolicy(object):
+    """Choose the compression method and level of each file by its extension.
+
+    ``extensions`` maps an extension to "store", "deflate", "bzip2", "lzma" or a level
+    of the default method (0 means store).
+    """
+
+    def __init__(self, method="deflate", level=6, extensions=None, entropy_probe=True):
+        if method not in COMPRESSION_METHODS:
+            raise ValueError("unknown compression method `%s`, available: %s" % (method, ", ".join(COMPRESSION_METHODS)))
+        self.method = COMPRESSION_METHODS[method]
+        self.level = level
+        self.entropy_probe = entropy_probe
+        self.extensions = dict((ext, "store") for ext in DEFAULT_STORE_EXTENSIONS)
+        for ext, value in (extensions or {}).items():
+            ext = ext.lower() if ext.startswith(".") else "." + ext.lower()
+            if not isinstance(value, int) and value not in COMPRESSION_METHODS:
+                raise ValueError("invalid compression `%s` for `%s`" % (value, ext))
+            self.extensions[ext] = value
+
+    @classmethod
+    def from_configs(cls, configs, release=False):
+        # "compression": {"method": "deflate", "level": 6, "extensions": {}, "entropy_probe": true, "release": {...}}
+        configs = dict(configs or {})
+        release_configs = configs.pop("release", {})
+        if release:
+            extensions = dict(configs.get("extensions", {}))
+            extensions.update(release_configs.get("extensions", {}))
+            configs.update(release_configs)
+            configs["extensions"] = extensions
+        return cls(configs.get("method", "deflate"), configs.get("level", 6), configs.get("extensions"),
+                   configs.get("entropy_probe", True))
+
+    def get(self, filename):
+        value = self.extensions.get(os.path.splitext(filename)[1].lower())
+        if value is None:
+            method, level = self.method, self.level
+        elif isinstance(value, int):
+            method, level = (self.method, value) if value else (ZIP_STORED, 0)
+        else:
+            method, level = COMPRESSION_METHODS[value], self.level
+        if method == ZIP_DEFLATED and not level:
+            method = ZIP_STORED
+        return method, level
+
+
+class ZipWriter(object):
+    """Write a standard zip file, compressing entries concurrently.
+
+    Entries are compressed by a thread pool and written strictly in the order they
+    were added; at most ``workers * 4`` chunks are held in memory at any time.
+
+    With ``incremental``, entries whose source content hash matches an entry of the
+    previous archive are copied raw (compressed bytes and CRC)
+    instead of being recompressed.
+    """
+
+    def __init__(self, file, workers=None, policy=None, chunk_size=CHUNK_SIZE, incremental=False,
+                 source_date_epoch=None):
+        self.file = file
+        self.source_date_epoch = source_date_epoch
+        self.workers = workers or os.cpu_count() or 1
+        self.policy = policy or CompressionPolicy()
+        self.chunk_size = chunk_size
+        self.incremental = incremental
+        self.entries = []
+        self.raw_size = 0
+        self.reused = 0
+
+    def _normalize(self, mtime, mode, is_dir=False):
+        if self.source_date_epoch is None:
+            return mtime, mode
+        if is_dir:
+            return min(mtime, self.source_date_epoch), 0o40755
+        return min(mtime, self.source_date_epoch), 0o100755 if mode & 0o111 else 0o100644
+
+    def add(self, arcname, path, mode=None):
+        st = os.stat(path)
+        if os.path.isdir(path):
+            return self.add_dir(arcname, st.st_mtime, st.st_mode)
+        mtime, mode = self._normalize(st.st_mtime, mode or st.st_mode)
+        method, level = self.policy.get(path)
+        probe = self.policy.entropy_probe and method != ZIP_STORED
+        if probe and st.st_size > self.chunk_size:
+            # 大文件需要在添加时确定压缩方式, 抽样探测
+            with open(path, "rb") as f:
+                if _is_incompressible(f.read(PROBE_SIZE)):
+                    method = ZIP_STORED
+        entry = ZipEntry(arcname, path, mtime, (mode & 0xFFFF) << 16, st.st_size,
+                         method, level, probe)
+        self.entries.append(entry)
+        return entry
+
+    def add_bytes(self, arcname, data, mtime, mode=0o100644):
+        mtime, mode = self._normalize(mtime, mode)
+        method, level = self.policy.get(arcname)
+        probe = self.policy.entropy_probe and method != ZIP_STORED
+        entry = ZipEntry(arcname, None, mtime, (mode & 0xFFFF) << 16, len(data), method, level, probe, data)
+        self.entries.append(entry)
+        return entry
+
+    def add_dir(self, arcname, mtime, mode=0o40755):
+        arcname = arcname.rstrip("/") + "/"
+        mtime, mode = self._normalize(mtime, mode, True)
+        entry = ZipEntry(arcname, None, mtime, (mode & 0xFFFF) << 16 | 0x10, 0, ZIP_STORED)
+        self.entries.append(entry)
+        return entry
+
+    def add_tree(self, root):
+        for dirpath, dirnames, filenames in os.walk(root):
+            # 原地排序: os.walk按dirnames的顺序进入子目录, 条目顺序与文件系统无关
+            dirnames.sort()
+            filenames.sort()
+            for name in dirnames:
+                path = os.path.join(dirpath, name)
+                self.add(os.path.relpath(path, root).replace(os.sep, "/"), path)
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                self.add(os.path.relpath(path, root).replace(os.sep, "/"), path)
+
+    def add_bundle(self, tree):
+        """Add every directory and file of a :class:`pkvenv.bundle.BundleTree`, sorted by path."""
+        now = time.time()
+        items = [(arcname + "/", None) for arcname in tree.iter_dirs()] + list(tree.iter_files())
+        for arcname, entry in sorted(items, key=lambda item: item[0]):
+            if entry is None:
+                self.add_dir(arcname, now)
+            elif entry.data is not None:
+                self.add_bytes(arcname, entry.data, entry.mtime, 0o100000 | (entry.mode or 0o644))
+            else:
+                self.add(arcname, entry.path, entry.mode and 0o100000 | entry.mode)
+
+    def _iter_tasks(self):
+        for entry in self.entries:
+            if entry.is_dir:
+                yield entry, None, True, True
+                continue
+            if entry.reuse:
+                yield entry, (_copy_entry, self.file) + entry.reuse, True, True
+                continue
+            if entry.data is not None:
+                yield entry, (_compress_data, entry.data, entry.method, entry.level, entry.probe), True, True
+                continue
+            if entry.method in (ZIP_BZIP2, ZIP_LZMA):
+                yield entry, (_compress_file, entry.path, entry.method, entry.level, entry.probe,
+                              self.chunk_size), True, True
+                continue
+            offset = 0
+            while True:
+                size = min(self.chunk_size, entry.file_size - offset)
+                is_last = offset + size >= entry.file_size
+                probe = entry.probe and offset == 0 and is_last
+                yield entry, (_compress_chunk, entry.path, offset, size, entry.method, entry.level, is_last,
+                              probe), offset == 0, is_last
+                offset += size
+                if is_last:
+                    break
+
+    def _write_local_header(self, f, entry):
+        name = entry.arcname.encode("utf-8")
+        date, dos_time = _dos_date_time(entry.mtime, self.source_date_epoch is not None)
+        if entry.zip64:
+            extra = struct.pack("<HHQQ", 1, 16, entry.file_size, entry.compress_size)
+            compress_size = file_size = 0xFFFFFFFF
+        else:
+            extra = b""
+            compress_size, file_size = entry.compress_size, entry.file_size
+        f.write(LOCAL_HEADER_STRUCT.pack(b"PK\003\004", entry.version, 0, entry.flags, entry.method, dos_time, date,
+                                         entry.crc, compress_size, file_size, len(name), len(extra)))
+        f.write(name)
+        f.write(extra)
+
+    def _write_central_dir(self, f):
+        start = f.tell()
+        for entry in self.entries:
+            name = entry.arcname.encode("utf-8")
+            date, dos_time = _dos_date_time(entry.mtime, self.source_date_epoch is not None)
+            extra_values = []
+            file_size, compress_size, header_offset = entry.file_size, entry.compress_size, entry.header_offset
+            if entry.zip64 or file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT:
+                extra_values += [file_size, compress_size]
+                file_size = compress_size = 0xFFFFFFFF
+            if header_offset > ZIP64_LIMIT:
+                extra_values.append(header_offset)
+                header_offset = 0xFFFFFFFF
+            extra = struct.pack("<HH%dQ" % len(extra_values), 1, 8 * len(extra_values), *extra_values) \
+                if extra_values else b""
+            version = max(entry.version, 45 if extra_values else 0)
+            create_system = 0 if os.name == "nt" and self.source_date_epoch is None else 3
+            f.write(CENTRAL_DIR_STRUCT.pack(b"PK\001\002", version, create_system, version, 0, entry.flags, entry.method,
+                                            dos_time, date, entry.crc, compress_size, file_size, len(name),
+                                            len(extra), 0, 0, 0, entry.mode, header_offset))
+            f.write(name)
+            f.write(extra)
+        end = f.tell()
+
+        count, size, offset = len(self.entries), end - start, start
+        if count > ZIP_FILECOUNT_LIMIT or size > ZIP64_LIMIT or offset > ZIP64_LIMIT:
+            f.write(END_CENTRAL_DIR64_STRUCT.pack(b"PK\006\006", 44, 45, 45, 0, 0, count, count, size, offset))
+            f.write(END_CENTRAL_DIR64_LOCATOR_STRUCT.pack(b"PK\006\007", 0, end, 1))
+            count = min(count, 0xFFFF)
+            size = min(size, 0xFFFFFFFF)
+            offset = min(offset, 0xFFFFFFFF)
+        f.write(END_CENTRAL_DIR_STRUCT.pack(b"PK\005\006", 0, 0, count, count, size, offset, 0))
+
+    def _load_previous(self):
+        previous = {}
+        manifest_file = self.file + MANIFEST_SUFFIX
+        if not os.path.exists(self.file) or not os.path.exists(manifest_file):
+            return previous
+        try:
+            with open(manifest_file, "r") as f:
+                manifest = json.load(f)
+            with zipfile.ZipFile(self.file) as zf:
+                infos = zf.infolist()
+            for info in infos:
+                item = manifest["entries"].get(info.filename)
+                if item:
+                    key = (item["sha256"], item["method"], item["level"])
+                    previous[key] = (info.header_offset, info.CRC, info.file_size, info.compress_size,
+                                     info.compress_type)
+        except (ValueError, KeyError, TypeError, AttributeError, zipfile.BadZipFile):
+            return {}  # 损坏或其他版本的manifest, 全部重新压缩
+        return previous
+
+    def _match_previous(self, executor):
+        previous = self._load_previous()
+        files = [entry for entry in self.entries if not entry.is_dir]
+        hashes = executor.map(lambda entry: hashlib.sha256(entry.data).hexdigest() if entry.data is not None
+                              else _hash_file(entry.path), files)
+        for entry, sha256 in zip(files, hashes):
+            entry.sha256 = sha256
+            reuse = previous.get((sha256,) + entry.requested)
+            if reuse and reuse[2] == entry.file_size:
+                entry.reuse = reuse
+                self.reused += 1
+
+    def _write_manifest(self):
+        entries = {}
+        for entry in self.entries:
+            if entry.sha256:
+                entries[entry.arcname] = {"sha256": entry.sha256, "method": entry.requested[0],
+                                          "level": entry.requested[1]}
+        with open(self.file + MANIFEST_SUFFIX + ".tmp", "w") as f:
+            json.dump({"version": 1, "entries": entries}, f)
+        os.replace(self.file + MANIFEST_SUFFIX + ".tmp", self.file + MANIFEST_SUFFIX)
+
+    def close(self):
+        max_pending = self.workers * 4
+        pending = collections.deque()
+        tmp_file = self.file + ".tmp"
+        with open(tmp_file, "wb") as f, ThreadPoolExecutor(max_workers=self.workers) as executor:
+            if self.incremental:
+                self._match_previous(executor)
+            for entry, task, is_first, is_last in self._iter_tasks():
+                future = executor.submit(*task) if task else None
+                pending.append((entry, future, is_first, is_last))
+                while len(pending) > max_pending:
+                    self._write_pending(f, *pending.popleft())
+            while pending:
+                self._write_pending(f, *pending.popleft())
+            self._write_central_dir(f)
+        # 先删除旧的manifest再替换zip: 在两者之间中断时不会留下与新zip不对应的manifest
+        if os.path.exists(self.file + MANIFEST_SUFFIX):
+            os.remove(self.file + MANIFEST_SUFFIX)
+        os.replace(tmp_file, self.file)
+        if self.incremental:
+            self._write_manifest()
+        return self
+
+    def _write_pending(self, f, entry, future, is_first, is_last):
+        result = future.result() if future is not None else None
+        if is_first:
+            if result is not None:
+                entry.method = result[3]
+            entry.header_offset = f.tell()
+            self._write_local_header(f, entry)
+        if result is not None:
+            crc, size, data, _ = result
+            entry.crc = crc32_combine(entry.crc, crc, size)
+            self.raw_size += size
+            if isinstance(data, bytes):
+                entry.compress_size += len(data)
+                f.write(data)
+            else:
+                start = f.tell()
+                shutil.copyfileobj(data, f)
+                data.close()
+                entry.compress_size += f.tell() - start
+        if is_last and not entry.is_dir:
+            # 回填本地文件头中的crc和大小
+            end = f.tell()
+            f.seek(entry.header_offset)
+            self._write_local_header(f, entry)
+            f.seek(end)
+
+    @property
+    def compress_size(self):
+        return sum(entry.compress_size for entry in self.entries)
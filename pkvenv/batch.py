@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from .main import (CONFIG_FILE_NAME, parse_venv_configs, get_py_version_from_str, get_source_date_epoch,
+                   is_cacheable_requirements, get_new_requirements, fetch_standalone_python,
+                   fetch_embeddable_python, fetch_get_pip, get_runtime_layer)
+from .api import BuildConfig, ConfigError
+from .size import format_size
+from .pipeline import Pipeline
+from .metrics import tracer
+from .remote_cache import wait_for_uploads
+
+# 查找配置文件时跳过的目录
+SKIP_DIRS = ("build", "node_modules", "__pycache__")
+
+
+def discover_projects(root):
+    """Return the sorted project dirs containing a pkvenv.json under ``root``."""
+    projects = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if CONFIG_FILE_NAME in filenames:
+            projects.append(os.path.abspath(dirpath))
+        # 不进入venv, build输出和隐藏目录
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith(".") and name not in SKIP_DIRS
+                             and not os.path.exists(os.path.join(dirpath, name, "pyvenv.cfg")))
+    return sorted(projects)
+
+
+class App(object):
+    """One project of the batch and the result of its build."""
+
+    def __init__(self, project_dir):
+        self.project_dir = project_dir
+        self.config = None
+        self.python_version = None
+        self.py_version = None
+        self.variants = []
+        self.requirements = None  # 共享的freeze stage的输出
+        self.status = "pending"
+        self.error = None
+        self.seconds = None
+        self.report = None
+        self.log_file = None
+
+    @property
+    def name(self):
+        return self.config.name if self.config else os.path.basename(self.project_dir)
+
+
+def plan_shared_work(apps, pipeline, reproducible=False):
+    """Add stages doing the work shared by several apps once: fetching each python
+    distribution, freezing each venv and installing each distinct runtime layer.
+
+    Failures are only warned about: the build of the app reports the actual error.
+    Return {app: [outputs of the shared runtime layers the app waits for]}; ``app.requirements``
+    is set to the output of the freeze stage of its venv.
+    """
+    source_date_epoch = get_source_date_epoch(reproducible)
+    pythons = {}  # (target, arch, version, source) -> output
+    venvs = {}  # venv path -> output
+    layers = {}  # (python output, venv output, target, arch) -> output
+    waiting = {}
+
+    def shared(name, func, inputs=(), resource="cpu"):
+        def run(**values):
+            if any(values[key] is None for key in inputs):
+                return None
+            try:
+                return func(*[values[key] for key in inputs])
+            except Exception as e:
+                print("[Warning] %s failed: %s" % (name, e))
+                return None
+        pipeline.add(name, run, inputs=inputs, outputs=[name], resource=resource)
+        return name
+
+    need_get_pip = any(variant.target == "windows" and not variant.cross_build
+                       for app in apps for variant in app.variants)
+    get_pip = shared("get-pip", fetch_get_pip, resource="network") if need_get_pip else None
+    for app in apps:
+        config = app.config
+        if config.venv_path not in venvs:
+            os.makedirs(config.build_path, exist_ok=True)
+            venvs[config.venv_path] = shared(
+                "freeze %s" % os.path.relpath(config.venv_path),
+                lambda venv_path=config.venv_path, build_path=config.build_path, py_version=app.py_version:
+                    get_new_requirements(venv_path, build_path, py_version))
+        app.requirements = venvs[config.venv_path]
+        app_layers = []
+        for variant in app.variants:
+            python_key = (variant.target, variant.arch, variant.python_version, variant.python_standalone)
+            if python_key not in pythons:
+                if variant.target == "linux":
+                    func = lambda variant=variant: fetch_standalone_python(
+                        variant.python_version, variant.python_standalone, variant.arch)
+                else:
+                    func = lambda variant=variant: fetch_embeddable_python(variant.python_version, variant.arch)
+                pythons[python_key] = shared("python %d (%s %s)" % (len(pythons) + 1, variant.target, variant.name),
+                                             func, resource="network")
+            key = (pythons[python_key], venvs[config.venv_path], variant.target, variant.arch)
+            if key not in layers:
+                inputs = [pythons[python_key], venvs[config.venv_path]]
+                if variant.target == "windows" and not variant.cross_build:
+                    inputs.append(get_pip)
+
+                def layer(python_file, requirements_file, get_pip_file=None, config=config, variant=variant):
+                    # 依赖本地路径的requirements不能缓存, 交给各自的构建
+                    if not is_cacheable_requirements(requirements_file):
+                        return None
+                    return get_runtime_layer(python_file, requirements_file, config.build_path, source_date_epoch,
+                                             get_pip_file, variant.cross_build, config.pip_args, variant.target,
+                                             variant.arch)
+                layers[key] = shared("layer %d" % (len(layers) + 1), layer, inputs)
+            app_layers.append(layers[key])
+        waiting[app] = app_layers
+    return waiting
+
+
+def build_app(app, options, jobs, requirements_file=None):
+    """Build one app in a child process, with its output in `build/<name>.build.log`.
+
+    ``requirements_file`` is the frozen venv of the shared freeze stage, the child does not run `pip freeze` again.
+    """
+    command = [sys.executable, "-m", "pkvenv", app.project_dir, "-j", str(jobs)]
+    for flag in ("no_trace", "incremental", "release", "reproducible"):
+        if getattr(options, flag):
+            command.append("--" + flag.replace("_", "-"))
+    if requirements_file:
+        command += ["--requirements", requirements_file]
+    os.makedirs(app.config.build_path, exist_ok=True)
+    app.log_file = os.path.join(app.config.build_path, "%s.build.log" % app.name)
+    report_file = os.path.join(app.config.build_path, "%s.report.json" % app.name)
+    if os.path.exists(report_file):
+        os.remove(report_file)
+    start = time.perf_counter()
+    app.status = "running"
+    with open(app.log_file, "wb") as f:
+        returncode = subprocess.call(command, stdout=f, stderr=subprocess.STDOUT)
+    app.seconds = time.perf_counter() - start
+    if os.path.exists(report_file):
+        with open(report_file, "r") as f:
+            app.report = json.load(f)
+    app.status = "success" if returncode == 0 else "failed"
+    if returncode != 0:
+        with open(app.log_file, "r", errors="replace") as f:
+            lines = [line.strip() for line in f if line.strip()]
+        errors = [line for line in lines if line.startswith("Error:")]
+        app.error = (errors or lines or ["exited with %d" % returncode])[-1]
+    print("[%s] %s %.1fs%s" % (app.status, app.name, app.seconds, " " + app.error if app.error else ""))
+
+
+def get_summary(apps, seconds, layers):
+    summary = {"apps": len(apps), "success": 0, "failed": 0, "seconds": round(seconds, 3),
+               "build_seconds": 0, "runtime_layers": layers, "cache": {}, "results": []}
+    for app in apps:
+        summary["success" if app.status == "success" else "failed"] += 1
+        summary["build_seconds"] += app.seconds or 0
+        for cache, counter in ((app.report or {}).get("cache") or {}).items():
+            total = summary["cache"].setdefault(cache, {"hits": 0, "misses": 0})
+            total["hits"] += counter["hits"]
+            total["misses"] += counter["misses"]
+        zip_files = []
+        if app.status == "success":
+            variants = (app.report or {}).get("variants")
+            zip_files = [item["zip_file"] for item in variants.values()] if variants else [app.config.zip_file]
+        summary["results"].append({
+            "name": app.name,
+            "project_dir": app.project_dir,
+            "status": app.status,
+            "error": app.error,
+            "seconds": round(app.seconds, 3) if app.seconds is not None else None,
+            "zip_files": zip_files,
+            "zip_bytes": sum(os.path.getsize(zip_file) for zip_file in zip_files if os.path.exists(zip_file)) or None,
+            "stages": (app.report or {}).get("stages"),
+            "log_file": app.log_file,
+        })
+    summary["build_seconds"] = round(summary["build_seconds"], 3)
+    return summary
+
+
+def print_summary(summary):
+    print("Build all: %d apps, %d succeeded, %d failed, %d runtime layers, %.1fs (%.1fs of builds)"
+          % (summary["apps"], summary["success"], summary["failed"], summary["runtime_layers"], summary["seconds"],
+             summary["build_seconds"]))
+    for result in sorted(summary["results"], key=lambda item: -(item["seconds"] or 0)):
+        print("  %-30s %-8s %8s %12s  %s" % (result["name"], result["status"],
+                                             "%.1fs" % result["seconds"] if result["seconds"] is not None else "-",
+                                             format_size(result["zip_bytes"]) if result["zip_bytes"] else "-",
+                                             result["error"] or ""))
+    for cache, counter in sorted(summary["cache"].items()):
+        print("  cache %-24s %d hits, %d misses" % (cache, counter["hits"], counter["misses"]))
+
+
+def build_all_main(argv):
+    argparser = argparse.ArgumentParser(prog="pkvenv build-all")
+    argparser.add_argument("root", help="directory searched for projects with a %s" % CONFIG_FILE_NAME)
+    argparser.add_argument("-j", "--jobs", type=int, help="number of apps built at the same time, default is the number of CPUs")
+    argparser.add_argument("--network", type=int, default=2, help="number of concurrent downloads")
+    argparser.add_argument("--no-trace", action="store_true", help="do not minimize the bundles with the recorded traces")
+    argparser.add_argument("--incremental", action="store_true", help="passed to each build")
+    argparser.add_argument("--release", action="store_true", help="passed to each build")
+    argparser.add_argument("--reproducible", action="store_true", help="passed to each build")
+    argparser.add_argument("--report", metavar="FILE", help="write the summary of all builds to FILE as JSON")
+    argparser.add_argument("--trace", metavar="FILE", help="write the timing of the batch to FILE in Chrome trace-event format")
+    arguments = argparser.parse_args(argv)
+
+    root = os.path.abspath(arguments.root)
+    if not os.path.isdir(root):
+        print("Error: %s is not a directory!" % root)
+        exit(-1)
+    apps = [App(project_dir) for project_dir in discover_projects(root)]
+    if not apps:
+        print("Error: no %s found in %s" % (CONFIG_FILE_NAME, root))
+        exit(-1)
+
+    start = time.perf_counter()
+    valid_apps = []
+    for app in apps:
+        try:
+            app.config = BuildConfig.load(app.project_dir)
+            venv_configs = parse_venv_configs(app.config.venv_path)
+            if "version" not in venv_configs:
+                raise ConfigError("Can not find python version is venv config file!")
+            app.python_version = venv_configs["version"]
+            app.py_version = get_py_version_from_str(app.python_version)
+            app.variants = app.config.get_variants(app.python_version)
+            valid_apps.append(app)
+        except (ConfigError, ValueError) as e:
+            app.status, app.error = "failed", str(e)
+            print("[failed] %s %s" % (app.name, e))
+    # 日志, 报告和汇总都以app名区分, 同名的app都不构建
+    project_dirs = {}
+    for app in valid_apps:
+        project_dirs.setdefault(app.name, []).append(app.project_dir)
+    for app in list(valid_apps):
+        if len(project_dirs[app.name]) > 1:
+            app.status, app.error = "failed", "duplicate app name %s in %s" % (app.name, ", ".join(
+                os.path.relpath(project_dir, root) for project_dir in project_dirs[app.name]))
+            print("[failed] %s %s" % (app.name, app.error))
+            valid_apps.remove(app)
+    print("Found %d apps in %s" % (len(apps), root))
+
+    cpu_count = os.cpu_count() or 1
+    jobs = max(1, arguments.jobs or cpu_count)
+    pipeline = Pipeline(limits={"cpu": jobs, "network": arguments.network})
+    waiting = plan_shared_work(valid_apps, pipeline, arguments.reproducible)
+    for app, layers in waiting.items():
+        # 同时构建多个app时分摊压缩线程
+        pipeline.add("build %s" % app.name, lambda app=app, **values: build_app(app, arguments,
+                                                                                max(1, cpu_count // jobs),
+                                                                                values[app.requirements]),
+                     inputs=layers + [app.requirements], resource="cpu")
+    try:
+        pipeline.run()
+        wait_for_uploads()  # 共享的layer在本进程中生成, 退出前完成上传
+    finally:
+        if arguments.trace:
+            tracer.write_chrome_trace(os.path.abspath(arguments.trace))
+    summary = get_summary(apps, time.perf_counter() - start,
+                          len(set(layer for layers in waiting.values() for layer in layers)))
+    print_summary(summary)
+    if arguments.report:
+        with open(arguments.report, "w") as f:
+            json.dump(summary, f, indent=1)
+        print("Report saved to", arguments.report)
+    if summary["failed"]:
+        exit(-1)
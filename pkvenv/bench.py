@@ -0,0 +1,424 @@
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import base64
+import shutil
+import hashlib
+import zipfile
+import argparse
+import tempfile
+import subprocess
+import statistics
+from contextlib import redirect_stdout
+from . import main as pkvenv_main
+from .bundle import BundleTree
+from .strip import strip_files
+from .metrics import get_peak_rss_windows
+
+# 基准测试使用本地生成的假embed python和wheel, 不需要网络, 可以在Linux上运行
+PY_VERSION = "3.9.2"
+# 比基线慢这么多秒以内的波动不算回退
+MIN_REGRESSION_SECONDS = 0.01
+
+
+def _gen_source(rnd, index, lines=80):
+    output = ['"""Synthetic module %d."""' % index, "import os", ""]
+    for i in range(lines // 4):
+        output.append("def func_%d(value, items=None):" % i)
+        output.append("    result = [item * %d for item in (items or range(value))]" % rnd.randint(1, 99))
+        output.append("    return os.path.join(str(value), str(sum(result)))  # %08x" % rnd.getrandbits(32))
+        output.append("")
+    return "\n".join(output) + "\n"
+
+
+def _gen_resource(rnd, size):
+    # 一半可压缩的文本, 一半随机数据(模拟图片等已压缩的资源)
+    if rnd.random() < 0.5:
+        words = [b"alpha", b"beta", b"gamma", b"delta", b"pkvenv", b"bundle", b"\n"]
+        data = b" ".join(rnd.choice(words) for _ in range(size // 5))
+        return data[:size]
+    return bytes(rnd.getrandbits(8) for _ in range(size))
+
+
+def make_embed_zip(output, rnd, modules=300):
+    """Write a fake embeddable python zip with the layout of the real one."""
+    py_tag = "".join(PY_VERSION.split(".")[:2])
+    stdlib = io.BytesIO()
+    with zipfile.ZipFile(stdlib, "w", zipfile.ZIP_DEFLATED) as zf:
+        for i in range(modules):
+            zf.writestr("lib%d/__init__.py" % i, _gen_source(rnd, i))
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("python.exe", bytes(rnd.getrandbits(8) for _ in range(100 * 1024)))
+        zf.writestr("pythonw.exe", bytes(rnd.getrandbits(8) for _ in range(100 * 1024)))
+        zf.writestr("python%s.dll" % py_tag, bytes(rnd.getrandbits(8) for _ in range(1024 * 1024)))
+        zf.writestr("python%s.zip" % py_tag, stdlib.getvalue())
+        zf.writestr("python%s._pth" % py_tag, "python%s.zip\r\n.\r\n\r\n# Uncomment to run site.main()\r\n#import site\r\n"
+                    % py_tag)
+        for name in ("_socket", "_ssl", "_sqlite3", "select", "unicodedata"):
+            zf.writestr("%s.pyd" % name, bytes(rnd.getrandbits(8) for _ in range(64 * 1024)))
+
+
+def make_wheel(output_dir, name, rnd, modules=20):
+    """Write a pure python wheel `<name>-1.0-py3-none-any.whl` and return its path."""
+    files = {}
+    for i in range(modules):
+        files["%s/mod%d.py" % (name, i)] = _gen_source(rnd, i).encode("utf-8")
+    files["%s/__init__.py" % name] = b"from .mod0 import func_0\n"
+    files["%s/tests/test_%s.py" % (name, name)] = b"def test():\n    pass\n"
+    dist_info = "%s-1.0.dist-info" % name
+    files[dist_info + "/METADATA"] = ("Metadata-Version: 2.1\nName: %s\nVersion: 1.0\n" % name).encode("utf-8")
+    files[dist_info + "/WHEEL"] = b"Wheel-Version: 1.0\nGenerator: pkvenv-bench\nRoot-Is-Purelib: true\nTag: py3-none-any\n"
+    record = []
+    for path, data in sorted(files.items()):
+        digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest()).rstrip(b"=").decode("ascii")
+        record.append("%s,sha256=%s,%d" % (path, digest, len(data)))
+    record.append("%s/RECORD,," % dist_info)
+    files[dist_info + "/RECORD"] = ("\n".join(record) + "\n").encode("utf-8")
+
+    wheel_file = os.path.join(output_dir, "%s-1.0-py3-none-any.whl" % name)
+    with zipfile.ZipFile(wheel_file, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path, data in sorted(files.items()):
+            zf.writestr(path, data)
+    return wheel_file
+
+
+def make_project(root, sources=200, resources=50, wheels=5, resource_size=64 * 1024, seed=0):
+    """Generate a synthetic project: app sources, resources, a wheel index and requirements.txt."""
+    rnd = random.Random(seed)
+    app_dir = os.path.join(root, "app")
+    for i in range(sources):
+        package_dir = os.path.join(app_dir, "pkg%d" % (i // 50))
+        os.makedirs(package_dir, exist_ok=True)
+        with open(os.path.join(package_dir, "mod%d.py" % i), "w") as f:
+            f.write(_gen_source(rnd, i))
+    resources_dir = os.path.join(root, "res")
+    os.makedirs(resources_dir, exist_ok=True)
+    for i in range(resources):
+        with open(os.path.join(resources_dir, "res%d.dat" % i), "wb") as f:
+            f.write(_gen_resource(rnd, resource_size))
+    with open(os.path.join(root, "main.py"), "w") as f:
+        f.write("def main():\n    print('hello')\n")
+
+    wheels_dir = os.path.join(root, "wheels")
+    os.makedirs(wheels_dir, exist_ok=True)
+    requirements = []
+    for i in range(wheels):
+        make_wheel(wheels_dir, "benchpkg%d" % i, rnd)
+        requirements.append("benchpkg%d==1.0" % i)
+    requirements_file = os.path.join(root, "requirements.txt")
+    with open(requirements_file, "w", newline="\n") as f:
+        f.write("\n".join(requirements) + "\n")
+
+    embed_zip = os.path.join(root, pkvenv_main.get_embed_python_url(PY_VERSION)[0])
+    make_embed_zip(embed_zip, rnd)
+    return {
+        "include": [os.path.join(root, "main.py"), app_dir, resources_dir],
+        "requirements_file": requirements_file,
+        "wheels_dir": wheels_dir,
+        "embed_zip": embed_zip,
+    }
+
+
+class Timer(object):
+
+    def __init__(self, verbose=False):
+        self.results = {}
+        self.verbose = verbose
+
+    def run(self, name, func, *args, **kwargs):
+        start = time.perf_counter()
+        if self.verbose:
+            result = func(*args, **kwargs)
+        else:
+            with redirect_stdout(io.StringIO()):
+                result = func(*args, **kwargs)
+        self.results[name] = time.perf_counter() - start
+        return result
+
+
+def run_build(project, cache_dir, build_dir, verbose=False):
+    """Run the build functions of pkvenv.main once and return {function: seconds}."""
+    os.environ["PKVENV_CACHE_DIR"] = cache_dir
+    os.makedirs(build_dir, exist_ok=True)
+    cached_embed_zip = os.path.join(pkvenv_main.get_cache_dir(), os.path.basename(project["embed_zip"]))
+    if not os.path.exists(cached_embed_zip):
+        shutil.copy(project["embed_zip"], cached_embed_zip)  # 代替下载
+    entry_points = [{"name": "bench", "entry_point": "main:main", "gui": False}]
+    pip_args = ["--no-index", "--find-links", project["wheels_dir"]]
+
+    timer = Timer(verbose)
+    python_zip_file = timer.run("fetch_embeddable_python", pkvenv_main.fetch_embeddable_python, PY_VERSION)
+    runtime_layer = timer.run("get_runtime_layer", pkvenv_main.get_runtime_layer, python_zip_file,
+                              project["requirements_file"], build_dir, None, None, True, pip_args)
+    tree = BundleTree()
+    timer.run("BundleTree.add_tree", tree.add_tree, pkvenv_main.PYTHON_ARCNAME,
+              os.path.join(runtime_layer, pkvenv_main.PYTHON_ARCNAME))
+    pth_filename, pth_content = timer.run("gen_pth_file", pkvenv_main.gen_pth_file, python_zip_file)
+    tree.add_bytes(pkvenv_main.PYTHON_ARCNAME + "/" + pth_filename, pth_content)
+    timer.run("copy_files", pkvenv_main.copy_files, project["include"], tree, entry_points)
+    timer.run("gen_launch_file", pkvenv_main.gen_launch_file, tree, entry_points)
+    timer.run("strip_files", strip_files, tree, pkvenv_main.PYTHON_ARCNAME, pkvenv_main.SITE_PACKAGES_ARCNAME,
+              "safe", False)
+    timer.run("zip_files", pkvenv_main.zip_files, tree, os.path.join(build_dir, "bench.zip"), None, None, True)
+    timer.run("BundleTree.materialize", tree.materialize, os.path.join(build_dir, "pkvenv"))
+    timer.results["total"] = sum(timer.results.values())
+    return timer.results
+
+
+def run_benchmarks(work_dir, sources, resources, wheels, resource_size, repeat, verbose=False):
+    """Time a cold build (empty cache and build dir) and a warm rebuild, ``repeat`` times each."""
+    project = make_project(os.path.join(work_dir, "project"), sources, resources, wheels, resource_size)
+    runs = {"cold": [], "warm": []}
+    old_cache_dir = os.environ.get("PKVENV_CACHE_DIR")
+    try:
+        for i in range(repeat):
+            cache_dir = os.path.join(work_dir, "cache%d" % i)
+            build_dir = os.path.join(work_dir, "build%d" % i)
+            os.makedirs(cache_dir)
+            runs["cold"].append(run_build(project, cache_dir, build_dir, verbose))
+            runs["warm"].append(run_build(project, cache_dir, build_dir, verbose))
+    finally:
+        if old_cache_dir is None:
+            os.environ.pop("PKVENV_CACHE_DIR", None)
+        else:
+            os.environ["PKVENV_CACHE_DIR"] = old_cache_dir
+
+    results = {}
+    for phase, items in runs.items():
+        for name in items[0]:
+            results.setdefault(name, {})[phase] = round(statistics.median(item[name] for item in items), 4)
+    return {
+        "params": {"sources": sources, "resources": resources, "wheels": wheels, "resource_size": resource_size,
+                   "repeat": repeat},
+        "results": results,
+    }
+
+
+def print_results(data, baseline=None):
+    print("%-26s %10s %10s" % ("function", "cold(s)", "warm(s)") + ("  %10s %10s" % ("base cold", "base warm")
+                                                                   if baseline else ""))
+    for name, values in data["results"].items():
+        line = "%-26s %10.4f %10.4f" % (name, values["cold"], values["warm"])
+        if baseline and name in baseline["results"]:
+            line += "  %10.4f %10.4f" % (baseline["results"][name]["cold"], baseline["results"][name]["warm"])
+        print(line)
+
+
+def compare_results(data, baseline, tolerance):
+    """Return the list of (function, phase, seconds, baseline seconds) slower than the baseline."""
+    regressions = []
+    for name, values in data["results"].items():
+        if name not in baseline["results"]:
+            continue
+        for phase, seconds in values.items():
+            base = baseline["results"][name].get(phase)
+            if base is not None and seconds is not None and seconds > base * (1 + tolerance) and seconds - base > MIN_REGRESSION_SECONDS:
+                regressions.append((name, phase, seconds, base))
+    return regressions
+
+
+def bench_main(argv):
+    argparser = argparse.ArgumentParser(prog="pkvenv bench")
+    argparser.add_argument("--sources", type=int, default=200, help="number of python files of the project")
+    argparser.add_argument("--resources", type=int, default=50, help="number of resource files of the project")
+    argparser.add_argument("--resource-size", type=int, default=64 * 1024, help="size of each resource file")
+    argparser.add_argument("--wheels", type=int, default=5, help="number of dependency wheels")
+    argparser.add_argument("-r", "--repeat", type=int, default=3, help="number of runs, the median is reported")
+    argparser.add_argument("-o", "--output", help="save the results to this json file, eg: as a new baseline")
+    argparser.add_argument("--baseline", help="compare with the results of a previous run and fail on regressions")
+    argparser.add_argument("--tolerance", type=float, default=0.2,
+                           help="allowed slowdown against the baseline, default is 0.2 (20%%)")
+    argparser.add_argument("--work-dir", help="keep the generated project and builds in this directory")
+    argparser.add_argument("-v", "--verbose", action="store_true", help="show the output of the build functions")
+    arguments = argparser.parse_args(argv)
+
+    baseline = None
+    if arguments.baseline:
+        with open(arguments.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline.get("params") != {"sources": arguments.sources, "resources": arguments.resources,
+                                      "wheels": arguments.wheels, "resource_size": arguments.resource_size,
+                                      "repeat": arguments.repeat}:
+            print("[Warning] baseline was recorded with different parameters: %s" % baseline.get("params"))
+
+    work_dir = arguments.work_dir or tempfile.mkdtemp(prefix="pkvenv-bench-")
+    if os.path.exists(work_dir) and os.listdir(work_dir):
+        print("Error: work dir %s is not empty!" % work_dir)
+        exit(-1)
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        data = run_benchmarks(work_dir, arguments.sources, arguments.resources, arguments.wheels,
+                              arguments.resource_size, arguments.repeat, arguments.verbose)
+    finally:
+        if not arguments.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    data["python"] = sys.version.split()[0]
+    data["platform"] = sys.platform
+
+    print_results(data, baseline)
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump(data, f, indent=1)
+        print("Results saved to", arguments.output)
+    if baseline:
+        regressions = compare_results(data, baseline, arguments.tolerance)
+        for name, phase, seconds, base in regressions:
+            print("Regression: %s (%s) %.4fs -> %.4fs (+%.0f%%)" % (name, phase, base, seconds,
+                                                                    (seconds / base - 1) * 100 if base else 100))
+        if regressions:
+            exit(-1)
+        print("No regressions against", arguments.baseline)
+
+
+def drop_page_cache(bundle_dir):
+    """Evict the files of the bundle from the page cache, return False if not supported."""
+    if sys.platform.startswith("linux") and os.geteuid() == 0:
+        os.sync()
+        try:
+            with open("/proc/sys/vm/drop_caches", "w") as f:
+                f.write("3\n")
+            return True
+        except OSError:
+            pass  # 容器中root通常也不能写 /proc/sys, 使用下面的fadvise
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    # 没有root权限时逐个文件丢弃缓存, 只影响打包内的文件(脏页需要先写回)
+    os.sync()
+    for root, _, files in os.walk(bundle_dir):
+        for name in files:
+            fd = os.open(os.path.join(root, name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    return True
+
+
+def launch_once(python_path, entry_point, args, probe_file):
+    """Launch the bundle once, return (seconds to the entry function, peak RSS in bytes)."""
+    env = dict(os.environ, PKVENV_STARTUP_PROBE=probe_file)
+    env.pop("PYTHONPATH", None)
+    env.pop("PYTHONHOME", None)
+    if entry_point:
+        env["PKVENV_ENTRY_POINT"] = entry_point
+    if os.path.exists(probe_file):
+        os.remove(probe_file)
+    start = time.time()
+    proc = subprocess.Popen([python_path, "-m", "pkvenv_main"] + list(args), env=env,
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if hasattr(os, "wait4"):
+        stderr = proc.stderr.read()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+        scale = 1 if sys.platform == "darwin" else 1024
+        rss = rusage.ru_maxrss * scale
+    else:
+        stderr = proc.communicate()[1]
+        rss = get_peak_rss_windows(int(proc._handle))
+    if not os.path.exists(probe_file):
+        raise ValueError("bundle exited with %d before reaching the entry function:\n%s"
+                         % (proc.returncode, stderr.decode("utf-8", "replace")))
+    with open(probe_file, "r") as f:
+        entered = float(f.read())
+    return entered - start, rss
+
+
+def percentile(values, percent):
+    # nearest-rank
+    values = sorted(values)
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+
+def run_startup_benchmarks(bundle_dir, entry_point, args, runs, cold_runs):
+    python_path = pkvenv_main.find_bundle_python(bundle_dir)
+    probe_file = os.path.join(tempfile.gettempdir(), "pkvenv-startup-%d" % os.getpid())
+    samples = {"cold": [], "warm": []}
+    try:
+        for _ in range(cold_runs):
+            if not drop_page_cache(bundle_dir):
+                print("[Warning] dropping the page cache is not supported here, skip cold runs")
+                break
+            samples["cold"].append(launch_once(python_path, entry_point, args, probe_file))
+        launch_once(python_path, entry_point, args, probe_file)  # 预热
+        for _ in range(runs):
+            samples["warm"].append(launch_once(python_path, entry_point, args, probe_file))
+    finally:
+        if os.path.exists(probe_file):
+            os.remove(probe_file)
+
+    results = {}
+    for phase, items in samples.items():
+        for name, index, scale in (("time_to_entry", 0, 1), ("rss_mb", 1, 1.0 / (1 << 20))):
+            values = [item[index] * scale for item in items if item[index] is not None]
+            for percent in (50, 95):
+                results.setdefault("%s_p%d" % (name, percent), {})[phase] = \
+                    round(percentile(values, percent), 4) if values else None
+    return {
+        "params": {"entry_point": entry_point, "runs": runs, "cold_runs": cold_runs},
+        "results": results,
+    }
+
+
+def bench_startup_main(argv):
+    args = []
+    if "--" in argv:
+        args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    argparser = argparse.ArgumentParser(prog="pkvenv bench-startup", usage="%(prog)s [options] bundle [-- args...]",
+                                        epilog="arguments after `--` are passed to the entry point")
+    argparser.add_argument("bundle", help="bundle zip or extracted bundle dir")
+    argparser.add_argument("-e", "--entry", help="name of the entry point, default is the first one")
+    argparser.add_argument("-n", "--runs", type=int, default=20, help="number of warm runs")
+    argparser.add_argument("--cold-runs", type=int, default=5,
+                           help="number of runs after dropping the page cache (where permitted)")
+    argparser.add_argument("-o", "--output", help="save the results to this json file, eg: as a new baseline")
+    argparser.add_argument("--baseline", help="compare with the results of a previous run and fail on regressions")
+    argparser.add_argument("--tolerance", type=float, default=0.2,
+                           help="allowed slowdown against the baseline, default is 0.2 (20%%)")
+    arguments = argparser.parse_args(argv)
+
+    baseline = None
+    if arguments.baseline:
+        with open(arguments.baseline, "r") as f:
+            baseline = json.load(f)
+
+    bundle_dir = os.path.abspath(arguments.bundle)
+    tmp_dir = None
+    if os.path.isfile(bundle_dir):
+        tmp_dir = tempfile.mkdtemp(prefix="pkvenv-startup-")
+        with zipfile.ZipFile(bundle_dir) as zf:
+            for info in zf.infolist():
+                output = zf.extract(info, tmp_dir)
+                mode = (info.external_attr >> 16) & 0o777
+                if mode and not info.is_dir():
+                    os.chmod(output, mode)
+        bundle_dir = tmp_dir
+    try:
+        data = run_startup_benchmarks(bundle_dir, arguments.entry, args, arguments.runs, arguments.cold_runs)
+    except (ValueError, OSError) as e:
+        print("Error: %s" % e)
+        exit(-1)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    data["platform"] = sys.platform
+
+    print("%-20s %10s %10s" % ("metric", "cold", "warm"))
+    for name, values in data["results"].items():
+        print("%-20s %10s %10s" % (name, *("-" if values[phase] is None else "%.4f" % values[phase]
+                                           for phase in ("cold", "warm"))))
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump(data, f, indent=1)
+        print("Results saved to", arguments.output)
+    if baseline:
+        regressions = compare_results(data, baseline, arguments.tolerance)
+        for name, phase, value, base in regressions:
+            print("Regression: %s (%s) %.4f -> %.4f" % (name, phase, base, value))
+        if regressions:
+            exit(-1)
+        print("No regressions against", arguments.baseline)
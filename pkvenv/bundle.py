@@ -0,0 +1,107 @@
+import os
+import time
+import shutil
+import posixpath
+
+
+class BundleEntry(object):
+    """Content of one file of the bundle: a source file on disk or in-memory bytes."""
+
+    def __init__(self, path=None, data=None, mode=None):
+        self.path = path
+        self.data = data
+        self.mode = mode
+        self.mtime = time.time() if data is not None else None
+
+    @property
+    def size(self):
+        return len(self.data) if self.data is not None else os.path.getsize(self.path)
+
+    def read(self):
+        if self.data is not None:
+            return self.data
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+class BundleTree(object):
+    """Virtual layout of the bundle: a mapping from archive paths to their content.
+
+    Files are only referenced here (app files, cached runtime layers, generated
+    content) and are streamed straight into the output archive; ``materialize``
+    writes a real staging directory when one is needed.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.dirs = set()  # 空目录
+
+    def add_file(self, arcname, path, mode=None):
+        self.entries[arcname] = BundleEntry(path=path, mode=mode)
+
+    def add_bytes(self, arcname, data, mode=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.entries[arcname] = BundleEntry(data=data, mode=mode)
+
+    def add_tree(self, arcname, root, skip=()):
+        for dirpath, dirnames, filenames in os.walk(root):
+            rel_path = os.path.relpath(dirpath, root).replace(os.sep, "/")
+            prefix = arcname if rel_path == "." else posixpath.join(arcname, rel_path)
+            if not dirnames and not filenames:
+                self.dirs.add(prefix)
+            for name in filenames:
+                if name not in skip:
+                    self.add_file(posixpath.join(prefix, name), os.path.join(dirpath, name))
+
+    def update(self, other):
+        """Add all files and empty dirs of another tree, replacing existing files."""
+        self.entries.update(other.entries)
+        self.dirs.update(other.dirs)
+
+    def remove(self, arcname):
+        """Remove a file, or everything under a directory."""
+        self.entries.pop(arcname, None)
+        prefix = arcname.rstrip("/") + "/"
+        for name in [name for name in self.entries if name.startswith(prefix)]:
+            del self.entries[name]
+        self.dirs = set(name for name in self.dirs if name != arcname and not name.startswith(prefix))
+
+    def __contains__(self, arcname):
+        return arcname in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def read(self, arcname):
+        return self.entries[arcname].read()
+
+    def iter_files(self, prefix=""):
+        for arcname in sorted(self.entries):
+            if arcname.startswith(prefix):
+                yield arcname, self.entries[arcname]
+
+    def iter_dirs(self):
+        """All directories of the bundle, including the parents of every file."""
+        dirs = set()
+        for arcname in list(self.entries) + list(self.dirs):
+            parent = arcname if arcname in self.dirs else posixpath.dirname(arcname)
+            while parent and parent not in dirs:
+                dirs.add(parent)
+                parent = posixpath.dirname(parent)
+        return sorted(dirs)
+
+    def materialize(self, stage_dir):
+        if os.path.exists(stage_dir):
+            shutil.rmtree(stage_dir, ignore_errors=True)
+        for arcname in self.iter_dirs():
+            os.makedirs(os.path.join(stage_dir, arcname), exist_ok=True)
+        for arcname, entry in self.iter_files():
+            output = os.path.join(stage_dir, arcname)
+            if entry.data is not None:
+                with open(output, "wb") as f:
+                    f.write(entry.data)
+            else:
+                shutil.copy2(entry.path, output)
+            if entry.mode is not None:
+                os.chmod(output, entry.mode)
@@ -0,0 +1,87 @@
+import os
+import shutil
+import argparse
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from .remote_cache import check_key
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    """GET/HEAD/PUT of the files under ``server.root``."""
+
+    def _get_path(self):
+        try:
+            return os.path.join(self.server.root, *check_key(self.path.split("?")[0].lstrip("/")))
+        except ValueError:
+            self.send_error(400)
+            return None
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        path = self._get_path()
+        if path is None:
+            return
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as f:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            if body:
+                shutil.copyfileobj(f, self.wfile, 1 << 16)
+
+    def do_PUT(self):
+        path = self._get_path()
+        if path is None:
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "%s.tmp-%d" % (path, threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            while length > 0:
+                chunk = self.rfile.read(min(length, 1 << 16))
+                if not chunk:
+                    break
+                f.write(chunk)
+                length -= len(chunk)
+        if length > 0:
+            os.remove(tmp_path)
+            self.send_error(400, "incomplete body")
+            return
+        os.replace(tmp_path, path)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class CacheServer(ThreadingMixIn, HTTPServer):
+    """A minimal remote cache store for tests and small fleets, not hardened for untrusted networks."""
+    daemon_threads = True
+
+    def __init__(self, address, root):
+        HTTPServer.__init__(self, address, CacheRequestHandler)
+        self.root = os.path.abspath(root)
+
+
+def cache_server_main(argv):
+    argparser = argparse.ArgumentParser(prog="pkvenv cache-server")
+    argparser.add_argument("root", help="directory storing the cached artifacts")
+    argparser.add_argument("--host", default="127.0.0.1", help="listen address, default is 127.0.0.1")
+    argparser.add_argument("--port", type=int, default=8800, help="listen port, default is 8800")
+    arguments = argparser.parse_args(argv)
+
+    os.makedirs(arguments.root, exist_ok=True)
+    server = CacheServer((arguments.host, arguments.port), arguments.root)
+    print("pkvenv cache server on http://%s:%d/ serving %s" % (arguments.host, server.server_address[1],
+                                                               server.root))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,240 @@
+import io
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import argparse
+import importlib
+import threading
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from . import __version__
+from .main import get_cache_dir, get_session
+
+# 转发协议: 客户端发送一行JSON请求 {"version", "argv", "cwd", "env"},
+# daemon返回多行JSON: {"out": text}, {"err": text}, 最后是 {"exit": code} 或 {"error": message}
+SOCKET_ENV = "PKVENV_DAEMON_SOCKET"
+NO_DAEMON_ENV = "PKVENV_NO_DAEMON"
+
+
+def get_socket_path():
+    return os.environ.get(SOCKET_ENV) or os.path.join(get_cache_dir(), "daemon.sock")
+
+
+def _send(sock, message):
+    sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def forward_to_daemon(argv):
+    """Run the build ``pkvenv <argv>`` in the daemon if one is listening.
+
+    Return the exit code, or None when the build has to run in this process.
+    """
+    if os.environ.get(NO_DAEMON_ENV) or not hasattr(socket, "AF_UNIX"):
+        return None
+    path = get_socket_path()
+    sock = _connect(path) if os.path.exists(path) else None
+    if sock is None:
+        return None
+    with sock, sock.makefile("rb") as f:
+        _send(sock, {"version": __version__, "argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)})
+        for line in f:
+            message = json.loads(line.decode("utf-8"))
+            if "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "err" in message:
+                sys.stderr.write(message["err"])
+                sys.stderr.flush()
+            elif "exit" in message:
+                return message["exit"]
+            elif "error" in message:
+                print("[Warning] %s, build without the daemon" % message["error"])
+                return None
+    print("Error: the pkvenv daemon closed the connection")
+    return -1
+
+
+def _is_same_user(conn):
+    # linux: 检查连接的客户端的uid; 其他平台只依靠socket文件的权限
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    _, uid, _ = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return uid == os.getuid()
+
+
+class _StreamWriter(io.TextIOBase):
+    """stdout/stderr of a forwarded build, sent to the client line by line."""
+
+    def __init__(self, sock, key, lock):
+        self.sock = sock
+        self.key = key
+        self.lock = lock
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if text:
+            with self.lock:
+                try:
+                    _send(self.sock, {self.key: text})
+                except OSError:
+                    pass  # 客户端断开后继续完成构建, 缓存仍然有效
+        return len(text)
+
+
+class Daemon(object):
+    """Serve forwarded builds from one warm process.
+
+    Everything cached in memory survives between builds: imported modules, the
+    pooled HTTP session, `pip freeze` results and file hashes of incremental zips.
+    Builds run one at a time, with the working directory and environment of the client.
+    """
+
+    def __init__(self, path, idle_timeout=None):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.running = 0
+        self.builds = 0
+        self.last_active = time.time()
+        self.stopped = False
+        self._build_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def run_build(self, argv, cwd, env, stdout, stderr):
+        from .main import build_main
+        with self._build_lock:
+            old_cwd, old_env = os.getcwd(), dict(os.environ)
+            try:
+                os.chdir(cwd)
+                os.environ.clear()
+                os.environ.update(env)
+                with redirect_stdout(stdout), redirect_stderr(stderr):
+                    build_main(argv)
+                return 0
+            except SystemExit as e:
+                return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except Exception:
+                traceback.print_exc(file=stderr)
+                return 1
+            finally:
+                os.chdir(old_cwd)
+                os.environ.clear()
+                os.environ.update(old_env)
+
+    def handle(self, conn):
+        with conn, conn.makefile("rb") as f:
+            try:
+                request = json.loads(f.readline().decode("utf-8"))
+            except ValueError:
+                return
+            if request.get("command") == "stop":
+                self.stopped = True
+                _send(conn, {"exit": 0})
+                return
+            if request.get("version") != __version__:
+                _send(conn, {"error": "the daemon runs pkvenv %s" % __version__})
+                return
+            with self._lock:
+                self.running += 1
+            start = time.time()
+            lock = threading.Lock()
+            try:
+                returncode = self.run_build(request["argv"], request["cwd"], request["env"],
+                                            _StreamWriter(conn, "out", lock), _StreamWriter(conn, "err", lock))
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.builds += 1
+                    self.last_active = time.time()
+            # 其他构建可能正在重定向sys.stdout, daemon自己的日志直接写到原来的stdout
+            print("[%s] pkvenv %s -> %d (%.2fs)" % (time.strftime("%H:%M:%S"), " ".join(request["argv"]), returncode,
+                                                    time.time() - start), file=sys.__stdout__, flush=True)
+            try:
+                _send(conn, {"exit": returncode})
+            except OSError:
+                pass
+
+    def serve(self):
+        if os.path.exists(self.path):
+            sock = _connect(self.path)
+            if sock is not None:
+                sock.close()
+                raise ValueError("a daemon is already listening on %s" % self.path)
+            os.remove(self.path)  # 上一个daemon异常退出留下的socket文件
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # 请求中包含客户端的环境变量, 只允许当前用户连接. 在umask 077下创建socket文件,
+        # bind和chmod之间其他用户也无法连接
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        server.listen(16)
+        server.settimeout(1)
+        # 预先导入构建用到的模块并建立连接池
+        importlib.import_module(".api", __package__)
+        get_session()
+        print("pkvenv daemon %s listening on %s (pid %d)" % (__version__, self.path, os.getpid()))
+        try:
+            while not self.stopped:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    if self.idle_timeout and not self.running and time.time() - self.last_active > self.idle_timeout:
+                        print("Idle for %ds, exit" % self.idle_timeout)
+                        break
+                    continue
+                conn.settimeout(None)
+                if not _is_same_user(conn):
+                    conn.close()
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            server.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        print("pkvenv daemon stopped after %d builds" % self.builds)
+
+
+def daemon_main(argv):
+    argparser = argparse.ArgumentParser(prog="pkvenv daemon")
+    argparser.add_argument("--socket", help="unix socket path, default is $%s or daemon.sock in the cache dir" % SOCKET_ENV)
+    argparser.add_argument("--idle-timeout", type=int, default=0, help="exit after this many idle seconds, 0 is never")
+    argparser.add_argument("--stop", action="store_true", help="stop the running daemon")
+    arguments = argparser.parse_args(argv)
+
+    if not hasattr(socket, "AF_UNIX"):
+        print("Error: unix sockets are not supported on this platform!")
+        exit(-1)
+    path = os.path.abspath(arguments.socket or get_socket_path())
+    if arguments.stop:
+        sock = _connect(path) if os.path.exists(path) else None
+        if sock is None:
+            print("Error: no daemon is listening on %s" % path)
+            exit(-1)
+        with sock, sock.makefile("rb") as f:
+            _send(sock, {"command": "stop"})
+            f.readline()
+        print("Daemon stopped")
+        return
+    try:
+        Daemon(path, arguments.idle_timeout).serve()
+    except ValueError as e:
+        print("Error: %s" % e)
+        exit(-1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,170 @@
+import os
+import json
+import struct
+import hashlib
+import zipfile
+from .delta_apply import MANIFEST_NAME, DIFF_MAGIC, OP_COPY, OP_INSERT
+
+ROOT_DIR = os.path.abspath(os.path.dirname(__file__))
+
+BLOCK_SIZE = 64
+# 匹配结束后的 LOCAL_SCAN_SIZE 字节内逐字节查找下一个匹配(修改通常是局部的), 之后只在锚点查找:
+# 以出现频率约为 1/ANCHOR_INTERVAL 的字节作为锚点, 锚点由内容决定, 插入或删除内容不影响其他锚点,
+# 不相关的数据不需要逐字节滑动
+LOCAL_SCAN_SIZE = 4096
+ANCHOR_INTERVAL = 256
+# 超过这个大小的文件直接整体替换, 不计算差异
+MAX_DIFF_SIZE = 16 << 20
+
+
+def _match_length(old, old_pos, new, new_pos):
+    length = 0
+    step = 4096
+    while step:
+        while new_pos + length + step <= len(new) and old_pos + length + step <= len(old) \
+                and new[new_pos + length:new_pos + length + step] == old[old_pos + length:old_pos + length + step]:
+            length += step
+        step //= 8
+    return length
+
+
+def _match_length_back(old, old_pos, new, new_pos, limit):
+    # old_pos/new_pos 之前相同的字节数, 最多 limit
+    length = 0
+    step = 4096
+    while step:
+        while length + step <= min(limit, old_pos) \
+                and new[new_pos - length - step:new_pos - length] == old[old_pos - length - step:old_pos - length]:
+            length += step
+        step //= 8
+    return length
+
+
+def _choose_anchor(data):
+    # 出现频率最接近 1/ANCHOR_INTERVAL 的字节, 太频繁的字节(例如连续的0)只在没有其他字节时使用
+    sample = data[:1 << 16]
+    best = None
+    for value in range(256):
+        count = sample.count(bytes((value,)))
+        if count:
+            interval = len(sample) / count
+            score = (interval < BLOCK_SIZE, max(interval, ANCHOR_INTERVAL) / min(interval, ANCHOR_INTERVAL))
+            if best is None or score < best[0]:
+                best = (score, value)
+    return bytes((best[1] if best else 0,))
+
+
+def _iter_anchors(data, anchor, start=0):
+    pos = data.find(anchor, start)
+    while 0 <= pos <= len(data) - BLOCK_SIZE:
+        yield pos
+        pos = data.find(anchor, pos + 1)
+
+
+def make_diff(old, new, block_size=BLOCK_SIZE):
+    """Return a binary diff turning ``old`` into ``new``: copy ops for blocks found in
+    ``old`` and insert ops for everything else (see ``pkvenv.delta_apply.apply_diff``)."""
+    index = {}
+    for offset in range(0, len(old) - block_size + 1, block_size):
+        index.setdefault(old[offset:offset + block_size], offset)
+    anchor = _choose_anchor(new)
+    anchor_index = {}
+    for offset in _iter_anchors(old, anchor):
+        anchor_index.setdefault(old[offset:offset + block_size], offset)
+
+    ops = [DIFF_MAGIC]
+    literal_start = pos = 0
+    end = len(new) - block_size
+    while pos <= end:
+        block = new[pos:pos + block_size]
+        offset = index.get(block)
+        if offset is None:
+            offset = anchor_index.get(block)
+        if offset is None:
+            if pos - literal_start < LOCAL_SCAN_SIZE:
+                pos += 1
+            else:
+                pos = new.find(anchor, pos + 1)
+                if pos < 0:
+                    break
+            continue
+        # 向前扩展匹配, 吃掉尚未输出的字面量
+        back = _match_length_back(old, offset, new, pos, pos - literal_start)
+        if pos - back > literal_start:
+            literal = new[literal_start:pos - back]
+            ops.append(OP_INSERT + struct.pack("<Q", len(literal)) + literal)
+        length = back + _match_length(old, offset, new, pos)
+        ops.append(OP_COPY + struct.pack("<QQ", offset - back, length))
+        pos = literal_start = pos - back + length
+    if literal_start < len(new):
+        literal = new[literal_start:]
+        ops.append(OP_INSERT + struct.pack("<Q", len(literal)) + literal)
+    return b"".join(ops)
+
+
+def _read_zip_files(zip_file):
+    """Return {path: (sha256, mode)} of the files of a bundle zip, and its directories."""
+    files = {}
+    dirs = []
+    with zipfile.ZipFile(zip_file) as zf:
+        for info in zf.infolist():
+            if info.filename.endswith("/"):
+                dirs.append(info.filename.rstrip("/"))
+                continue
+            h = hashlib.sha256()
+            with zf.open(info) as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+            files[info.filename] = (h.hexdigest(), (info.external_attr >> 16) & 0o777)
+    return files, dirs
+
+
+def make_delta(old_zip, new_zip, output):
+    """Create an update package turning a bundle installed from ``old_zip`` into ``new_zip``.
+
+    The package is a zip runnable with the bundled interpreter
+    (``Python\\python.exe update.zip <bundle_dir>``).
+    """
+    old_files, _ = _read_zip_files(old_zip)
+    new_files, new_dirs = _read_zip_files(new_zip)
+    old_by_hash = {}
+    for path, (sha256, _) in sorted(old_files.items()):
+        old_by_hash.setdefault(sha256, path)
+
+    manifest = {
+        "version": 1,
+        "old_name": os.path.basename(old_zip),
+        "new_name": os.path.basename(new_zip),
+        "old_files": dict((path, sha256) for path, (sha256, _) in old_files.items()),
+        "dirs": new_dirs,
+        "files": [],
+    }
+    stats = {"copy": 0, "diff": 0, "full": 0}
+    with zipfile.ZipFile(old_zip) as old_zf, zipfile.ZipFile(new_zip) as new_zf, \
+            zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as out:
+        with open(os.path.join(ROOT_DIR, "delta_apply.py"), "rb") as f:
+            out.writestr("__main__.py", f.read())
+        for index, (path, (sha256, mode)) in enumerate(sorted(new_files.items())):
+            item = {"path": path, "sha256": sha256, "mode": mode}
+            if sha256 in old_by_hash:
+                # 未变化的文件只记录hash, 从已安装的版本中拷贝
+                item.update(op="copy", source=old_by_hash[sha256])
+            else:
+                data = new_zf.read(path)
+                item.update(op="full", data="data/%d" % index)
+                if path in old_files and len(data) <= MAX_DIFF_SIZE \
+                        and new_zf.getinfo(path).file_size <= MAX_DIFF_SIZE:
+                    old_data = old_zf.read(path)
+                    if len(old_data) <= MAX_DIFF_SIZE:
+                        diff = make_diff(old_data, data)
+                        if len(diff) < len(data) * 0.9:
+                            item.update(op="diff", source=path)
+                            data = diff
+                out.writestr(item["data"], data)
+            stats[item["op"]] += 1
+            manifest["files"].append(item)
+        out.writestr(MANIFEST_NAME, json.dumps(manifest, indent=1))
+    print("Delta: %d unchanged, %d diffs, %d full files, %d removed -> %s (%d bytes)"
+          % (stats["copy"], stats["diff"], stats["full"], len(set(old_files) - set(new_files)), output,
+             os.path.getsize(output)))
+    return stats
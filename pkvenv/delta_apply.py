@@ -0,0 +1,218 @@
+# coding: utf-8
+# 增量更新包的应用脚本, 由 `pkvenv delta` 作为 __main__.py 打入更新包, 只依赖标准库,
+# 可以直接使用打包内的python运行:
+#
+#   Python\python.exe update.zip <bundle_dir>
+import os
+import sys
+import json
+import stat
+import shutil
+import struct
+import hashlib
+import zipfile
+
+MANIFEST_NAME = "pkvenv_delta.json"
+JOURNAL_NAME = "journal"
+DIFF_MAGIC = b"PKVDIFF1"
+OP_COPY = b"C"
+OP_INSERT = b"I"
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def apply_diff(base, diff):
+    """Rebuild a file from its base content and a diff made by ``pkvenv.delta.make_diff``."""
+    if diff[:len(DIFF_MAGIC)] != DIFF_MAGIC:
+        raise ValueError("invalid diff data")
+    pos = len(DIFF_MAGIC)
+    output = []
+    while pos < len(diff):
+        op = diff[pos:pos + 1]
+        if op == OP_COPY:
+            offset, length = struct.unpack_from("<QQ", diff, pos + 1)
+            output.append(base[offset:offset + length])
+            pos += 17
+        elif op == OP_INSERT:
+            length, = struct.unpack_from("<Q", diff, pos + 1)
+            output.append(diff[pos + 9:pos + 9 + length])
+            pos += 9 + length
+        else:
+            raise ValueError("invalid diff op %r" % op)
+    return b"".join(output)
+
+
+def _link_or_copy(src, dst, link=True):
+    """Hard link ``src`` if ``link``, else (or if it can not be linked) copy it; return True if linked."""
+    if link:
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return False
+
+
+def _write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _join(root, path):
+    return os.path.join(root, *path.split("/"))
+
+
+def rollback(bundle_dir, backup_dir):
+    """Undo the steps recorded in the journal of an update that failed or was interrupted."""
+    with open(os.path.join(backup_dir, JOURNAL_NAME)) as f:
+        # 中断时最后一行可能不完整, 对应的步骤没有执行
+        steps = [json.loads(line) for line in f if line.endswith("\n")]
+    for op, path in reversed(steps):
+        file = _join(bundle_dir, path)
+        if op == "added":
+            if os.path.lexists(file):
+                os.remove(file)
+        else:
+            backup = _join(os.path.join(backup_dir, "files"), path)
+            if os.path.lexists(backup):
+                os.makedirs(os.path.dirname(file), exist_ok=True)
+                os.replace(backup, file)
+    os.remove(os.path.join(backup_dir, JOURNAL_NAME))
+    shutil.rmtree(backup_dir, ignore_errors=True)
+
+
+def swap_files(bundle_dir, stage_dir, backup_dir, changed, removed):
+    """Move ``changed`` files from ``stage_dir`` into the bundle and ``removed`` files out of it.
+
+    Files are replaced one by one instead of renaming the bundle directory, which windows refuses
+    while the bundled python (running this script) is inside it. Every step is written to a journal
+    first; on failure the replaced files are restored from ``backup_dir``.
+    """
+    os.makedirs(os.path.join(backup_dir, "files"), exist_ok=True)
+    journal = open(os.path.join(backup_dir, JOURNAL_NAME), "w")
+
+    def log(op, path):
+        journal.write(json.dumps([op, path]) + "\n")
+        journal.flush()
+
+    try:
+        # 正在运行的exe和已加载的dll不能覆盖, 但可以重命名
+        for path in sorted(set(changed) | set(removed)):
+            file = _join(bundle_dir, path)
+            if os.path.lexists(file):
+                log("moved", path)
+                backup = _join(os.path.join(backup_dir, "files"), path)
+                os.makedirs(os.path.dirname(backup), exist_ok=True)
+                os.replace(file, backup)
+        for path in sorted(changed):
+            file = _join(bundle_dir, path)
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            log("added", path)
+            os.replace(_join(stage_dir, path), file)
+    except BaseException:
+        journal.close()
+        rollback(bundle_dir, backup_dir)
+        raise
+    journal.close()
+    os.remove(os.path.join(backup_dir, JOURNAL_NAME))
+    # 旧的python.exe可能仍在运行, 删除失败时留给下一次更新
+    shutil.rmtree(backup_dir, ignore_errors=True)
+
+
+def apply_delta(patch_file, bundle_dir, dry_run=False):
+    bundle_dir = os.path.abspath(bundle_dir)
+    stage_dir = bundle_dir + ".pkvenv-update"
+    backup_dir = bundle_dir + ".pkvenv-old"
+    if not dry_run and os.path.isfile(os.path.join(backup_dir, JOURNAL_NAME)):
+        print("Rolling back the interrupted update of %s" % bundle_dir)
+        rollback(bundle_dir, backup_dir)
+    with zipfile.ZipFile(patch_file) as zf:
+        manifest = json.loads(zf.read(MANIFEST_NAME).decode("utf-8"))
+        old_files = manifest["old_files"]
+
+        # 1. 校验已安装的文件
+        errors = []
+        needed = set(item["source"] for item in manifest["files"] if item.get("source"))
+        for path in sorted(needed):
+            file = _join(bundle_dir, path)
+            if not os.path.isfile(file) or hash_file(file) != old_files[path]:
+                errors.append(path)
+        if errors:
+            raise ValueError("installed bundle does not match the patch base: %s" % ", ".join(errors[:10]))
+        if dry_run:
+            print("Patch %s can be applied to %s" % (patch_file, bundle_dir))
+            return
+
+        # 2. 在临时目录中生成变化的文件, 未变化的文件保留在原处
+        if os.path.exists(stage_dir):
+            shutil.rmtree(stage_dir)
+        os.makedirs(stage_dir)
+        changed = set()
+        modes = dict((item["path"], item.get("mode")) for item in manifest["files"])
+        for item in manifest["files"]:
+            if item["op"] == "copy" and item["source"] == item["path"]:
+                continue
+            output = _join(stage_dir, item["path"])
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            source = _join(bundle_dir, item["source"]) if item.get("source") else None
+            linked = False
+            if item["op"] == "copy":
+                # 硬链接与源文件共享inode和权限: 只有两者(包括源文件更新后)的权限相同时才链接, 否则复制
+                mode = item.get("mode")
+                linked = _link_or_copy(source, output, not mode or stat.S_IMODE(os.stat(source).st_mode) == mode
+                                       and modes.get(item["source"], mode) in (None, 0, mode))
+            elif item["op"] == "full":
+                _write_file(output, zf.read(item["data"]))
+            elif item["op"] == "diff":
+                with open(source, "rb") as f:
+                    _write_file(output, apply_diff(f.read(), zf.read(item["data"])))
+            else:
+                raise ValueError("unknown op `%s`" % item["op"])
+            if item["op"] != "copy" and hash_file(output) != item["sha256"]:
+                raise ValueError("hash mismatch after patching %s" % item["path"])
+            if item.get("mode") and not linked:
+                os.chmod(output, item["mode"])
+            changed.add(item["path"])
+
+    # 3. 逐个替换文件; 不属于旧版本的文件(用户数据, 日志等)不受影响
+    removed = set(old_files) - set(item["path"] for item in manifest["files"])
+    swap_files(bundle_dir, stage_dir, backup_dir, changed, removed)
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    for path in sorted(removed, reverse=True):
+        parent = os.path.dirname(_join(bundle_dir, path))
+        while parent != bundle_dir:
+            try:
+                os.rmdir(parent)  # 只删除空目录
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+    for path in manifest.get("dirs", []):
+        os.makedirs(_join(bundle_dir, path), exist_ok=True)
+    for item in manifest["files"]:
+        if item["path"] not in changed and item.get("mode"):
+            os.chmod(_join(bundle_dir, item["path"]), item["mode"])
+    print("Updated %s to %s" % (bundle_dir, manifest.get("new_name", "")))
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if arg != "--dry-run"]
+    if len(args) != 1:
+        sys.stderr.write("usage: python %s <bundle_dir> [--dry-run]\n" % sys.argv[0])
+        sys.exit(2)
+    patch_file = sys.argv[0]
+    try:
+        apply_delta(patch_file, args[0], "--dry-run" in sys.argv[1:])
+    except (ValueError, OSError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import os
+import ast
+import sys
+import struct
+import marshal
+import importlib.util
+from .metrics import span, report
+
+# 导入归档: pkvenv_package和纯python的依赖打包进 site-packages/pkvenv.pka, 运行时映射到内存后直接导入,
+# 安装时只需要解压一个文件. 格式见 pkvenv_importer.py (打包为 pkvenv_main/importer.py)
+IMPORT_ARCHIVE_NAME = "pkvenv.pka"
+IMPORT_ARCHIVE_MAGIC = b"PKVENVA\x01"
+IMPORT_ARCHIVE_HEADER = struct.Struct("<8sQQ")
+IMPORTER_PTH_NAME = "_pkvenv_importer.pth"  # 排在其他.pth之前, 其他.pth导入的模块也可以在归档中
+NATIVE_SUFFIXES = (".so", ".pyd", ".dll", ".dylib")
+
+
+def _is_native(filename):
+    return filename.endswith(NATIVE_SUFFIXES) or ".so." in filename
+
+
+def _get_str_value(node):
+    # python < 3.8 的字符串常量为 ast.Str
+    value = node.value if isinstance(node, ast.Constant) else getattr(node, "s", None)
+    return value if isinstance(value, str) else None
+
+
+def _get_imported_names(source):
+    """Return the top-level names imported by ``source``: import statements, ``__import__("x")``
+    and ``importlib.import_module("x")`` calls."""
+    try:
+        module = ast.parse(source)
+    except SyntaxError:
+        return set()  # site同样会跳过这一行
+    names = set()
+    for node in ast.walk(module):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.module and not node.level:
+                names.add(node.module.split(".")[0])
+        elif isinstance(node, ast.Call) and node.args:
+            func = node.func
+            if isinstance(func, ast.Name) and func.id == "__import__" or \
+                    isinstance(func, ast.Attribute) and func.attr == "import_module":
+                name = _get_str_value(node.args[0])
+                if name:
+                    names.add(name.split(".")[0])
+    return names
+
+
+def _get_pth_imports(tree, site_packages):
+    # site初始化时执行.pth中以 `import` 开头的整行, 其中导入的模块可能早于importer, 保留在文件系统中
+    names = set()
+    for arcname, entry in tree.iter_files(site_packages + "/"):
+        if "/" in arcname[len(site_packages) + 1:] or not arcname.endswith(".pth"):
+            continue
+        for line in entry.read().decode("utf-8", "replace").splitlines():
+            if line.startswith(("import ", "import\t")):
+                names.update(_get_imported_names(line))
+    return names
+
+
+def find_archive_tops(tree, site_packages, exclude=()):
+    """Return the top-level packages and modules of site-packages that can be imported from the archive.
+
+    Packages containing native extensions or shared libraries stay in the file system, as well as the
+    packages with data files which use ``__file__`` (they may open the data files by path).
+    """
+    prefix = site_packages + "/"
+    native = set()
+    tops = set()
+    has_data = set()
+    sources = {}
+    for arcname, entry in tree.iter_files(prefix):
+        parts = arcname[len(prefix):].split("/")
+        if len(parts) == 1:
+            if parts[0].endswith(".py"):
+                tops.add(parts[0][:-3])
+            continue
+        if _is_native(parts[-1]):
+            native.add(parts[0])
+        elif parts[-1].endswith(".py"):
+            tops.add(parts[0])  # 只有数据文件的目录(例如 bin, share)不是包
+            sources.setdefault(parts[0], []).append(entry)
+        elif "__pycache__" not in parts:
+            has_data.add(parts[0])
+    # 数据文件只能通过 importlib.resources 或 get_data 从归档中读取, open(__file__拼接的路径) 会失败
+    uses_file = set(top for top in has_data - native
+                    if any(b"__file__" in entry.read() for entry in sources.get(top, [])))
+    skip = native | uses_file | set(exclude) | _get_pth_imports(tree, site_packages) | {"pkvenv_main", "__pycache__"}
+    return sorted(name for name in tops if name not in skip and name.isidentifier())
+
+
+def _read_pyc(tree, arcname, cache_tag):
+    # 优先使用pip安装时由打包内的python编译的pyc
+    dirname, filename = arcname.rsplit("/", 1)
+    pyc = "%s/__pycache__/%s.%s.pyc" % (dirname, filename[:-3], cache_tag)
+    if pyc not in tree:
+        return None, None
+    data = tree.read(pyc)
+    if len(data) < 16:
+        return None, None
+    return data[:4], data[16:]
+
+
+def write_import_archive(tree, site_packages, output, py_version, exclude=()):
+    """Move the pure python packages of ``tree`` into the import archive ``output``.
+
+    ``tree`` is changed in place: the archived files are replaced by the archive, the importer
+    and the .pth file installing it. Return (archived top-level names, stats).
+    """
+    from .main import ROOT_DIR
+    prefix = site_packages + "/"
+    tops = find_archive_tops(tree, site_packages, exclude)
+    cache_tag = "cpython-%s%s" % (py_version[0], py_version[1])
+    # 目标版本与构建用的python相同时可以在本进程中编译没有pyc的模块(例如项目文件)
+    can_compile = sys.implementation.cache_tag == cache_tag
+    magic = importlib.util.MAGIC_NUMBER if can_compile else None
+    files = {}
+    modules = {}
+    compiled = 0
+    with span("import archive", file=os.path.basename(output)) as args, open(output, "wb") as f:
+        f.write(IMPORT_ARCHIVE_HEADER.pack(IMPORT_ARCHIVE_MAGIC, 0, 0))
+        for top in tops:
+            entries = [(arcname, entry) for arcname, entry in tree.iter_files(prefix + top + "/")] or \
+                [(prefix + top + ".py", tree.entries[prefix + top + ".py"])]
+            dirs = set()
+            for arcname, entry in entries:
+                relpath = arcname[len(prefix):]
+                if "/__pycache__/" in "/" + relpath:
+                    continue
+                data = entry.read()
+                files[relpath] = (f.tell(), len(data))
+                f.write(data)
+                dirs.update("/".join(relpath.split("/")[:i]) for i in range(1, relpath.count("/") + 1))
+                if not relpath.endswith(".py"):
+                    continue
+                is_package = relpath.endswith("/__init__.py")
+                name = (relpath[:-len("/__init__.py")] if is_package else relpath[:-3]).replace("/", ".")
+                if not all(part.isidentifier() for part in name.split(".")):
+                    continue
+                pyc_magic, code = _read_pyc(tree, arcname, cache_tag)
+                if code is None or magic is not None and pyc_magic != magic:
+                    code = None
+                    if can_compile:
+                        try:
+                            code = marshal.dumps(compile(data, relpath, "exec", dont_inherit=True))
+                        except SyntaxError:
+                            pass  # 与文件系统中一样在导入时报错
+                elif magic is None:
+                    magic = pyc_magic
+                code_offset = -1
+                if code is not None:
+                    code_offset = f.tell()
+                    f.write(code)
+                    compiled += 1
+                modules[name] = (is_package, relpath, files[relpath][0], len(data), code_offset,
+                                 len(code) if code is not None else 0)
+            for dirname in dirs:
+                name = dirname.replace("/", ".")
+                if name not in modules and all(part.isidentifier() for part in name.split(".")):
+                    modules[name] = (True, dirname, -1, 0, -1, 0)  # 没有__init__.py的目录
+            tree.remove(prefix + top)
+            tree.remove(prefix + top + ".py")
+            for arcname, _ in list(tree.iter_files(prefix + "__pycache__/" + top + ".")):
+                tree.remove(arcname)  # 顶层模块的pyc
+        index = marshal.dumps({"magic": magic or b"", "modules": modules, "files": files}, 4)
+        index_offset = f.tell()
+        f.write(index)
+        f.seek(0)
+        f.write(IMPORT_ARCHIVE_HEADER.pack(IMPORT_ARCHIVE_MAGIC, index_offset, len(index)))
+        args.update(packages=len(tops), modules=len(modules), compiled=compiled, files=len(files))
+    args["bytes"] = os.path.getsize(output)
+    tree.add_file(prefix + IMPORT_ARCHIVE_NAME, output)
+    tree.add_file(prefix + "pkvenv_main/importer.py", os.path.join(ROOT_DIR, "pkvenv_importer.py"))
+    tree.add_bytes(prefix + IMPORTER_PTH_NAME, "import pkvenv_main.importer\n")
+    report.set("import_archive", **args)
+    print("Import archive: %d packages, %d modules (%d precompiled), %d files -> %s (%d bytes)"
+          % (len(tops), len(modules), compiled, len(files), output, args["bytes"]))
+    return tops, args
@@ -1,31 +1,89 @@
 import os
-import requests
+import sys
 import argparse
 import subprocess
 import shutil
 import json
+import re
+import fnmatch
+import hashlib
+import zipfile
+import tarfile
+import tempfile
+import platform
+import threading
 from pathlib import Path
 from . import __version__
+from .delta import make_delta
+from .size import analyze_zip, analyze_tree, check_size_budget, print_size_report, write_treemap
+from .metrics import span, report
+from .archive import ZipWriter, _hash_file
+from .import_archive import IMPORT_ARCHIVE_NAME
+from . import remote_cache
 
 ROOT_DIR = os.path.abspath(os.path.dirname(__file__))
 CONFIG_FILE_NAME = "pkvenv.json"
+TRACE_FILE_NAME = "pkvenv.trace.json"
+# 打包内的路径
+PYTHON_ARCNAME = "Python"
+SITE_PACKAGES_ARCNAME = "Python/Lib/site-packages"
+LAYER_STAMP_FILE = ".pkvenv-layer"
+# 打包的目标平台: windows 使用python.org的embed python, linux 使用可重定位的standalone python
+TARGETS = ("windows", "linux")
+# 各平台支持的架构, 第一个为默认架构
+ARCHS = {
+    "windows": ("amd64", "win32", "arm64"),
+    "linux": ("x86_64", "aarch64"),
+}
+STANDALONE_TRIPLE = "%s-unknown-linux-gnu"
+WINDOWS_PLATFORMS = {"amd64": "win_amd64", "win32": "win32", "arm64": "win_arm64"}
+LINUX_PLATFORMS = ("manylinux2014_%s", "manylinux_2_17_%s", "manylinux2010_%s", "manylinux1_%s", "linux_%s")
+# platform.machine() -> 架构名
+HOST_ARCHS = {
+    "windows": {"amd64": "amd64", "x86_64": "amd64", "arm64": "arm64", "aarch64": "arm64", "x86": "win32",
+                "i386": "win32", "i686": "win32"},
+    "linux": {"x86_64": "x86_64", "amd64": "x86_64", "aarch64": "aarch64", "arm64": "aarch64"},
+}
+LAYER_FORMAT_VERSION = "2"
 
 def get_cache_dir():
-    cache_dir = os.path.join(str(Path.home()), ".pkevnv")
+    cache_dir = os.environ.get("PKVENV_CACHE_DIR") or os.path.join(str(Path.home()), ".pkevnv")
     if not os.path.exists(cache_dir):
-        os.mkdir(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
     elif os.path.islink(cache_dir) or os.path.isfile(cache_dir):
         raise ValueError("Can not create cache dir!")
     return cache_dir
 
 
+# 进程内共享连接池, 通过api或daemon连续构建时复用连接
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests  # 延迟导入, 转发给daemon的命令不需要加载requests
+            _session = requests.Session()
+            _session.headers["User-Agent"] = "pkvenv/" + __version__
+    return _session
+
+
 def download_file(url, output):
-    req = requests.get(url, {'user-agent': "pkvenv/" + __version__}, stream=True)
-    req.raise_for_status()
-    with open(output, "wb") as f:
-        for chunk in req.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
+    with span("download", url=url) as args:
+        req = get_session().get(url, stream=True)
+        req.raise_for_status()
+        tmp_output = "%s.part-%d" % (output, os.getpid())
+        size = 0
+        with open(tmp_output, "wb") as f:
+            for chunk in req.iter_content(chunk_size=1 << 16):
+                if chunk:
+                    f.write(chunk)
+                    size += len(chunk)
+        os.replace(tmp_output, output)  # 中断的下载不会留下不完整的缓存文件
+        args["bytes"] = size
+    report.add_download(os.path.basename(output), size)
 
 
 def get_embed_python_url(py_version_str, os_arch = "amd64"):
@@ -47,6 +105,7 @@ def fetch_embeddable_python(py_version_str, os_arch = "amd64"):
     cache_dir = get_cache_dir()
     filename, url = get_embed_python_url(py_version_str, os_arch)
     cache_file = os.path.join(cache_dir, filename)
+    report.add_cache("python", os.path.exists(cache_file))
     if not os.path.exists(cache_file):
         print("Downloading %s" % url)
         download_file(url, cache_file)
@@ -54,6 +113,38 @@ def fetch_embeddable_python(py_version_str, os_arch = "amd64"):
     return cache_file
 
 
+def fetch_standalone_python(py_version_str, source=None, arch="x86_64"):
+    """Return a relocatable CPython tarball (python-build-standalone `install_only` layout) for linux bundles.
+
+    ``source`` is a local path or the url of a mirror; without it the cache dir is
+    searched for `cpython-<version>+<release>-<arch>-unknown-linux-gnu-install_only.tar.gz`.
+    """
+    cache_dir = get_cache_dir()
+    if source and "://" in source:
+        cache_file = os.path.join(cache_dir, source.rstrip("/").split("/")[-1])
+        report.add_cache("python", os.path.exists(cache_file))
+        if not os.path.exists(cache_file):
+            print("Downloading %s" % source)
+            download_file(source, cache_file)
+            print("Download finish %s" % cache_file)
+        return cache_file
+    if source:
+        if not os.path.isfile(source):
+            raise ValueError("standalone python %s is not exists" % source)
+        return source
+
+    major_minor = ".".join(py_version_str.split(".")[:2])
+    suffix = "-%s-install_only.tar.gz" % (STANDALONE_TRIPLE % arch)
+    candidates = sorted(filename for filename in os.listdir(cache_dir)
+                        if filename.startswith("cpython-%s." % major_minor) and filename.endswith(suffix))
+    if not candidates:
+        raise ValueError("Can not find a standalone python %s in %s, put a `cpython-%s.*+*%s` tarball there "
+                         "or set `python_standalone` to its path or url" % (major_minor, cache_dir, major_minor, suffix))
+    exact = [filename for filename in candidates if filename.startswith("cpython-%s+" % py_version_str)]
+    report.add_cache("python", True)
+    return os.path.join(cache_dir, (exact or candidates)[-1])
+
+
 def parse_venv_configs(venv_path):
     configs = {}
     cfg_file = os.path.join(venv_path, "pyvenv.cfg")
@@ -83,25 +174,83 @@ def get_py_version_from_str(py_version_str):
 def find_python_bin_from_path(path):
     python_path = None
     if os.name != "nt":
-        for suffix in ('python', 'python3'): # TODO: format: python3.7, python3.8
-            path = os.path.join(path, suffix)
-            if os.path.exists(path):
-                python_path = path
+        for suffix in ('python3', 'python'):
+            candidate = os.path.join(path, suffix)
+            if os.path.exists(candidate):
+                python_path = candidate
                 break
     else:
         python_path = os.path.join(path, "python.exe")
     return python_path
 
 
+def find_bundle_python(bundle_dir):
+    # windows: Python/python.exe, linux: Python/bin/python3
+    for path in (("Python", "python.exe"), ("Python", "bin", "python3"), ("Python", "bin", "python")):
+        python_path = os.path.join(bundle_dir, *path)
+        if os.path.isfile(python_path):
+            return python_path
+    raise ValueError("Can not find the bundled python in %s" % bundle_dir)
+
+
+def find_bundle_site_packages(bundle_dir):
+    site_packages_path = get_site_packages_path(bundle_dir)
+    if os.path.isdir(site_packages_path):
+        return site_packages_path
+    lib_path = os.path.join(bundle_dir, PYTHON_ARCNAME, "lib")
+    for name in sorted(os.listdir(lib_path)) if os.path.isdir(lib_path) else []:
+        if re.match(r"python3\.\d+$", name) and os.path.isdir(os.path.join(lib_path, name, "site-packages")):
+            return os.path.join(lib_path, name, "site-packages")
+    raise ValueError("Can not find the site-packages of %s" % bundle_dir)
+
+
+def get_site_packages_arcname(target, py_version):
+    if target == "linux":
+        return "%s/lib/python%s.%s/site-packages" % (PYTHON_ARCNAME, py_version[0], py_version[1])
+    return SITE_PACKAGES_ARCNAME
+
+
+# 进程内的pip freeze结果, 在daemon中跨构建复用: venv path -> (已安装包的清单, 输出)
+_freeze_cache = {}
+
+
+def _get_venv_inventory(venv_path):
+    # pyvenv.cfg 和 site-packages 中各个发行包元数据的修改时间, 安装或卸载包后会变化
+    paths = [os.path.join(venv_path, "pyvenv.cfg"), os.path.join(venv_path, "Lib", "site-packages")]
+    lib_path = os.path.join(venv_path, "lib")
+    if os.path.isdir(lib_path):
+        paths += [os.path.join(lib_path, name, "site-packages") for name in sorted(os.listdir(lib_path))]
+    inventory = []
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        inventory.append((path, os.stat(path).st_mtime_ns))
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith((".dist-info", ".egg-info", ".egg-link", ".pth")):
+                    inventory.append((name, os.stat(os.path.join(path, name)).st_mtime_ns))
+    return inventory
+
+
 def get_new_requirements(venv_path, output_path, py_version):
-    bin_path = os.path.join(venv_path, "Scripts")
+    bin_path = os.path.join(venv_path, "Scripts" if os.name == "nt" else "bin")
     python_path = find_python_bin_from_path(bin_path)
     print("Found python path: ", python_path)
     if not os.path.exists(python_path):
         raise ValueError("%s is not exists" % python_path)
-    output = subprocess.check_output([python_path, "-m", "pip", "freeze"], cwd=bin_path)
+    inventory = _get_venv_inventory(venv_path)
+    cached = _freeze_cache.get(venv_path)
+    report.add_cache("freeze", cached is not None and cached[0] == inventory)
+    if cached is not None and cached[0] == inventory:
+        output = cached[1]
+    else:
+        with span("pip freeze"):
+            output = report.check_output([python_path, "-m", "pip", "freeze"], cwd=bin_path)
+        # editable安装的包(例如 -e git+...@commit)的内容变化不会反映在清单中
+        if b"-e " not in output:
+            _freeze_cache[venv_path] = (inventory, output)
     new_requirements_file = os.path.join(output_path, "requirements.txt")
-    with open(new_requirements_file, "w") as f:
+    with open(new_requirements_file, "w", newline="\n") as f:
         for line in output.decode("utf-8").split("\n"):
             line = line.strip()
             if "pkvenv" in line:
@@ -109,112 +258,617 @@ def get_new_requirements(venv_path, output_path, py_version):
             if line.startswith("-e "):
                 line = line[3:]  # -e安装的包改为非editable安装
             f.write(line)
-            f.write(os.linesep)
+            f.write("\n")
     return new_requirements_file
 
 
-def setup_python(python_zip_file, requirements_file, output_path):
-    bin_path = os.path.join(output_path, "Python")
-    shutil.unpack_archive(python_zip_file, bin_path)
-    found_python_path_file = False
-    for filename in os.listdir(bin_path):
-        if filename.startswith("python") and filename.endswith("._pth"): # python37._pth
-            found_python_path_file = True
-            with open(os.path.join(bin_path, filename), "a") as f:
-                #f.write("..\\pkgs")
-                f.write("..")
-                f.write(os.linesep)
-                f.write("import site")
-                f.write(os.linesep)
-                break
-    if not found_python_path_file:
-        raise ValueError("Can not found python._pth file")
+def gen_pth_file(python_zip_file):
+    # 在 python37._pth 中加入打包根目录并启用site, 返回 (文件名, 内容)
+    with zipfile.ZipFile(python_zip_file) as zf:
+        for filename in zf.namelist():
+            if filename.startswith("python") and filename.endswith("._pth"): # python37._pth
+                content = zf.read(filename)
+                linesep = b"\r\n" if b"\r\n" in content else b"\n"
+                if content and not content.endswith(linesep):
+                    content += linesep
+                #content += b"..\\pkgs"
+                return filename, content + b".." + linesep + b"import site" + linesep
+    raise ValueError("Can not found python._pth file")
 
-    cache_dir = get_cache_dir()
-    get_pip_file = os.path.join(cache_dir, "get-pip.py")
+
+def fetch_get_pip():
+    get_pip_file = os.path.join(get_cache_dir(), "get-pip.py")
+    report.add_cache("get-pip", os.path.exists(get_pip_file))
     if not os.path.exists(get_pip_file):
         get_pip_url = "https://bootstrap.pypa.io/get-pip.py"
+        print("Downloading %s" % get_pip_url)
         download_file(get_pip_url, get_pip_file)
+    return get_pip_file
+
+
+def get_host_arch(target):
+    return HOST_ARCHS[target].get(platform.machine().lower())
+
+
+def is_cross_build(target="windows", arch=None):
+    # 无法在本机运行目标平台的python时, 使用本机的pip按目标平台安装依赖
+    arch = arch or ARCHS[target][0]
+    if target == "linux":
+        return not sys.platform.startswith("linux") or arch != get_host_arch(target)
+    if os.name != "nt":
+        return True
+    host_arch = get_host_arch(target)
+    return arch != host_arch and not (arch == "win32" and host_arch == "amd64")  # x64上可以运行32位python
+
+
+def setup_python_cross(requirements_file, site_packages_path, platforms, py_version, pip_args=()):
+    os.makedirs(site_packages_path, exist_ok=True)
+    command = [sys.executable, "-m", "pip", "install", "--target", site_packages_path]
+    for platform_tag in platforms:
+        command += ["--platform", platform_tag]
+    command += ["--python-version", py_version, "--implementation", "cp", "--only-binary=:all:", "--no-compile",
+                "-r", requirements_file]
+    with span("pip install", cross_build=True) as args:
+        output = report.check_output(command + list(pip_args))
+        args["site_packages_files"] = sum(len(files) for _, _, files in os.walk(site_packages_path))
+    return output
+
+
+def setup_python(python_zip_file, requirements_file, output_path, source_date_epoch=None, get_pip_file=None,
+                 cross_build=False, pip_args=(), arch="amd64"):
+    bin_path = os.path.join(output_path, "Python")
+    with span("unpack", file=os.path.basename(python_zip_file)) as args:
+        shutil.unpack_archive(python_zip_file, bin_path)
+        with zipfile.ZipFile(python_zip_file) as zf:
+            args["files"] = len(zf.namelist())
+            args["bytes"] = sum(info.file_size for info in zf.infolist())
+    pth_filename, pth_content = gen_pth_file(python_zip_file)
+    with open(os.path.join(bin_path, pth_filename), "wb") as f:
+        f.write(pth_content)
+
+    if cross_build:
+        py_version = pth_filename[len("python"):-len("._pth")]  # python39._pth -> 39
+        output = setup_python_cross(requirements_file, get_site_packages_path(output_path), [WINDOWS_PLATFORMS[arch]], py_version,
+                                    pip_args)
+        print("install requirements_file", output)
+        _count_wheel_cache(output)
+        return
+
+    if get_pip_file is None:
+        get_pip_file = fetch_get_pip()
 
     python_path = find_python_bin_from_path(bin_path)
     if not os.path.exists(python_path):
         raise ValueError("python bin file(%s) is not exists" % python_path)
 
-    output = subprocess.check_output([python_path, get_pip_file], cwd=bin_path)
+    # 设置 SOURCE_DATE_EPOCH 后pip生成基于hash校验的pyc, 与安装时间无关
+    env = dict(os.environ, SOURCE_DATE_EPOCH=str(source_date_epoch)) if source_date_epoch is not None else None
+    with span("pip bootstrap"):
+        output = report.check_output([python_path, get_pip_file], cwd=bin_path, env=env)
     print("get_pip", output)
 
-    output = subprocess.check_output([python_path, "-m", "pip", "install", "-r", requirements_file], cwd=bin_path)
+    with span("pip install") as args:
+        output = report.check_output([python_path, "-m", "pip", "install", "-r", requirements_file] + list(pip_args),
+                                     cwd=bin_path, env=env)
+        args["site_packages_files"] = sum(len(files) for _, _, files in os.walk(get_site_packages_path(output_path)))
     print("install requirements_file", output)
+    _count_wheel_cache(output)
 
 
-def copy_files(files, output_path, name, is_gui):
-    # copy include file to pkvenv_package model dir
-    pkvenv_package_path = os.path.join(output_path, "Python", "Lib", "site-packages", "pkvenv_package")
-    if os.path.exists(pkvenv_package_path):
-        shutil.rmtree(pkvenv_package_path, ignore_errors=True)
-    os.makedirs(pkvenv_package_path, exist_ok=True)
+def _check_tar_members(members):
+    """Reject the members which could write outside of the output dir, the checks do not depend on
+    ``tarfile.data_filter`` (python < 3.8.17 / 3.11.4 does not have it)."""
+    names = set()
+    links = set()
+    for member in members:
+        name = member.name.rstrip("/")
+        parts = name.split("/")
+        if not name or name.startswith("/") or os.path.isabs(name) or ".." in parts or "\\" in name:
+            raise ValueError("unsafe path in tarball: %s" % member.name)
+        if not (member.isfile() or member.isdir() or member.issym()):
+            raise ValueError("hard link or device in tarball: %s" % member.name)
+        if name in names or any("/".join(parts[:i]) in links for i in range(1, len(parts))):
+            raise ValueError("member overwrites or goes through another member in tarball: %s" % member.name)
+        if member.issym():
+            if member.linkname.startswith("/") or os.path.isabs(member.linkname):
+                raise ValueError("absolute symlink in tarball: %s -> %s" % (member.name, member.linkname))
+            links.add(name)
+        elif member.isfile():
+            member.mode &= 0o755  # 去掉setuid/setgid和其他用户的写权限
+        names.add(name)
 
-    if not os.path.exists(pkvenv_package_path):
-        os.mkdir(pkvenv_package_path)
 
-    for file in files:
-        if os.path.isfile(file):
-            shutil.copy(file, pkvenv_package_path)
-        elif os.path.isdir(file):
-            shutil.copytree(file, os.path.join(pkvenv_package_path, os.path.basename(file)))
+def _extract_tar(tar_file, output_path):
+    output_path = os.path.abspath(output_path)
+    with tarfile.open(tar_file) as tf:
+        members = tf.getmembers()
+        _check_tar_members(members)
+        if hasattr(tarfile, "data_filter"):
+            tf.extractall(output_path, members, filter="data")
         else:
-            print("[Warning] %s file is not a file or dir" % file)
+            tf.extractall(output_path, members)
+    # 符号链接可能指向后面解压的链接, 全部解压后再检查最终指向的位置
+    root = os.path.realpath(output_path)
+    for member in members:
+        path = os.path.realpath(os.path.join(output_path, *member.name.rstrip("/").split("/")))
+        if member.issym() and path != root and not path.startswith(root + os.sep):
+            shutil.rmtree(output_path, ignore_errors=True)
+            raise ValueError("symlink points outside of the tarball: %s -> %s" % (member.name, member.linkname))
+
+
+def setup_python_standalone(python_tar_file, requirements_file, output_path, source_date_epoch=None,
+                            cross_build=False, pip_args=(), arch="x86_64"):
+    # standalone python的tarball中是一个 python/ 目录: python/bin/python3, python/lib/python3.X/...
+    tmp_path = os.path.join(output_path, ".unpack")
+    with span("unpack", file=os.path.basename(python_tar_file)) as args:
+        _extract_tar(python_tar_file, tmp_path)
+        if not os.path.isdir(os.path.join(tmp_path, "python")):
+            raise ValueError("%s is not a standalone python (install_only) tarball" % python_tar_file)
+        os.rename(os.path.join(tmp_path, "python"), os.path.join(output_path, PYTHON_ARCNAME))
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        args["files"] = sum(len(files) for _, _, files in os.walk(os.path.join(output_path, PYTHON_ARCNAME)))
+    site_packages_path = find_bundle_site_packages(output_path)
 
-    # copy .exe to root directory
-    if is_gui:
-        shutil.copy(os.path.join(ROOT_DIR, "launch_gui.exe.py"), os.path.join(output_path, "%s.exe" % name))
+    if cross_build:
+        py_version = os.path.basename(os.path.dirname(site_packages_path))[len("python"):].replace(".", "")
+        platforms = [platform_tag % arch for platform_tag in LINUX_PLATFORMS]
+        output = setup_python_cross(requirements_file, site_packages_path, platforms, py_version, pip_args)
+        print("install requirements_file", output)
+        _count_wheel_cache(output)
+        return
+
+    python_path = find_bundle_python(output_path)
+    env = dict(os.environ, SOURCE_DATE_EPOCH=str(source_date_epoch)) if source_date_epoch is not None else dict(os.environ)
+    env.pop("PYTHONHOME", None)
+    env.pop("PYTHONPATH", None)
+    if not os.path.isdir(os.path.join(site_packages_path, "pip")):
+        with span("pip bootstrap"):
+            output = report.check_output([python_path, "-m", "ensurepip"], env=env)
+        print("ensurepip", output)
+
+    with span("pip install") as args:
+        output = report.check_output([python_path, "-m", "pip", "install", "-r", requirements_file] + list(pip_args),
+                                     env=env)
+        args["site_packages_files"] = sum(len(files) for _, _, files in os.walk(site_packages_path))
+    print("install requirements_file", output)
+    _count_wheel_cache(output)
+
+
+def _count_wheel_cache(output):
+    # 根据pip的输出统计wheel缓存的命中情况
+    for line in output.decode("utf-8", "replace").splitlines():
+        line = line.strip()
+        if line.startswith("Using cached "):
+            report.add_cache("wheels", True)
+        elif line.startswith("Downloading "):
+            report.add_cache("wheels", False)
+
+
+def get_site_packages_path(output_path, site_packages=SITE_PACKAGES_ARCNAME):
+    return os.path.join(output_path, *site_packages.split("/"))
+
+
+def is_cacheable_requirements(requirements_file):
+    # 本地路径安装的包内容可能变化, 不能按requirements的内容缓存
+    with open(requirements_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line and (os.path.isabs(line) or line.startswith(".") or "file:" in line):
+                return False
+    return True
+
+
+def get_source_date_epoch(reproducible=False):
+    # https://reproducible-builds.org/specs/source-date-epoch/
+    if os.environ.get("SOURCE_DATE_EPOCH"):
+        return int(os.environ["SOURCE_DATE_EPOCH"])
+    return 315532800 if reproducible else None  # 1980-01-01, zip能表示的最早时间
+
+
+def setup_runtime(python_zip_file, requirements_file, output_path, source_date_epoch=None, get_pip_file=None,
+                  cross_build=False, pip_args=(), target="windows", arch=None):
+    arch = arch or ARCHS[target][0]
+    if target == "linux":
+        setup_python_standalone(python_zip_file, requirements_file, output_path, source_date_epoch, cross_build,
+                                pip_args, arch)
     else:
-        shutil.copy(os.path.join(ROOT_DIR, "launch.exe.py"), os.path.join(output_path, "%s.exe" % name))
+        setup_python(python_zip_file, requirements_file, output_path, source_date_epoch, get_pip_file, cross_build,
+                     pip_args, arch)
+
 
+def get_runtime_layer(python_zip_file, requirements_file, build_path, source_date_epoch=None, get_pip_file=None,
+                      cross_build=False, pip_args=(), target="windows", arch=None):
+    """Return a directory containing the `Python` runtime with all requirements installed.
+
+    The layer is keyed by the python distribution (embeddable zip or standalone
+    tarball) and the requirements and reused across builds from the cache dir.
+    """
+    if not is_cacheable_requirements(requirements_file):
+        layer_path = os.path.join(build_path, "runtime")
+        if os.path.exists(layer_path):
+            shutil.rmtree(layer_path, ignore_errors=True)
+        report.add_cache("runtime", False)
+        os.makedirs(layer_path)
+        setup_runtime(python_zip_file, requirements_file, layer_path, source_date_epoch, get_pip_file, cross_build,
+                      pip_args, target, arch)
+        return layer_path
+
+    h = hashlib.sha256()
+    h.update(LAYER_FORMAT_VERSION.encode("utf-8"))
+    h.update(os.path.basename(python_zip_file).encode("utf-8"))  # 文件名中包含python版本和架构
+    h.update(b"reproducible" if source_date_epoch is not None else b"")
+    h.update(b"cross" if cross_build else b"")
+    h.update(target.encode("utf-8"))
+    h.update((arch or "").encode("utf-8"))
+    # pip_args 影响安装的包(例如 --index-url, --no-binary)
+    h.update(json.dumps(list(pip_args)).encode("utf-8"))
+    with open(requirements_file, "rb") as f:
+        h.update(f.read())
+    layers_dir = os.path.join(get_cache_dir(), "layers")
+    layer_path = os.path.join(layers_dir, "runtime-" + h.hexdigest()[:16])
+    if os.path.exists(os.path.join(layer_path, LAYER_STAMP_FILE)):
+        print("Use cached runtime layer:", layer_path)
+        report.add_cache("runtime", True)
+        return layer_path
+    report.add_cache("runtime", False)
+
+    tmp_path = "%s.tmp-%d" % (layer_path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    # 本地没有时先从共享的远程缓存下载其他agent生成的layer
+    remote = remote_cache.get_remote_cache()
+    remote_key = "layers/runtime-%s.sha256" % h.hexdigest()
+    os.makedirs(layers_dir, exist_ok=True)
+    fetched = remote is not None and fetch_remote_layer(remote, remote_key, h.hexdigest(), tmp_path)
+    if fetched:
+        print("Use runtime layer from remote cache:", remote_key)
+    else:
+        os.makedirs(tmp_path)
+        setup_runtime(python_zip_file, requirements_file, tmp_path, source_date_epoch, get_pip_file, cross_build,
+                      pip_args, target, arch)
+        with open(os.path.join(tmp_path, LAYER_STAMP_FILE), "w") as f:
+            f.write(h.hexdigest())
+    if os.path.exists(layer_path):
+        shutil.rmtree(layer_path, ignore_errors=True)  # 不完整的旧layer
+    try:
+        os.rename(tmp_path, layer_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)  # 其他进程已经生成了相同的layer
+    if remote is not None and not fetched and remote_cache.is_upload_enabled():
+        remote_cache.upload_async(remote, remote_key, lambda file: pack_layer(layer_path, file))
+    return layer_path
 
-def zip_files(output_path, name):
-    build_path = os.path.dirname(output_path)
-    shutil.make_archive(os.path.join(build_path, name), "zip", output_path)
 
+def pack_layer(layer_path, archive_file):
+    # 上传的时间主要花在压缩上, 使用最快的压缩级别
+    with tarfile.open(archive_file, "w:gz", compresslevel=1) as tf:
+        for name in sorted(os.listdir(layer_path)):
+            tf.add(os.path.join(layer_path, name), name)
+
+
+def fetch_remote_layer(remote, key, digest, output_path):
+    """Unpack the layer ``key`` of the remote cache into ``output_path``, return False on a miss."""
+    archive_file = output_path + ".tar.gz"
+    try:
+        if not remote_cache.fetch(remote, key, archive_file):
+            return False
+        with span("unpack", file=os.path.basename(key)):
+            _extract_tar(archive_file, output_path)
+        stamp_file = os.path.join(output_path, LAYER_STAMP_FILE)
+        with open(stamp_file, "r") as f:
+            if f.read() != digest:
+                raise ValueError("layer stamp does not match")
+        return True
+    except Exception as e:  # 损坏的缓存当作未命中, 在本地生成
+        print("[Warning] remote cache %s: bad layer %s: %s" % (remote, key, e))
+        shutil.rmtree(output_path, ignore_errors=True)
+        return False
+    finally:
+        if os.path.exists(archive_file):
+            os.remove(archive_file)
+
+
+LINUX_LAUNCHER_TEMPLATE = """#!/bin/sh
+# pkvenv launcher: run the `%(name)s` entry point with the bundled python
+SELF=$(readlink -f "$0" 2>/dev/null || echo "$0")
+DIR=$(cd "$(dirname "$SELF")" && pwd)
+unset PYTHONHOME PYTHONPATH
+PKVENV_ENTRY_POINT=%(name)s exec "$DIR/Python/bin/python3" -m pkvenv_main "$@"
+"""
+# fork_server模式: 不加载site运行fork客户端, 由常驻的server fork出的子进程运行入口
+LINUX_FORK_LAUNCHER_TEMPLATE = """#!/bin/sh
+# pkvenv launcher: run the `%(name)s` entry point in a child of the pre-imported fork server
+SELF=$(readlink -f "$0" 2>/dev/null || echo "$0")
+DIR=$(cd "$(dirname "$SELF")" && pwd)
+unset PYTHONHOME PYTHONPATH
+exec "$DIR/Python/bin/python3" -I -S "$DIR/%(site_packages)s/pkvenv_main/fork.py" "$DIR" %(name)s "$@"
+"""
+FORK_SERVER_IDLE_TIMEOUT = 600
+
+
+def copy_files(files, tree, entry_points, site_packages=SITE_PACKAGES_ARCNAME, target="windows", fork_server=False):
+    # add include files to pkvenv_package model dir
+    pkvenv_package_path = site_packages + "/pkvenv_package"
+    tree.remove(pkvenv_package_path)
+    tree.dirs.add(pkvenv_package_path)
+
+    with span("copy", dest=pkvenv_package_path) as args:
+        for file in files:
+            if os.path.isfile(file):
+                tree.add_file(pkvenv_package_path + "/" + os.path.basename(file), file)
+            elif os.path.isdir(file):
+                tree.add_tree(pkvenv_package_path + "/" + os.path.basename(file), file)
+            else:
+                print("[Warning] %s file is not a file or dir" % file)
+        copied = [entry for _, entry in tree.iter_files(pkvenv_package_path + "/")]
+        args["files"] = len(copied)
+        args["bytes"] = sum(entry.size for entry in copied)
+    report.set("copy", **args)
+
+    # add .exe to root directory, one for each entry point
+    for entry_point in entry_points:
+        if target == "linux":
+            template = LINUX_FORK_LAUNCHER_TEMPLATE if fork_server else LINUX_LAUNCHER_TEMPLATE
+            tree.add_bytes(entry_point["name"], template % {"name": entry_point["name"], "site_packages": site_packages},
+                           mode=0o755)
+        elif entry_point["gui"]:
+            tree.add_file("%s.exe" % entry_point["name"], os.path.join(ROOT_DIR, "launch_gui.exe.py"))
+        else:
+            tree.add_file("%s.exe" % entry_point["name"], os.path.join(ROOT_DIR, "launch.exe.py"))
+
+
+def zip_files(tree, zip_file, workers=None, policy=None, incremental=False, source_date_epoch=None, variant=None):
+    # 报告的zip部分以variant名(例如 3.11.7-x86_64)为key, targets矩阵的各个zip分别记录
+    with span("compress", zip_file=os.path.basename(zip_file)) as args:
+        writer = ZipWriter(zip_file, workers, policy, incremental=incremental, source_date_epoch=source_date_epoch)
+        writer.add_bundle(tree)
+        writer.close()
+        args.update(files=len(tree), bytes=writer.raw_size, compressed_bytes=writer.compress_size,
+                    reused=writer.reused)
+    report.set("zip", **{variant or os.path.splitext(os.path.basename(zip_file))[0]: {
+        "file": zip_file, "files": len(tree), "raw_bytes": writer.raw_size, "compressed_bytes": writer.compress_size,
+        "reused": writer.reused}})
+    print("Zip: %d entries (%d reused), %d bytes -> %d bytes" % (len(writer.entries), writer.reused, writer.raw_size,
+                                                                 writer.compress_size))
+
+
+# pkvenv_main/__main__.py: 根据启动程序的名称(`%s.exe`)选择要运行的入口模块.
+# 启动程序通过环境变量 PKVENV_ENTRY_POINT 传入名称, 旧版本的启动程序没有设置该变量, 则通过父进程的路径获取.
+LAUNCH_MAIN_TEMPLATE = """import os
+import sys
+import runpy
+
+ENTRY_POINTS = {
+%(entry_points)s}
+DEFAULT_ENTRY_POINT = %(default)r
+
+
+def get_launcher_name():
+    name = os.environ.pop("PKVENV_ENTRY_POINT", None)
+    if name or os.name != "nt":
+        return name
+    try:
+        import ctypes
+        from ctypes import wintypes
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        kernel32.OpenProcess.restype = wintypes.HANDLE
+        handle = kernel32.OpenProcess(0x1000, False, os.getppid())  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return None
+        try:
+            size = wintypes.DWORD(1024)
+            buf = ctypes.create_unicode_buffer(size.value)
+            if not kernel32.QueryFullProcessImageNameW(handle, 0, buf, ctypes.byref(size)):
+                return None
+            return os.path.splitext(os.path.basename(buf.value))[0]
+        finally:
+            kernel32.CloseHandle(handle)
+    except Exception:
+        return None
 
-def gen_launch_file(output_path, args):
+
+name = (get_launcher_name() or DEFAULT_ENTRY_POINT).lower()
+runpy.run_module(ENTRY_POINTS.get(name, ENTRY_POINTS[DEFAULT_ENTRY_POINT]), run_name="__main__", alter_sys=True)
+"""
+
+
+LAUNCH_INIT_TEMPLATE = """import os
+
+
+def startup_probe():
+    # `pkvenv bench-startup` 测量到达入口函数的时间: 记录时间后直接退出, 不运行程序
+    probe_file = os.environ.get("PKVENV_STARTUP_PROBE")
+    if probe_file:
+        import time
+        with open(probe_file, "w") as f:
+            f.write(repr(time.time()))
+        raise SystemExit(0)
+"""
+
+
+def get_entry_point_module_name(name):
+    module_name = re.sub(r"\W", "_", name).lower()
+    if not module_name or module_name[0].isdigit():
+        module_name = "_" + module_name
+    return module_name
+
+
+def gen_launch_file(tree, entry_points, site_packages=SITE_PACKAGES_ARCNAME):
     # 创建 pkvenv_main model, 通过运行pkvenv_main model来拉起 pkvenv_package.
-    pkvenv_main_path = os.path.join(output_path, "Python", "Lib", "site-packages", "pkvenv_main")
-    if os.path.exists(pkvenv_main_path):
-        shutil.rmtree(pkvenv_main_path, ignore_errors=True)
-    os.makedirs(pkvenv_main_path, exist_ok=True)
+    # 每个入口生成一个 pkvenv_main.<name> 模块, 所有入口共享同一个 Python 目录.
+    pkvenv_main_path = site_packages + "/pkvenv_main"
+    tree.remove(pkvenv_main_path)
 
-    tmp = args.split(":")
-    module_names = tmp[0].split(".")
-    function_name = tmp[1]
+    modules = {}
+    for entry_point in entry_points:
+        tmp = entry_point["entry_point"].split(":")
+        module_names = tmp[0].split(".")
+        function_name = tmp[1]
 
-    main_file = os.path.join(pkvenv_main_path, "__main__.py")
-    package_name = "." + ".".join(module_names[0:-1]) if module_names[0:-1] else ""
-    with open(main_file, "w") as f:
-        f.write("from pkvenv_package%s import %s%s" % (package_name, module_names[-1], os.linesep))
-        f.write("%s.%s()%s" % (module_names[-1], function_name, os.linesep))
+        module_name = get_entry_point_module_name(entry_point["name"])
+        if module_name in modules.values() or module_name in ("__init__", "__main__"):
+            raise ValueError("duplicate entry point name `%s`" % entry_point["name"])
+        modules[entry_point["name"].lower()] = "pkvenv_main." + module_name
 
-    init_file = os.path.join(pkvenv_main_path, "__init__.py")
-    with open(init_file, "w") as f:
-        pass
+        package_name = "." + ".".join(module_names[0:-1]) if module_names[0:-1] else ""
+        content = "from pkvenv_package%s import %s\n" % (package_name, module_names[-1])
+        content += "if __name__ == \"__main__\":\n"
+        content += "    from pkvenv_main import startup_probe\n"
+        content += "    startup_probe()\n"
+        content += "    %s.%s()\n" % (module_names[-1], function_name)
+        tree.add_bytes(pkvenv_main_path + "/" + module_name + ".py", content)
 
+    tree.add_bytes(pkvenv_main_path + "/__main__.py", LAUNCH_MAIN_TEMPLATE % {
+        "entry_points": "".join("    %r: %r,\n" % item for item in modules.items()),
+        "default": entry_points[0]["name"].lower(),
+    })
+    tree.add_bytes(pkvenv_main_path + "/__init__.py", LAUNCH_INIT_TEMPLATE)
 
 
-def main():
-    print("pkvenv %s" % __version__)
-    argparser = argparse.ArgumentParser()
-    argparser.add_argument("project_dir", help="project dir")
-    arguments = argparser.parse_args()
+def get_bundle_hash(tree, layer_path=None):
+    """Fingerprint of the bundle content.
 
-    project_dir = os.path.abspath(arguments.project_dir)
+    Files of a cached runtime layer are covered by the layer's digest (the layer never
+    changes once created), other files are hashed by content.
+    """
+    h = hashlib.sha256()
+    layer_prefix = None
+    if layer_path and os.path.exists(os.path.join(layer_path, LAYER_STAMP_FILE)):  # 不能缓存的layer没有stamp
+        layer_prefix = os.path.join(layer_path, "")
+        with open(os.path.join(layer_path, LAYER_STAMP_FILE), "rb") as f:
+            h.update(f.read())
+    for arcname, entry in tree.iter_files():
+        h.update(arcname.encode("utf-8") + b"\0")
+        if entry.data is not None:
+            h.update(hashlib.sha256(entry.data).digest())
+        elif layer_prefix and entry.path.startswith(layer_prefix):
+            h.update(str(entry.size).encode("utf-8"))
+        else:
+            h.update(_hash_file(entry.path).encode("utf-8"))
+    return h.hexdigest()
+
+
+def gen_fork_server_files(tree, entry_points, site_packages=SITE_PACKAGES_ARCNAME, layer_path=None,
+                          idle_timeout=FORK_SERVER_IDLE_TIMEOUT):
+    # pkvenv_main/fork.py 和它的配置, 在打包内容确定之后生成. 客户端根据配置中的hash找到对应的server,
+    # 打包内容变化后hash不同, 旧的server不再使用
+    pkvenv_main_path = site_packages + "/pkvenv_main"
+    config_arcname = pkvenv_main_path + "/fork_server.json"
+    tree.remove(config_arcname)
+    tree.add_file(pkvenv_main_path + "/fork.py", os.path.join(ROOT_DIR, "pkvenv_fork.py"))
+    tree.add_bytes(config_arcname, json.dumps({
+        "hash": get_bundle_hash(tree, layer_path),
+        "idle_timeout": idle_timeout,
+        "entry_points": dict((entry_point["name"].lower(),
+                              "pkvenv_main." + get_entry_point_module_name(entry_point["name"]))
+                             for entry_point in entry_points),
+        "default": entry_points[0]["name"].lower(),
+    }, indent=1, sort_keys=True))
+
+
+def load_trace(trace_file):
+    if not os.path.exists(trace_file):
+        return 0, set()
+    try:
+        with open(trace_file, "r") as f:
+            trace = json.load(f)
+        return int(trace.get("runs", 1)), set(str(file) for file in trace.get("files", []))
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError("%s is not a valid trace file" % trace_file)
+
+
+def merge_trace(trace_file, run_trace_file, reset=False):
+    runs, files = (0, set()) if reset else load_trace(trace_file)
+    # 被trace的进程在退出时写入, 崩溃或被杀死时为空或不完整
+    if not os.path.exists(run_trace_file) or os.path.getsize(run_trace_file) == 0:
+        raise ValueError("no trace recorded, the traced command exited before writing it")
+    try:
+        _, run_files = load_trace(run_trace_file)
+    except ValueError:
+        raise ValueError("no trace recorded, the trace written by the traced command is incomplete")
+    files |= run_files
+    with open(trace_file, "w") as f:
+        json.dump({"runs": runs + 1, "files": sorted(files)}, f, indent=1)
+    return runs + 1, files
+
+
+def trace_bundle(output_path, trace_file, command, reset=False):
+    # 用打包内的python运行command, 记录所有从打包目录中import的模块和open的文件
+    python_path = find_bundle_python(output_path)
+    tracer_file = os.path.join(find_bundle_site_packages(output_path), "pkvenv_trace.py")
+    shutil.copy(os.path.join(ROOT_DIR, "pkvenv_trace.py"), tracer_file)
+    fd, run_trace_file = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        returncode = subprocess.call([python_path, "-m", "pkvenv_trace", run_trace_file, output_path] + command)
+        runs, files = merge_trace(trace_file, run_trace_file, reset)
+    finally:
+        os.remove(tracer_file)
+        os.remove(run_trace_file)
+    print("Trace: %d files recorded, %d runs merged into %s" % (len(files), runs, trace_file))
+    return returncode
+
+
+def _get_trace_module_key(path):
+    # pkg/__pycache__/mod.cpython-39.pyc, pkg/mod.py, pkg/mod.cp39-win_amd64.pyd -> pkg/mod
+    dirname, filename = os.path.split(path)
+    if os.path.basename(dirname) == "__pycache__" and filename.endswith(".pyc"):
+        dirname = os.path.dirname(dirname)
+        return (dirname + "/" if dirname else "") + filename.split(".")[0]
+    if filename.endswith((".py", ".pyc", ".pyd")) or filename.endswith(".so") and (".cpython-" in filename or ".abi3." in filename):
+        return (dirname + "/" if dirname else "") + filename.split(".")[0]
+    return None
+
+
+def _get_trace_top_name(path):
+    key = _get_trace_module_key(path)
+    return (key or path).split("/")[0].split(".")[0]
+
+
+def minimize_from_trace(tree, trace_file, keep_patterns=(), site_packages=SITE_PACKAGES_ARCNAME):
+    # 只保留trace中记录到的顶层包, 以及这些包中被import过的python模块(数据文件和动态库全部保留)
+    _, traced_files = load_trace(trace_file)
+    prefix = site_packages + "/"
+    touched_keys = set()
+    touched_tops = set()
+    for path in traced_files:
+        if not path.startswith(prefix):
+            continue
+        path = path[len(prefix):]
+        if path.startswith(IMPORT_ARCHIVE_NAME + "/"):
+            path = path[len(IMPORT_ARCHIVE_NAME) + 1:]  # 从导入归档中import的模块
+        touched_tops.add(_get_trace_top_name(path))
+        key = _get_trace_module_key(path)
+        if key:
+            touched_keys.add(key)
+
+    removed_files, removed_bytes = 0, 0
+    for arcname, entry in list(tree.iter_files(prefix)):
+        path = arcname[len(prefix):]
+        parts = path.split("/")
+        if parts[0] in ("pkvenv_main", "pkvenv_package") or parts[0].endswith((".dist-info", ".egg-info")):
+            continue
+        if len(parts) == 1 and path.endswith(".pth"):
+            continue
+        if any(fnmatch.fnmatch(path, pattern) for pattern in keep_patterns):
+            continue
+        if _get_trace_top_name(path) in touched_tops:
+            key = _get_trace_module_key(path)
+            if key is None or key in touched_keys:
+                continue
+        removed_files += 1
+        removed_bytes += entry.size
+        tree.remove(arcname)
+    print("Trace minimize: removed %d files (%d bytes)" % (removed_files, removed_bytes))
+
+
+def read_configs(project_dir):
     if not os.path.exists(project_dir) or not os.path.isdir(project_dir):
-        print("Error: project directory(%s) is not exists or not a directory!" % project_dir)
-        exit(-1)
+        raise ValueError("project directory(%s) is not exists or not a directory!" % project_dir)
 
     configs_file = os.path.join(project_dir, CONFIG_FILE_NAME)
     if not os.path.exists(configs_file):
-        print("Error: config file(%s) is not exists!" % configs_file)
-        exit(-1)
+        raise ValueError("config file(%s) is not exists!" % configs_file)
 
     configs = None
     with open(configs_file, "r") as f:
@@ -223,57 +877,244 @@ def main():
         except:
             pass
     if not configs:
-        print("Error: can not parse config file!")
-        exit(-1)
+        raise ValueError("can not parse config file!")
+    return configs
 
-    name = configs["name"] if "name" in configs else None
-    args = configs["entry_point"] if "entry_point" in configs else None
-    venv = configs["venv"] if "venv" in configs else None
-    include = configs["include"] if "include" in configs else None
-    gui = bool(configs["gui"]) if "gui" in configs else False
-    if name is None:
-        print("Error: `name` is missing in config file!")
+
+def load_configs(project_dir):
+    try:
+        return read_configs(project_dir)
+    except ValueError as e:
+        print("Error: %s" % e)
         exit(-1)
-    if args is None:
-        print("Error: `args` is missing in config file!")
+
+
+def get_trace_configs(project_dir, configs):
+    trace = configs["trace"] if "trace" in configs else None
+    if isinstance(trace, dict):
+        trace_file = trace["file"] if "file" in trace else TRACE_FILE_NAME
+        keep_patterns = trace["keep"] if "keep" in trace else []
+    else:
+        trace_file = trace or TRACE_FILE_NAME
+        keep_patterns = []
+    return os.path.abspath(os.path.join(project_dir, trace_file)), keep_patterns
+
+
+def trace_main(argv):
+    argparser = argparse.ArgumentParser(prog="pkvenv trace")
+    argparser.add_argument("project_dir", help="project dir")
+    argparser.add_argument("-o", "--output", help="trace file, default is `trace` in config file or %s" % TRACE_FILE_NAME)
+    argparser.add_argument("--reset", action="store_true", help="discard the existing trace instead of merging into it")
+    argparser.add_argument("command", nargs=argparse.REMAINDER,
+                           help="arguments passed to the bundled python, eg: `-- -m pkvenv_main` (default) or `-- smoke_test.py`")
+    arguments = argparser.parse_args(argv)
+
+    project_dir = os.path.abspath(arguments.project_dir)
+    configs = load_configs(project_dir)
+    trace_file, _ = get_trace_configs(project_dir, configs)
+    if arguments.output:
+        trace_file = os.path.abspath(arguments.output)
+    command = arguments.command[1:] if arguments.command[:1] == ["--"] else arguments.command
+
+    output_path = os.path.join(project_dir, "build", "pkvenv")
+    tmp_dir = None
+    try:
+        if not os.path.exists(output_path):
+            # 没有打包目录时先在临时目录中生成(不使用trace裁剪), trace之后删除
+            from .api import BuildConfig, BuildOptions, PkvenvError, build
+            tmp_dir = tempfile.mkdtemp(prefix="pkvenv-trace-")
+            print("Stage the bundle without the trace to", tmp_dir)
+            try:
+                result = build(BuildConfig.load(project_dir), BuildOptions(no_trace=True, stage_dir=tmp_dir,
+                                                                           stage_only=True))
+            except PkvenvError as e:
+                print("Error: %s" % e)
+                exit(-1)
+            output_path = tmp_dir
+            if not os.path.exists(os.path.join(tmp_dir, PYTHON_ARCNAME)):
+                output_path = os.path.join(tmp_dir, list(result.zip_files)[0])  # targets矩阵: 第一个variant
+        returncode = trace_bundle(output_path, trace_file, command, arguments.reset)
+    except ValueError as e:
+        print("Error: %s" % e)
         exit(-1)
-    if venv is None:
-        print("Error: `venv` is missing in config file!")
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    if returncode != 0:
+        print("[Warning] traced command exited with %d" % returncode)
+
+
+def size_main(argv):
+    argparser = argparse.ArgumentParser(prog="pkvenv size")
+    argparser.add_argument("bundle", help="project dir (uses the zips of its `targets` and `size_budget`), a bundle zip "
+                                          "or a staged bundle dir (raw sizes only)")
+    argparser.add_argument("-n", "--top", type=int, default=20, help="number of the largest groups to show")
+    argparser.add_argument("--json", metavar="FILE", help="write the sizes as a JSON treemap")
+    arguments = argparser.parse_args(argv)
+
+    from .bundle import BundleTree
+    bundle = os.path.abspath(arguments.bundle)
+    budget = None
+    trees = []
+    if os.path.isfile(os.path.join(bundle, CONFIG_FILE_NAME)):
+        from .api import BuildConfig
+        try:
+            config = BuildConfig.load(bundle)
+            venv_configs = parse_venv_configs(config.venv_path)
+            if "version" not in venv_configs:
+                raise ValueError("Can not find python version is venv config file!")
+            zip_files = [config.get_zip_file(variant) for variant in config.get_variants(venv_configs["version"])]
+        except ValueError as e:
+            print("Error: %s" % e)
+            exit(-1)
+        budget = config.size_budget
+        missing = [zip_file for zip_file in zip_files if not os.path.isfile(zip_file)]
+        if missing:
+            print("Error: %s is not exists, build the project first!" % ", ".join(missing))
+            exit(-1)
+        trees = [analyze_zip(zip_file) for zip_file in zip_files]
+    elif os.path.isdir(bundle):
+        tree = BundleTree()
+        tree.add_tree("", bundle)
+        trees = [analyze_tree(tree, name=bundle)]
+    elif os.path.isfile(bundle):
+        trees = [analyze_zip(bundle)]
+    else:
+        print("Error: %s is not exists!" % bundle)
         exit(-1)
-    if include is None:
-        print("Error: `include` is missing in config file!")
+
+    errors = []
+    for tree in trees:
+        print_size_report(tree, arguments.top)
+        if budget:
+            try:
+                errors += ["%s: %s" % (os.path.basename(tree["name"]), error) if len(trees) > 1 else error
+                           for error in check_size_budget(tree, budget)]
+            except ValueError as e:
+                print("Error: %s" % e)
+                exit(-1)
+    if arguments.json:
+        # targets矩阵的各个zip作为treemap根节点的子节点
+        write_treemap(trees[0] if len(trees) == 1 else {
+            "name": bundle, "size": sum(tree["size"] for tree in trees),
+            "compressed": sum(tree["compressed"] for tree in trees),
+            "children": dict((tree["name"], tree) for tree in trees)}, arguments.json)
+        print("Treemap saved to", arguments.json)
+    for error in errors:
+        print("Error: %s" % error)
+    if errors:
         exit(-1)
+    if budget:
+        print("Size budget OK")
 
-    venv_path = os.path.abspath(os.path.join(project_dir, venv))
-    include_files = []
-    for item in include:
-        include_files.append(os.path.abspath(os.path.join(project_dir, item))) # TODO: dir
 
-    output_path = os.path.join(project_dir, "build", "pkvenv")
-    if os.path.exists(output_path):
-        shutil.rmtree(output_path, ignore_errors=True)
-    os.makedirs(output_path, exist_ok=True)
+def delta_main(argv):
+    argparser = argparse.ArgumentParser(prog="pkvenv delta")
+    argparser.add_argument("old_zip", help="zip of the installed version")
+    argparser.add_argument("new_zip", help="zip of the new version")
+    argparser.add_argument("-o", "--output", help="update package, default is `<new_zip>.delta.zip`")
+    arguments = argparser.parse_args(argv)
+
+    for zip_file in (arguments.old_zip, arguments.new_zip):
+        if not os.path.isfile(zip_file):
+            print("Error: %s is not exists!" % zip_file)
+            exit(-1)
+    output = arguments.output or os.path.splitext(arguments.new_zip)[0] + ".delta.zip"
+    make_delta(arguments.old_zip, arguments.new_zip, output)
 
-    venv_configs = parse_venv_configs(venv_path)
-    if "version" not in venv_configs:
-        print("Error: Can not find python version is venv config file!")
-        exit(-1)
-    print("Found venv configs:", venv_configs, venv_path)
-    py_version = get_py_version_from_str(venv_configs['version'])
-    new_requirements_file = get_new_requirements(venv_path, output_path, py_version)
-    print("Found new requirements file:", new_requirements_file)
 
-    embed_python_zip_file = fetch_embeddable_python(venv_configs['version'])
-    print("Fetch embed python:", embed_python_zip_file)
-    setup_python(embed_python_zip_file, new_requirements_file, output_path)
+def bench_main(argv):
+    from .bench import bench_main
+    bench_main(argv)
 
-    copy_files(include_files, output_path, name, gui)
-    gen_launch_file(output_path, args)
-    zip_files(output_path, name)
 
+def bench_startup_main(argv):
+    from .bench import bench_startup_main
+    bench_startup_main(argv)
 
 
+def build_all_main(argv):
+    from .batch import build_all_main
+    build_all_main(argv)
 
 
+def watch_main(argv):
+    from .watch import watch_main
+    watch_main(argv)
+
+
+def daemon_main(argv):
+    from .daemon import daemon_main
+    daemon_main(argv)
+
+
+def cache_server_main(argv):
+    from .cache_server import cache_server_main
+    cache_server_main(argv)
+
+
+COMMANDS = {
+    "build-all": build_all_main,
+    "daemon": daemon_main,
+    "cache-server": cache_server_main,
+    "watch": watch_main,
+    "trace": trace_main,
+    "delta": delta_main,
+    "size": size_main,
+    "bench": bench_main,
+    "bench-startup": bench_startup_main,
+}
+
+
+def build_main(argv):
+    argparser = argparse.ArgumentParser(prog="pkvenv")
+    argparser.add_argument("project_dir", help="project dir")
+    argparser.add_argument("--no-trace", action="store_true", help="do not minimize the bundle with the recorded trace")
+    argparser.add_argument("-j", "--jobs", type=int, help="number of compression workers, default is the number of CPUs")
+    argparser.add_argument("--incremental", action="store_true",
+                           help="reuse the compressed entries of unchanged files from the previous zip")
+    argparser.add_argument("--release", action="store_true", help="use the `release` compression settings of the config file")
+    argparser.add_argument("--strip-dry-run", action="store_true", help="only report the files the strip stage would remove")
+    argparser.add_argument("--reproducible", action="store_true",
+                           help="produce byte-identical zips for identical inputs (implied by SOURCE_DATE_EPOCH)")
+    argparser.add_argument("--trace", metavar="FILE",
+                           help="write the timing of the build stages to FILE in Chrome trace-event format")
+    argparser.add_argument("--prometheus", metavar="FILE",
+                           help="also write the build report to FILE as Prometheus textfile metrics")
+    argparser.add_argument("--stage-dir", help="also write the bundle tree to this directory (relative to project dir), eg: build/pkvenv")
+    argparser.add_argument("--requirements", metavar="FILE",
+                           help="use this frozen requirements file of the venv instead of running `pip freeze`")
+    arguments = argparser.parse_args(argv)
+
+    from .api import BuildConfig, BuildOptions, PkvenvError, build
+    options = BuildOptions(no_trace=arguments.no_trace, jobs=arguments.jobs, incremental=arguments.incremental,
+                           release=arguments.release, strip_dry_run=arguments.strip_dry_run,
+                           reproducible=arguments.reproducible, stage_dir=arguments.stage_dir,
+                           chrome_trace=arguments.trace, prometheus=arguments.prometheus,
+                           requirements_file=arguments.requirements)
+    try:
+        build(BuildConfig.load(arguments.project_dir), options)
+    except PkvenvError as e:
+        print("Error: %s" % e)
+        exit(-1)
+
+
+def main():
+    print("pkvenv %s" % __version__)
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
+    # 有daemon在运行时转发给daemon构建, 省去启动进程和冷缓存的开销
+    from .daemon import forward_to_daemon
+    returncode = forward_to_daemon(sys.argv[1:])
+    if returncode is None:
+        try:
+            build_main(sys.argv[1:])
+        finally:
+            remote_cache.wait_for_uploads()
+    elif returncode != 0:
+        exit(returncode)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import threading
+from contextlib import contextmanager
+
+
+class Tracer(object):
+    """Records timed spans of the build, from any thread.
+
+    Spans are written in the Chrome trace-event format (chrome://tracing, Perfetto),
+    with values like byte and file counts attached as args.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.events = []
+        self.thread_names = {}
+        self.begin = time.perf_counter()
+        self._local = threading.local()
+
+    def _get_tid(self):
+        # 线程结束后ident会被复用, 每个线程分配独立的编号
+        tid = getattr(self._local, "tid", None)
+        if tid is None:
+            with self._lock:
+                tid = self._local.tid = len(self.thread_names) + 1
+                self.thread_names[tid] = threading.current_thread().name
+        return tid
+
+    @contextmanager
+    def span(self, name, cat="build", **args):
+        """Time the enclosed block; the yielded dict can be filled with more args."""
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            event = {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": round((start - self.begin) * 1e6),
+                "dur": round((end - start) * 1e6),
+                "pid": os.getpid(),
+                "tid": self._get_tid(),
+                "args": args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def get_durations(self, cat="stage"):
+        """Return {span name: seconds} of the recorded spans of a category."""
+        with self._lock:
+            return dict((event["name"], event["dur"] / 1e6) for event in self.events if event["cat"] == cat)
+
+    def write_chrome_trace(self, trace_file):
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event["ts"])
+            events += [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                       for tid, name in sorted(self.thread_names.items())]
+        with open(trace_file, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, indent=1)
+
+
+# 进程内默认的tracer, 构建的各个步骤都记录到这里
+tracer = Tracer()
+
+
+def span(name, cat="build", **args):
+    return tracer.span(name, cat, **args)
+
+
+def get_peak_rss():
+    """Return (peak RSS of this process, peak RSS of the largest finished child) in bytes."""
+    try:
+        import resource
+    except ImportError:
+        return get_peak_rss_windows(), None
+    scale = 1 if sys.platform == "darwin" else 1024  # linux上单位是KB
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def get_peak_rss_windows(process=None):
+    """Peak working set of a process handle (default: the current process) in bytes."""
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    if process is None:
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+
+def _get_command_label(command):
+    # [python, -m, pip, install, ...] -> `pip install`, [python, get-pip.py] -> `get-pip.py`
+    if len(command) >= 3 and command[1] == "-m":
+        return " ".join(command[2:4])
+    if len(command) >= 2:
+        return os.path.basename(command[1])
+    return os.path.basename(command[0])
+
+
+class BuildReport(object):
+    """Counters of one build, written as a JSON report and as Prometheus textfile metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.begin = time.time()
+        self.downloads = {}  # artifact -> bytes
+        self.cache = {}  # cache name -> {"hits": n, "misses": n}
+        self.subprocesses = []
+        self.values = {}  # section -> {key: value}, eg: copy, zip
+
+    def add_download(self, artifact, size):
+        with self._lock:
+            self.downloads[artifact] = self.downloads.get(artifact, 0) + size
+
+    def add_cache(self, name, hit, count=1):
+        with self._lock:
+            counter = self.cache.setdefault(name, {"hits": 0, "misses": 0})
+            counter["hits" if hit else "misses"] += count
+
+    def set(self, section, **values):
+        with self._lock:
+            self.values.setdefault(section, {}).update(values)
+
+    def check_output(self, command, **kwargs):
+        """``subprocess.check_output`` recording the wall time of the command."""
+        start = time.perf_counter()
+        returncode = 0
+        try:
+            return subprocess.check_output(command, **kwargs)
+        except subprocess.CalledProcessError as e:
+            returncode = e.returncode
+            raise
+        finally:
+            with self._lock:
+                self.subprocesses.append({
+                    "command": [str(arg) for arg in command],
+                    "seconds": round(time.perf_counter() - start, 3),
+                    "returncode": returncode,
+                })
+
+    def to_dict(self, name, status, stages=None):
+        peak_rss, children_peak_rss = get_peak_rss()
+        with self._lock:
+            report = {
+                "name": name,
+                "status": status,
+                "started": self.begin,
+                "seconds": round(time.time() - self.begin, 3),
+                "stages": stages or {},
+                "downloads": dict(self.downloads),
+                "cache": dict((key, dict(value)) for key, value in self.cache.items()),
+                "subprocesses": list(self.subprocesses),
+                "peak_rss": peak_rss,
+                "children_peak_rss": children_peak_rss,
+            }
+            for section, values in self.values.items():
+                report[section] = dict(values)
+        return report
+
+    def write_json(self, report_file, report):
+        with open(report_file, "w") as f:
+            json.dump(report, f, indent=1)
+
+    def write_prometheus(self, metrics_file, report):
+        """Write the report in the node_exporter textfile collector format."""
+        lines = []
+
+        def metric(metric_name, help, value, **labels):
+            if value is None:
+                return
+            if not any(line.startswith("# HELP %s " % metric_name) for line in lines):
+                lines.append("# HELP %s %s" % (metric_name, help))
+                lines.append("# TYPE %s gauge" % metric_name)
+            labels = dict(project=report["name"], **labels)
+            label_str = ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                                 for key, value in sorted(labels.items()))
+            lines.append("%s{%s} %s" % (metric_name, label_str, value))
+
+        metric("pkvenv_build_success", "1 if the last build succeeded", int(report["status"] == "success"))
+        metric("pkvenv_build_duration_seconds", "Wall time of the build", report["seconds"])
+        metric("pkvenv_build_timestamp_seconds", "Start time of the build", round(report["started"]))
+        for stage, seconds in sorted(report["stages"].items()):
+            metric("pkvenv_stage_duration_seconds", "Wall time of a build stage", seconds, stage=stage)
+        for artifact, size in sorted(report["downloads"].items()):
+            metric("pkvenv_download_bytes", "Bytes downloaded per artifact", size, artifact=artifact)
+        for cache, counter in sorted(report["cache"].items()):
+            metric("pkvenv_cache_hits", "Cache hits", counter["hits"], cache=cache)
+            metric("pkvenv_cache_misses", "Cache misses", counter["misses"], cache=cache)
+        seconds = {}
+        for item in report["subprocesses"]:
+            command = _get_command_label(item["command"])
+            seconds[command] = seconds.get(command, 0) + item["seconds"]
+        for command, value in sorted(seconds.items()):
+            metric("pkvenv_subprocess_seconds", "Wall time of subprocesses", round(value, 3), command=command)
+        copy = report.get("copy", {})
+        metric("pkvenv_copy_files", "Number of project files copied into the bundle", copy.get("files"))
+        metric("pkvenv_copy_bytes", "Bytes of project files copied into the bundle", copy.get("bytes"))
+        for variant, zip_values in sorted(report.get("zip", {}).items()):
+            metric("pkvenv_zip_files", "Number of files in the zip", zip_values.get("files"), variant=variant)
+            metric("pkvenv_zip_raw_bytes", "Uncompressed size of the zip", zip_values.get("raw_bytes"), variant=variant)
+            metric("pkvenv_zip_compressed_bytes", "Compressed size of the zip", zip_values.get("compressed_bytes"),
+                   variant=variant)
+            metric("pkvenv_zip_reused_files", "Files reused from the previous zip", zip_values.get("reused"),
+                   variant=variant)
+        metric("pkvenv_peak_rss_bytes", "Peak RSS of the build process", report["peak_rss"])
+        metric("pkvenv_children_peak_rss_bytes", "Peak RSS of the largest subprocess", report["children_peak_rss"])
+
+        # 先写临时文件再重命名, 避免node_exporter读到写了一半的文件
+        tmp_file = "%s.%d.tmp" % (metrics_file, os.getpid())
+        with open(tmp_file, "w", newline="\n") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, metrics_file)
+
+
+# 当前构建的计数
+report = BuildReport()
@@ -0,0 +1,162 @@
+import io
+import os
+import time
+import gzip
+import shlex
+import shutil
+import hashlib
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from .bundle import BundleTree
+from .metrics import span, report
+
+# 单文件包: sh启动脚本 + payload(多个tar.gz分块). 启动脚本中记录了payload的hash和各分块的偏移(索引).
+# 第一次运行时并发解压所有分块到 `<cache>/<name>-<hash>`, 之后只检查stamp文件是否存在, 直接运行.
+ONEFILE_CHUNKS = 4
+ONEFILE_CACHE_ENV = "PKVENV_ONEFILE_DIR"
+ONEFILE_STAMP_FILE = ".pkvenv-onefile"
+ONEFILE_HASH_LENGTH = 16
+
+ONEFILE_STUB_TEMPLATE = """#!/bin/sh
+# pkvenv onefile: %(name)s, payload %(hash)s
+C="${%(cache_env)s:-${XDG_CACHE_HOME:-$HOME/.cache}/pkvenv-apps}"
+D="$C"/%(dir_name)s
+if [ ! -f "$D/%(stamp)s" ]; then
+    mkdir -p "$C" && T=$(mktemp -d "$C"/.%(dir_name)s.XXXXXX) || exit 1
+%(extract)s    S=0
+    for P in %(pids)s; do wait $P || S=1; done
+    if [ $S != 0 ] || ! "$T/Python/bin/python3" -I -S "$T/%(site_packages)s/pkvenv_main/onefile.py" "$T" "$D"; then
+        rm -rf "$T"
+        echo "pkvenv: can not extract $0 to $D" >&2
+        exit 1
+    fi
+fi
+unset PYTHONHOME PYTHONPATH
+case "${0##*/}" in
+%(cases)s    *) E=%(default)s ;;
+esac
+%(exec)s
+exit 127
+"""
+ONEFILE_EXEC = 'PKVENV_ENTRY_POINT="$E" exec "$D/Python/bin/python3" -m pkvenv_main "$@"'
+ONEFILE_FORK_EXEC = 'exec "$D/Python/bin/python3" -I -S "$D/%(site_packages)s/pkvenv_main/fork.py" "$D" "$E" "$@"'
+
+
+def split_chunks(tree, count):
+    """Split the files of ``tree`` into at most ``count`` lists of similar total size."""
+    files = sorted(tree.iter_files(), key=lambda item: (-item[1].size, item[0]))
+    chunks = [[0, []] for _ in range(max(1, min(count, len(files))))]
+    for arcname, entry in files:
+        chunk = min(chunks, key=lambda item: item[0])  # 大文件优先放入当前最小的分块
+        chunk[0] += entry.size
+        chunk[1].append((arcname, entry))
+    return [sorted(items, key=lambda item: item[0]) for _, items in chunks]
+
+
+def _write_chunk(file, items, dirs=(), level=6, source_date_epoch=None):
+    def normalize(mtime):
+        return int(mtime if source_date_epoch is None else min(mtime, source_date_epoch))
+
+    with open(file, "wb") as f, \
+            gzip.GzipFile(filename="", fileobj=f, mode="wb", compresslevel=level, mtime=source_date_epoch or 0) as gz, \
+            tarfile.open(fileobj=gz, mode="w", format=tarfile.GNU_FORMAT) as tar:
+        for arcname in dirs:
+            info = tarfile.TarInfo(arcname)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = normalize(time.time())
+            tar.addfile(info)
+        for arcname, entry in items:
+            info = tarfile.TarInfo(arcname)
+            if entry.data is not None:
+                info.size, info.mtime, mode = len(entry.data), entry.mtime, 0o644
+            else:
+                st = os.stat(entry.path)
+                info.size, info.mtime, mode = st.st_size, st.st_mtime, st.st_mode
+            # 保留源文件的mtime, python按mtime检查__pycache__中的pyc是否过期
+            info.mtime = normalize(info.mtime)
+            info.mode = (entry.mode or mode) & 0o7777
+            if entry.data is not None:
+                tar.addfile(info, io.BytesIO(entry.data))
+            else:
+                with open(entry.path, "rb") as src:
+                    tar.addfile(info, src)
+
+
+def gen_onefile_stub(name, payload_hash, chunk_sizes, entry_points, site_packages, fork_server=False):
+    """Return the sh stub extracting the chunks (appended in this order) and running an entry point.
+
+    The offsets of the chunks depend on the length of the stub itself, render until it is stable.
+    """
+    dir_name = shlex.quote("%s-%s" % (name, payload_hash))
+    cases = "".join("    %s) E=%s ;;\n" % (shlex.quote(entry_point["name"]), shlex.quote(entry_point["name"]))
+                    for entry_point in entry_points)
+    length = 0
+    while True:
+        extract = ""
+        offset = length
+        for i, size in enumerate(chunk_sizes):
+            # tail从偏移处读取(对普通文件是seek), 各分块由单独的gzip进程同时解压
+            extract += "    tail -c +%d \"$0\" | head -c %d | tar -xzf - -C \"$T\" & P%d=$!\n" % (offset + 1, size, i)
+            offset += size
+        stub = (ONEFILE_STUB_TEMPLATE % {
+            "name": name,
+            "hash": payload_hash,
+            "cache_env": ONEFILE_CACHE_ENV,
+            "dir_name": dir_name,
+            "stamp": ONEFILE_STAMP_FILE,
+            "extract": extract,
+            "pids": " ".join("$P%d" % i for i in range(len(chunk_sizes))),
+            "site_packages": site_packages,
+            "cases": cases,
+            "default": shlex.quote(entry_points[0]["name"]),
+            "exec": (ONEFILE_FORK_EXEC if fork_server else ONEFILE_EXEC) % {"site_packages": site_packages},
+        }).encode("utf-8")
+        if len(stub) == length:
+            return stub
+        length = len(stub)
+
+
+def write_onefile(tree, output, name, entry_points, site_packages, fork_server=False, chunks=ONEFILE_CHUNKS,
+                  workers=None, level=6, source_date_epoch=None):
+    """Write the single-file executable of ``tree`` (a linux bundle) to ``output``."""
+    from .main import ROOT_DIR
+    # 不修改传入的tree, zip阶段同时在读取它
+    bundle = BundleTree()
+    bundle.update(tree)
+    bundle.add_file(site_packages + "/pkvenv_main/onefile.py", os.path.join(ROOT_DIR, "pkvenv_onefile.py"))
+    tmp_dir = tempfile.mkdtemp(prefix=".onefile-", dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        with span("onefile", file=os.path.basename(output)) as args:
+            groups = split_chunks(bundle, chunks)
+            files = [os.path.join(tmp_dir, "chunk%d.tar.gz" % i) for i in range(len(groups))]
+            with ThreadPoolExecutor(workers or os.cpu_count() or 1) as executor:
+                futures = [executor.submit(_write_chunk, file, items, sorted(bundle.dirs) if i == 0 else (),
+                                           level, source_date_epoch)
+                           for i, (file, items) in enumerate(zip(files, groups))]
+                for future in futures:
+                    future.result()
+            h = hashlib.sha256()
+            for file in files:
+                with open(file, "rb") as f:
+                    for block in iter(lambda: f.read(1 << 20), b""):
+                        h.update(block)
+            payload_hash = h.hexdigest()[:ONEFILE_HASH_LENGTH]
+            stub = gen_onefile_stub(name, payload_hash, [os.path.getsize(file) for file in files], entry_points,
+                                    site_packages, fork_server)
+            tmp_output = os.path.join(tmp_dir, os.path.basename(output))
+            with open(tmp_output, "wb") as f:
+                f.write(stub)
+                for file in files:
+                    with open(file, "rb") as src:
+                        shutil.copyfileobj(src, f, 1 << 20)
+            os.chmod(tmp_output, 0o755)
+            os.replace(tmp_output, output)
+            args.update(chunks=len(files), hash=payload_hash, bytes=os.path.getsize(output))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    report.set("onefile", **{os.path.basename(output): {"hash": payload_hash, "chunks": len(files),
+                                                        "bytes": args["bytes"]}})
+    print("Onefile: %s (%d chunks, %d bytes, payload %s)" % (output, len(files), args["bytes"], payload_hash))
+    return output
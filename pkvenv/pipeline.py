@@ -0,0 +1,122 @@
+import os
+import threading
+from .metrics import span
+
+# 每类资源同时运行的stage数
+DEFAULT_RESOURCE_LIMITS = {
+    "network": 2,
+    "disk": 2,
+    "cpu": os.cpu_count() or 1,
+}
+
+
+class Stage(object):
+    """One step of the build: ``func(**inputs)`` produces the values named in ``outputs``.
+
+    ``func`` returns a single value for one output, or a tuple matching ``outputs``.
+    ``resource`` is the kind of work the stage mostly does (network, disk or cpu).
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), resource="cpu"):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.resource = resource
+
+
+class Pipeline(object):
+    """Run a DAG of stages, starting each one as soon as its inputs are available.
+
+    Independent stages run concurrently in threads, limited per resource kind so that
+    e.g. downloads overlap with local work without oversubscribing the disk or CPUs.
+    """
+
+    def __init__(self, limits=None, callback=None):
+        self.stages = []
+        self.limits = dict(DEFAULT_RESOURCE_LIMITS, **(limits or {}))
+        # callback(event, stage_name), event: start/finish/error, 在stage所在的线程中调用
+        self.callback = callback
+        self.failed_stage = None
+
+    def add(self, name, func, inputs=(), outputs=(), resource="cpu"):
+        if resource not in self.limits:
+            raise ValueError("unknown resource `%s` of stage %s" % (resource, name))
+        self.stages.append(Stage(name, func, inputs, outputs, resource))
+
+    def _check(self, values):
+        producers = {}
+        for stage in self.stages:
+            for output in stage.outputs:
+                if output in producers or output in values:
+                    raise ValueError("`%s` is produced by more than one stage" % output)
+                producers[output] = stage.name
+        available = set(values)
+        pending = list(self.stages)
+        while pending:
+            ready = [stage for stage in pending if all(name in available for name in stage.inputs)]
+            if not ready:
+                missing = sorted(set(name for stage in pending for name in stage.inputs) - available)
+                raise ValueError("stages %s can never run, missing inputs: %s"
+                                 % (", ".join(stage.name for stage in pending), ", ".join(missing)))
+            for stage in ready:
+                available.update(stage.outputs)
+                pending.remove(stage)
+
+    def run(self, **values):
+        """Run all stages and return the dict of all values (initial ones and stage outputs)."""
+        self._check(values)
+        values = dict(values)
+        slots = dict((resource, limit) for resource, limit in self.limits.items())
+        pending = list(self.stages)
+        running = set()
+        errors = []
+        cond = threading.Condition()
+
+        def run_stage(stage):
+            try:
+                if self.callback:
+                    self.callback("start", stage.name)
+                with span(stage.name, cat="stage", resource=stage.resource):
+                    result = stage.func(**dict((name, values[name]) for name in stage.inputs))
+                if len(stage.outputs) == 1:
+                    result = (result,)
+                elif not stage.outputs:
+                    result = ()
+                outputs = dict(zip(stage.outputs, result))
+                if self.callback:
+                    self.callback("finish", stage.name)
+            except BaseException as e:
+                outputs = None
+                error = e
+                if self.callback:
+                    try:
+                        self.callback("error", stage.name)
+                    except Exception:
+                        pass
+            with cond:
+                if outputs is None:
+                    if not errors:
+                        self.failed_stage = stage.name
+                    errors.append(error)
+                else:
+                    values.update(outputs)
+                running.discard(stage)
+                slots[stage.resource] += 1
+                cond.notify_all()
+
+        with cond:
+            while pending or running:
+                if not errors:
+                    for stage in list(pending):
+                        if slots[stage.resource] > 0 and all(name in values for name in stage.inputs):
+                            pending.remove(stage)
+                            running.add(stage)
+                            slots[stage.resource] -= 1
+                            threading.Thread(target=run_stage, args=(stage,), name=stage.name, daemon=True).start()
+                elif not running:
+                    break  # 出错后不再启动新的stage, 等待正在运行的结束
+                cond.wait()
+        if errors:
+            raise errors[0]
+        return values
@@ -0,0 +1,404 @@
+# coding: utf-8
+# fork server模式的启动模块, 打包时拷贝为 site-packages/pkvenv_main/fork.py (只用于linux, 只依赖标准库).
+#
+# 客户端: 启动程序用 `python3 -I -S fork.py <bundle_root> <entry_point> [args...]` 运行, 不加载site,
+#   只导入C实现的模块(_socket, _signal, marshal), 启动只需要几毫秒.
+#   连接常驻的server, 把argv/环境变量/cwd和stdin/stdout/stderr的fd发给它, 转发信号并以子进程的退出码退出.
+#   server不存在时在后台启动一个, 本次直接运行程序.
+# server: `python3 -I -m pkvenv_main.fork --serve <bundle_root>`, 预先导入所有入口模块, 每个请求fork一个子进程运行入口.
+#   空闲超时后退出; 打包内容变化(fork_server.json中的hash不同)后不再处理请求并退出.
+#
+# 消息是4字节长度加marshal序列化的dict, 客户端和server使用同一个python.
+import os
+import sys
+import marshal
+import _socket
+
+CONFIG_FILE = "fork_server.json"
+NO_FORK_SERVER_ENV = "PKVENV_NO_FORK_SERVER"
+STALE_CHECK_INTERVAL = 5
+CHILD_MODULES = ("io", "runpy", "signal", "traceback", "threading", "atexit", "struct", "array")
+FORWARD_SIGNALS = ("SIGINT", "SIGTERM", "SIGHUP", "SIGQUIT", "SIGUSR1", "SIGUSR2", "SIGWINCH")
+# shell每次调用都会变化的环境变量, 不影响预先导入的模块
+VOLATILE_ENV = ("PWD", "OLDPWD", "SHLVL", "_", "COLUMNS", "LINES")
+
+
+def get_socket_path(bundle_root):
+    # 只有当前用户可以访问的目录, 请求中包含环境变量和终端的fd. 每个安装目录一个server
+    uid = os.getuid()
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    path = runtime_dir if runtime_dir and os.path.isdir(runtime_dir) else "/tmp/pkvenv-%d" % uid
+    if not os.path.isdir(path):
+        os.mkdir(path, 0o700)
+    st = os.lstat(path)
+    if st.st_uid != uid or st.st_mode & 0o077 or os.path.islink(path):
+        raise OSError("unsafe socket dir %s" % path)
+    st = os.stat(bundle_root)
+    return os.path.join(path, "pkvenv-fork-%x-%x.sock" % (st.st_dev, st.st_ino))
+
+
+def send_message(sock, message):
+    data = marshal.dumps(message)
+    sock.sendall(len(data).to_bytes(4, "big") + data)
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def recv_message(sock):
+    size = recv_exactly(sock, 4)
+    data = recv_exactly(sock, int.from_bytes(size, "big")) if size else None
+    return marshal.loads(data) if data is not None else None
+
+
+def run_direct(name, args):
+    # 不使用server, 与普通的启动程序相同
+    python = sys.executable
+    env = dict(os.environ, PKVENV_ENTRY_POINT=name)
+    os.execve(python, [python, "-m", "pkvenv_main"] + args, env)
+
+
+def spawn_server(bundle_root):
+    # 两次fork脱离当前进程, server不持有调用者的stdio (否则通过管道读取输出的脚本会一直等待)
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        null = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(null, fd)
+        os.chdir("/")
+        os.execv(sys.executable, [sys.executable, "-I", "-m", "pkvenv_main.fork", "--serve", bundle_root])
+    finally:
+        os._exit(1)
+
+
+def client_main(argv):
+    import _signal  # signal模块会导入enum, 启动慢
+    bundle_root, name, args = argv[0], argv[1], argv[2:]
+    if os.environ.get(NO_FORK_SERVER_ENV):
+        run_direct(name, args)
+    try:
+        path = get_socket_path(bundle_root)
+    except OSError:
+        run_direct(name, args)
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        spawn_server(bundle_root)
+        run_direct(name, args)
+
+    fds = b"".join(fd.to_bytes(4, sys.byteorder) for fd in (0, 1, 2))
+    request = {"name": name, "argv": args, "cwd": os.getcwd(), "env": dict(os.environ)}
+    try:
+        sock.sendmsg([b"\0"], [(_socket.SOL_SOCKET, _socket.SCM_RIGHTS, fds)])
+        send_message(sock, request)
+    except OSError:
+        sock.close()  # server正在退出, 或者stdio中有已关闭的fd
+        run_direct(name, args)
+    child = []
+
+    def forward(signum, frame):
+        # 子进程是单独的进程组, 与终端的前台进程组一样把信号发给整个组
+        if child:
+            try:
+                os.killpg(child[0], signum)
+            except OSError:
+                pass
+
+    for signame in FORWARD_SIGNALS:
+        if hasattr(_signal, signame):
+            _signal.signal(getattr(_signal, signame), forward)
+    while True:
+        message = recv_message(sock)
+        if message is None or "stale" in message:
+            break
+        if "pid" in message:
+            child.append(message["pid"])
+        elif "exit" in message:
+            sys.exit(message["exit"])
+        elif "signal" in message:
+            # 子进程被信号结束, 用相同的信号结束自己
+            _signal.signal(message["signal"], _signal.SIG_DFL)
+            os.kill(os.getpid(), message["signal"])
+            sys.exit(128 + message["signal"])
+    if child:
+        sys.stderr.write("pkvenv: the fork server exited while running the command\n")
+        sys.exit(1)
+    # server已经过期(打包被更新), 启动新的server并直接运行
+    sock.close()
+    spawn_server(bundle_root)
+    run_direct(name, args)
+
+
+def get_import_env(env):
+    """The environment seen by the entry modules pre-imported in the server."""
+    return dict((key, value) for key, value in env.items() if key not in VOLATILE_ENV)
+
+
+def load_config():
+    import json
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), CONFIG_FILE), "r") as f:
+        return json.load(f)
+
+
+class ForkServer(object):
+    """Pre-import the entry points of the bundle and fork a child for each request."""
+
+    def __init__(self, bundle_root):
+        self.bundle_root = bundle_root
+        self.config = load_config()
+        self.path = get_socket_path(bundle_root)
+        self.idle_timeout = self.config.get("idle_timeout") or 0
+        self.children = {}  # pid -> connection
+        self.orphans = set()  # 客户端已经断开的子进程
+        self.lock_file = None
+        self.wakeup = ()
+        self.stale_conn = None
+        self.import_env = None  # 预先导入入口模块时的环境变量(第一个客户端的)
+
+    def is_stale(self):
+        try:
+            return load_config()["hash"] != self.config["hash"]
+        except (OSError, ValueError, KeyError):
+            return True
+
+    def run_child(self, conn, fds, request):
+        import io
+        import runpy
+        import signal
+        import traceback
+        os.setpgid(0, 0)
+        # 不保留server的socket, 锁和其他客户端的连接
+        signal.set_wakeup_fd(-1)
+        for fd in self.wakeup:
+            os.close(fd)
+        self.lock_file.close()
+        for other in self.children.values():
+            other.close()
+        for signame in FORWARD_SIGNALS + ("SIGCHLD",):
+            if hasattr(signal, signame):
+                signal.signal(getattr(signal, signame), signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for fd, target in zip(fds, (0, 1, 2)):
+            os.dup2(fd, target)
+            os.close(fd)
+        conn.close()
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        # server的stdio是/dev/null, 按客户端的fd重新创建, 终端上的stdout按行缓冲
+        encoding = sys.stdout.encoding
+        sys.stdin = sys.__stdin__ = io.TextIOWrapper(io.open(0, "rb", closefd=False), encoding)
+        sys.stdout = sys.__stdout__ = io.TextIOWrapper(io.open(1, "wb", closefd=False), encoding,
+                                                       line_buffering=os.isatty(1))
+        sys.stderr = sys.__stderr__ = io.TextIOWrapper(io.open(2, "wb", closefd=False), encoding, "backslashreplace",
+                                                       line_buffering=True)
+        sys.argv = [sys.argv[0]] + request["argv"]
+        entry_points = self.config["entry_points"]
+        module = entry_points.get(request["name"].lower(), entry_points[self.config["default"]])
+        # 入口模块重新执行, 它导入的app模块已经在server中导入
+        sys.modules.pop(module, None)
+        code = 0
+        kill_signal = None
+        try:
+            runpy.run_module(module, run_name="__main__", alter_sys=True)
+        except SystemExit as e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code, int):
+                code = e.code
+            else:
+                sys.stderr.write("%s\n" % e.code)
+                code = 1
+        except KeyboardInterrupt:
+            traceback.print_exc()
+            kill_signal = signal.SIGINT
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        # 与解释器正常退出相同: 等待非daemon线程, 执行atexit, 刷新输出
+        import threading
+        if hasattr(threading, "_shutdown"):
+            threading._shutdown()
+        import atexit
+        atexit._run_exitfuncs()
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        if kill_signal is not None:
+            # 与python相同, 被Ctrl+C中断时以SIGINT结束
+            signal.signal(kill_signal, signal.SIG_DFL)
+            os.kill(os.getpid(), kill_signal)
+        os._exit(code & 0xff)
+
+    def accept(self, server):
+        import socket
+        import struct
+        from array import array
+        conn, _ = server.accept()
+        conn.setblocking(True)
+        # 只处理当前用户的请求
+        _, uid, _ = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+        if uid != os.getuid():
+            conn.close()
+            return True
+        if self.is_stale():
+            self.stale_conn = conn  # 释放socket和锁之后再回复, 客户端可以立即启动新的server
+            return False
+        fds = array("i")
+        _, ancdata, _, _ = conn.recvmsg(1, socket.CMSG_SPACE(3 * fds.itemsize))
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+        try:
+            request = recv_message(conn)
+        except (OSError, ValueError, EOFError):
+            request = None
+        stale = request is not None and get_import_env(request["env"]) != self.import_env
+        if request is None or len(fds) != 3 or stale:
+            for fd in fds:
+                os.close(fd)
+            if stale:
+                # 入口模块在其他环境变量下导入(导入时可能读取了配置): 由按这次的环境启动的新server处理
+                self.stale_conn = conn
+                return False
+            conn.close()
+            return True
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.close()
+                self.run_child(conn, list(fds), request)
+            except BaseException:
+                import traceback
+                os.write(2, traceback.format_exc().encode("utf-8", "replace"))
+            finally:
+                os._exit(1)
+        for fd in fds:
+            os.close(fd)
+        self.children[pid] = conn
+        try:
+            send_message(conn, {"pid": pid})
+        except OSError:
+            pass
+        return True
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            conn = self.children.pop(pid, None)
+            self.orphans.discard(pid)
+            if conn is None:
+                continue
+            if os.WIFSIGNALED(status):
+                message = {"signal": os.WTERMSIG(status)}
+            else:
+                message = {"exit": os.WEXITSTATUS(status)}
+            try:
+                send_message(conn, message)
+            except OSError:
+                pass
+            conn.close()
+
+    def serve(self):
+        import time
+        import fcntl
+        import select
+        import signal
+        import socket
+        import importlib
+        # 同时启动的多个server只保留一个
+        self.lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+        # 子进程用到的模块也预先导入, fork之后不需要再加载. 导入时的cwd为 "/", 环境变量为启动server的客户端的,
+        # 环境变量不同的请求当作过期处理
+        self.import_env = get_import_env(os.environ)
+        for module in CHILD_MODULES + tuple(sorted(set(self.config["entry_points"].values()))):
+            importlib.import_module(module)
+        # SIGCHLD唤醒select, 子进程结束后立即返回退出码
+        self.wakeup = wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # 退出时删除socket
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o600)
+        server.listen(64)
+        last_active = time.time()
+        try:
+            while True:
+                clients = [conn for pid, conn in self.children.items() if pid not in self.orphans]
+                readable, _, _ = select.select([server, wakeup_r] + clients, [], [], STALE_CHECK_INTERVAL)
+                if wakeup_r in readable:
+                    try:
+                        os.read(wakeup_r, 512)
+                    except BlockingIOError:
+                        pass
+                for pid, conn in list(self.children.items()):
+                    if conn in readable and pid not in self.orphans:
+                        # 客户端在子进程结束前退出(例如被kill -9), 结束子进程
+                        self.orphans.add(pid)
+                        try:
+                            os.killpg(pid, signal.SIGTERM)
+                        except OSError:
+                            pass
+                self.reap()
+                if server in readable:
+                    if not self.accept(server):
+                        break
+                    last_active = time.time()
+                elif not self.children:
+                    if self.idle_timeout and time.time() - last_active > self.idle_timeout:
+                        break
+                    if not readable and self.is_stale():
+                        break  # 打包已经更新, 下一次启动时使用新的server
+                if self.children:
+                    last_active = time.time()
+        finally:
+            server.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.lock_file.close()
+        if self.stale_conn is not None:
+            send_message(self.stale_conn, {"stale": True})
+            self.stale_conn.close()
+        while self.children:
+            pid, _ = os.waitpid(-1, 0)
+            self.children.pop(pid, None)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--serve"]:
+        ForkServer(sys.argv[2]).serve()
+    else:
+        client_main(sys.argv[1:])
@@ -0,0 +1,257 @@
+# coding: utf-8
+# 导入归档的importer, 打包时拷贝为 site-packages/pkvenv_main/importer.py (只依赖标准库).
+# site初始化时由 site-packages/_pkvenv_importer.pth 导入, 把 site-packages/pkvenv.pka 映射到内存并安装finder.
+#
+# 归档格式: 8字节MAGIC, 索引的偏移和长度(各8字节, little endian), 各文件的原始数据, marshal序列化的索引:
+#   {"magic": 预编译代码的pyc magic, "modules": {模块名: (is_package, 路径, 源码偏移, 长度, 代码偏移, 长度)},
+#    "files": {路径: (偏移, 长度)}}
+# 偏移为-1表示没有源码(没有__init__.py的目录)或没有预编译的代码(运行时编译源码).
+# 模块的code object直接从mmap中反序列化, 不复制数据; 资源文件通过 importlib.resources 读取.
+import io
+import os
+import sys
+import mmap
+import marshal
+import _imp
+# 与 importlib.machinery 中的相同, 避免在site初始化时导入 importlib 包(及warnings)
+from _frozen_importlib import ModuleSpec
+import _frozen_importlib_external
+from _frozen_importlib_external import PathFinder
+
+ARCHIVE_NAME = "pkvenv.pka"
+ARCHIVE_MAGIC = b"PKVENVA\x01"
+
+
+class Archive(object):
+    """The memory-mapped archive; ``view`` slices share the mapped pages without copying."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        if self.view[:8] != ARCHIVE_MAGIC:
+            raise ImportError("%s is not a pkvenv archive" % path)
+        index_offset = int.from_bytes(self.view[8:16], "little")
+        index_size = int.from_bytes(self.view[16:24], "little")
+        index = marshal.loads(self.view[index_offset:index_offset + index_size])
+        self.modules = index["modules"]
+        self.files = index["files"]
+        # 只有同一个python版本编译的代码可以使用, 否则从源码编译
+        self.code_valid = index["magic"] == _frozen_importlib_external.MAGIC_NUMBER
+        self._children = None
+
+    @property
+    def children(self):
+        """{dir: sorted names of its files and dirs}, built on the first use of the resources."""
+        if self._children is None:
+            children = {"": set()}
+            for name in self.files:
+                while True:
+                    parent, _, child = name.rpartition("/")
+                    if parent in children:
+                        children[parent].add(child)
+                        break
+                    children[parent] = set([child])
+                    name = parent
+            self._children = dict((name, sorted(names)) for name, names in children.items())
+        return self._children
+
+    def get_path(self, relpath):
+        return os.path.join(self.path, *relpath.split("/"))
+
+    def get_relpath(self, path):
+        prefix = os.path.join(self.path, "")
+        if not path.startswith(prefix):
+            return None
+        return path[len(prefix):].replace(os.sep, "/")
+
+    def read(self, relpath):
+        offset, size = self.files[relpath]
+        return bytes(self.view[offset:offset + size])
+
+
+class ArchivePath(object):
+    """Traversable (``importlib.resources.abc.Traversable``) of a file or dir in the archive."""
+
+    def __init__(self, archive, at):
+        self.archive = archive
+        self.at = at
+
+    @property
+    def name(self):
+        return self.at.rsplit("/", 1)[-1]
+
+    def __repr__(self):
+        return "ArchivePath(%r)" % self.archive.get_path(self.at)
+
+    def is_file(self):
+        return self.at in self.archive.files
+
+    def is_dir(self):
+        return self.at in self.archive.children
+
+    def exists(self):
+        return self.is_file() or self.is_dir()
+
+    def iterdir(self):
+        prefix = self.at + "/" if self.at else ""
+        return iter([ArchivePath(self.archive, prefix + name) for name in self.archive.children.get(self.at, [])])
+
+    def joinpath(self, *descendants):
+        parts = [self.at] if self.at else []
+        for descendant in descendants:
+            parts.extend(part for part in str(descendant).replace("\\", "/").split("/") if part)
+        return ArchivePath(self.archive, "/".join(parts))
+
+    __truediv__ = joinpath
+
+    def read_bytes(self):
+        if not self.is_file():
+            raise FileNotFoundError(self.archive.get_path(self.at))
+        return self.archive.read(self.at)
+
+    def read_text(self, encoding=None, errors=None):
+        return self.read_bytes().decode(encoding or "utf-8", errors or "strict")
+
+    def open(self, mode="r", *args, **kwargs):
+        stream = io.BytesIO(self.read_bytes())
+        return stream if "b" in mode else io.TextIOWrapper(stream, *args, **kwargs)
+
+
+class ArchiveResourceReader(object):
+    """Resource reader of a package in the archive, used by ``importlib.resources``."""
+
+    def __init__(self, archive, package_dir):
+        self.path = ArchivePath(archive, package_dir)
+
+    def files(self):
+        return self.path
+
+    # python < 3.9 的 importlib.resources 使用以下接口
+    def open_resource(self, resource):
+        return self.path.joinpath(resource).open("rb")
+
+    def resource_path(self, resource):
+        raise FileNotFoundError(resource)  # 不在文件系统中, importlib.resources.path 会复制到临时文件
+
+    def is_resource(self, name):
+        return self.path.joinpath(name).is_file()
+
+    def contents(self):
+        return [path.name for path in self.path.iterdir()]
+
+
+class ArchiveLoader(object):
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.names = {}  # 以其他名字导入的模块: 导入的名字 -> 归档中的名字
+
+    def _entry(self, fullname):
+        return self.archive.modules[self.names.get(fullname, fullname)]
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        code = self.get_code(module.__spec__.name)
+        if code is not None:
+            exec(code, module.__dict__)
+
+    def is_package(self, fullname):
+        return self._entry(fullname)[0]
+
+    def get_filename(self, fullname):
+        return self.archive.get_path(self._entry(fullname)[1])
+
+    def get_code(self, fullname):
+        _, relpath, source_offset, source_size, code_offset, code_size = self._entry(fullname)
+        path = self.archive.get_path(relpath)
+        if code_offset >= 0 and self.archive.code_valid:
+            code = marshal.loads(self.archive.view[code_offset:code_offset + code_size])
+            _imp._fix_co_filename(code, path)  # 预编译时记录的是构建机器上的路径
+            return code
+        if source_offset < 0:
+            return None
+        return compile(bytes(self.archive.view[source_offset:source_offset + source_size]), path, "exec",
+                       dont_inherit=True)
+
+    def get_source(self, fullname):
+        _, _, source_offset, source_size, _, _ = self._entry(fullname)
+        if source_offset < 0:
+            return None
+        return _frozen_importlib_external.decode_source(
+            bytes(self.archive.view[source_offset:source_offset + source_size]))
+
+    def get_data(self, path):
+        # pkgutil.get_data 用 __file__ 所在目录拼接出路径
+        relpath = self.archive.get_relpath(path)
+        if relpath is None:
+            with open(path, "rb") as f:
+                return f.read()
+        if relpath not in self.archive.files:
+            raise FileNotFoundError(path)
+        return self.archive.read(relpath)
+
+    def get_resource_reader(self, fullname):
+        is_package, relpath = self._entry(fullname)[:2]
+        if not is_package:
+            return None
+        return ArchiveResourceReader(self.archive, relpath.rsplit("/", 1)[0] if relpath.endswith(".py") else relpath)
+
+
+class ArchiveFinder(object):
+    """Meta path finder of the modules in the archive."""
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.loader = ArchiveLoader(archive)
+
+    def _find_in_path(self, fullname, path):
+        # 子模块在父包的__path__中查找: 父包可能以其他名字导入,
+        # 例如 _distutils_hack 把归档中的 setuptools._distutils 作为 distutils 导入
+        tail = fullname.rpartition(".")[2]
+        for entry in path:
+            relpath = self.archive.get_relpath(entry) if isinstance(entry, str) else None
+            if relpath is None:
+                continue
+            name = (relpath.replace("/", ".") + "." if relpath else "") + tail
+            if name in self.archive.modules:
+                return name
+        return None
+
+    def find_spec(self, fullname, path=None, target=None):
+        name = fullname if path is None else self._find_in_path(fullname, path)
+        entry = self.archive.modules.get(name) if name is not None else None
+        if entry is None:
+            return None
+        if name != fullname:
+            self.loader.names[fullname] = name
+        is_package, relpath, source_offset = entry[:3]
+        if source_offset < 0:
+            # 没有__init__.py的目录
+            spec = ModuleSpec(fullname, self.loader, is_package=True)
+            spec.submodule_search_locations = [self.archive.get_path(relpath)]
+            return spec
+        spec = ModuleSpec(fullname, self.loader, origin=self.archive.get_path(relpath), is_package=is_package)
+        spec.has_location = True
+        if is_package:
+            spec.submodule_search_locations = [self.archive.get_path(relpath.rsplit("/", 1)[0])]
+        return spec
+
+    def invalidate_caches(self):
+        pass
+
+
+def install(path=None):
+    path = path or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ARCHIVE_NAME)
+    if not os.path.isfile(path) or any(isinstance(finder, ArchiveFinder) for finder in sys.meta_path):
+        return
+    finder = ArchiveFinder(Archive(path))
+    # 放在PathFinder之前: 归档中的模块优先于文件系统
+    index = sys.meta_path.index(PathFinder) if PathFinder in sys.meta_path else len(sys.meta_path)
+    sys.meta_path.insert(index, finder)
+
+
+install()
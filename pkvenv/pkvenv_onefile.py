@@ -0,0 +1,88 @@
+# coding: utf-8
+# 单文件包的安装模块, 打包时拷贝为 site-packages/pkvenv_main/onefile.py (只用于linux, 只依赖标准库).
+#
+# 启动脚本第一次运行时把payload的各个分块并发解压到缓存目录下的临时目录, 然后用解压出的python运行
+#   `python3 -I -S onefile.py <tmp_dir> <install_dir>`: 写入stamp文件后把临时目录原子地重命名为
+#   `<cache>/<name>-<hash>`, 再删除同一个程序的旧版本和中断的解压留下的临时目录.
+# 多个进程同时第一次运行时各自解压, 只有一个重命名成功, 其他进程删除自己的临时目录后使用它.
+import os
+import sys
+import time
+import shutil
+
+STAMP_FILE = ".pkvenv-onefile"
+KEEP_ENV = "PKVENV_ONEFILE_KEEP"
+HASH_LENGTH = 16
+STALE_TMP_SECONDS = 3600
+
+
+def _is_hash(value):
+    return len(value) == HASH_LENGTH and all(c in "0123456789abcdef" for c in value)
+
+
+def remove_version(path):
+    # 先删除stamp, 删除到一半时启动脚本会重新解压而不是运行不完整的目录
+    try:
+        os.remove(os.path.join(path, STAMP_FILE))
+    except OSError:
+        pass
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def install(tmp_dir, install_dir):
+    payload_hash = os.path.basename(install_dir)[-HASH_LENGTH:]
+    with open(os.path.join(tmp_dir, STAMP_FILE), "w") as f:
+        f.write(payload_hash)
+    for _ in range(3):
+        try:
+            os.rename(tmp_dir, install_dir)  # 目标目录不为空时失败, 不会覆盖正在使用的版本
+            return
+        except OSError:
+            if os.path.isfile(os.path.join(install_dir, STAMP_FILE)):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+            if os.path.isdir(install_dir):
+                remove_version(install_dir)  # 没有stamp的不完整目录
+    raise OSError("can not rename %s to %s" % (tmp_dir, install_dir))
+
+
+def prune(install_dir, keep):
+    """Remove the versions of the same program except the current one and ``keep`` newer others."""
+    cache_dir, current = os.path.split(install_dir)
+    name = current[:-HASH_LENGTH - 1]
+    versions = []
+    now = time.time()
+    for item in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, item)
+        if item.startswith("." + name + "-") and _is_hash(item[len(name) + 2:].split(".")[0]):
+            # `.<name>-<hash>.XXXXXX`: 被中断的解压, 正在解压的目录不会这么旧
+            try:
+                if now - os.stat(path).st_mtime > STALE_TMP_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+        elif item != current and item.startswith(name + "-") and _is_hash(item[len(name) + 1:]):
+            try:
+                versions.append((os.stat(os.path.join(path, STAMP_FILE)).st_mtime, path))
+            except OSError:
+                remove_version(path)
+    # 刚被替换的版本可能仍在运行, 默认保留最近的一个旧版本
+    for _, path in sorted(versions, reverse=True)[keep:]:
+        remove_version(path)
+
+
+def main(argv):
+    tmp_dir, install_dir = [os.path.abspath(path) for path in argv[:2]]
+    install(tmp_dir, install_dir)
+    try:
+        keep = int(os.environ.get(KEEP_ENV, "1"))
+    except ValueError:
+        keep = 1
+    try:
+        prune(install_dir, max(keep, 0))
+    except OSError as e:
+        sys.stderr.write("pkvenv: can not remove old versions: %s\n" % e)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
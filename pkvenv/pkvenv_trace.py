@@ -0,0 +1,82 @@
+# coding: utf-8
+# 运行时追踪模块, 由 `pkvenv trace` 临时拷贝到打包目录的 site-packages 中, 用打包内的python运行.
+# 只依赖标准库.
+#
+# usage: python -m pkvenv_trace <trace_file> <bundle_root> [-m module | script] [args...]
+import os
+import sys
+import json
+import atexit
+import runpy
+
+_files = set()
+
+
+def _record(path):
+    if isinstance(path, bytes):
+        path = os.fsdecode(path)
+    if isinstance(path, str):
+        _files.add(os.path.abspath(path))
+
+
+def _audit_hook(event, args):
+    if event == "open" or event == "ctypes.dlopen":
+        if args:
+            _record(args[0])
+
+
+def _install_open_hook():
+    # python < 3.8 没有 sys.addaudithook, 退化为替换 open
+    import builtins
+    import io
+    origin_open = builtins.open
+
+    def traced_open(file, *args, **kwargs):
+        _record(file)
+        return origin_open(file, *args, **kwargs)
+
+    builtins.open = traced_open
+    io.open = traced_open
+
+
+def _write_trace(trace_file, bundle_root):
+    for module in list(sys.modules.values()):
+        filename = getattr(module, "__file__", None)
+        if filename:
+            _record(filename)
+    bundle_root = os.path.abspath(bundle_root)
+    files = set()
+    for path in _files:
+        if path.startswith(bundle_root + os.sep):
+            files.add(os.path.relpath(path, bundle_root).replace(os.sep, "/"))
+    with open(trace_file, "w") as f:
+        json.dump({"files": sorted(files)}, f, indent=1)
+
+
+def main():
+    if len(sys.argv) < 3:
+        sys.stderr.write("usage: python -m pkvenv_trace <trace_file> <bundle_root> [-m module | script] [args...]\n")
+        sys.exit(2)
+    trace_file = sys.argv[1]
+    bundle_root = sys.argv[2]
+    target = sys.argv[3:] or ["-m", "pkvenv_main"]
+
+    atexit.register(_write_trace, trace_file, bundle_root)
+    if hasattr(sys, "addaudithook"):
+        sys.addaudithook(_audit_hook)
+    else:
+        _install_open_hook()
+
+    if target[0] == "-m":
+        if len(target) < 2:
+            sys.stderr.write("pkvenv_trace: -m requires a module name\n")
+            sys.exit(2)
+        sys.argv = [target[1]] + target[2:]
+        runpy.run_module(target[1], run_name="__main__", alter_sys=True)
+    else:
+        sys.argv = target
+        runpy.run_path(target[0], run_name="__main__")
+
+
+if __name__ == "__main__":
+    main()
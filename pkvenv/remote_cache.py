@@ -0,0 +1,193 @@
+import os
+import re
+import shutil
+import hashlib
+import posixpath
+import platform
+import tempfile
+import threading
+from .metrics import span, report
+
+# 共享的远程缓存: 目录(NFS等)或者 http(s)://, 例如 `pkvenv cache-server` 或支持PUT的WebDAV
+REMOTE_CACHE_ENV = "PKVENV_REMOTE_CACHE"
+# 设置为0时只读, 不上传本地生成的layer (例如不受信任的PR构建)
+REMOTE_CACHE_UPLOAD_ENV = "PKVENV_REMOTE_CACHE_UPLOAD"
+
+
+def check_key(key):
+    # key为 `layers/runtime-<sha256>.sha256` 形式的相对路径
+    parts = key.split("/")
+    if not key or any(part in ("", ".", "..") or "\\" in part for part in parts):
+        raise ValueError("invalid remote cache key: %s" % key)
+    return parts
+
+
+class DirectoryCache(object):
+    """Artifacts stored as files in a directory shared by the build agents (eg: an NFS mount)."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def __str__(self):
+        return self.path
+
+    def get(self, key, output):
+        """Copy the artifact ``key`` to ``output``, return False if it is not in the cache."""
+        path = os.path.join(self.path, *check_key(key))
+        try:
+            shutil.copyfile(path, output)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, file):
+        path = os.path.join(self.path, *check_key(key))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再重命名, 其他agent不会读到写了一半的文件
+        tmp_path = "%s.tmp-%s-%d" % (path, platform.node(), os.getpid())
+        shutil.copyfile(file, tmp_path)
+        os.replace(tmp_path, path)
+
+
+class HttpCache(object):
+    """Artifacts stored with `GET/PUT <url>/<key>`, basic auth can be given in the url."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def __str__(self):
+        return self.url
+
+    def get(self, key, output):
+        from .main import get_session  # main导入了这个模块
+        req = get_session().get("%s/%s" % (self.url, "/".join(check_key(key))), stream=True)
+        if req.status_code == 404:
+            return False
+        req.raise_for_status()
+        with open(output, "wb") as f:
+            for chunk in req.iter_content(chunk_size=1 << 16):
+                if chunk:
+                    f.write(chunk)
+        return True
+
+    def put(self, key, file):
+        from .main import get_session
+        with open(file, "rb") as f:
+            req = get_session().put("%s/%s" % (self.url, "/".join(check_key(key))), data=f)
+        req.raise_for_status()
+
+
+def get_remote_cache():
+    """Return the backend configured with $PKVENV_REMOTE_CACHE, or None."""
+    location = os.environ.get(REMOTE_CACHE_ENV)
+    if not location:
+        return None
+    if location.startswith(("http://", "https://")):
+        return HttpCache(location)
+    return DirectoryCache(location)
+
+
+def is_upload_enabled():
+    return os.environ.get(REMOTE_CACHE_UPLOAD_ENV, "1") not in ("0", "false", "no")
+
+
+def _get(cache, key, output):
+    with span("remote cache get", key=key) as args:
+        try:
+            hit = cache.get(key, output)
+        except Exception as e:
+            print("[Warning] remote cache %s: can not get %s: %s" % (cache, key, e))
+            hit = False
+        args["hit"] = hit
+        if hit:
+            args["bytes"] = os.path.getsize(output)
+            report.add_download("remote:" + key, args["bytes"])
+    return hit
+
+
+def _file_sha256(file):
+    h = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def content_key(key, digest):
+    # 内容寻址: key(输入的hash)对应的文件只保存内容的sha256, 内容保存在 `<dir>/sha256-<内容的sha256>`
+    return posixpath.join(posixpath.dirname(key), "sha256-" + digest)
+
+
+def fetch(cache, key, output):
+    """Download ``key`` to ``output``; a failing remote cache is a miss, never a build error.
+
+    Raises ValueError if the downloaded content does not match the sha256 recorded for ``key``.
+    """
+    digest_file = output + ".sha256"
+    try:
+        hit = _get(cache, key, digest_file)
+        if hit:
+            with open(digest_file, "rb") as f:
+                digest = f.read(100).strip().decode("ascii", "replace")
+    finally:
+        if os.path.exists(digest_file):
+            os.remove(digest_file)
+    if hit and not re.match(r"^[0-9a-f]{64}$", digest):
+        raise ValueError("invalid sha256 in %s" % key)
+    hit = hit and _get(cache, content_key(key, digest), output)
+    report.add_cache("remote", hit)
+    if hit and _file_sha256(output) != digest:
+        raise ValueError("sha256 of %s does not match" % key)
+    return hit
+
+
+def put(cache, key, file):
+    """Upload the content first, then ``key`` pointing to it, other agents never fetch a missing content."""
+    digest = _file_sha256(file)
+    cache.put(content_key(key, digest), file)
+    digest_file = file + ".sha256"
+    with open(digest_file, "w") as f:
+        f.write(digest)
+    try:
+        cache.put(key, digest_file)
+    finally:
+        os.remove(digest_file)
+
+
+_uploads = []
+_uploads_lock = threading.Lock()
+
+
+def upload_async(cache, key, pack):
+    """Upload the artifact written by ``pack(file)`` in a background thread.
+
+    The build goes on meanwhile; :func:`wait_for_uploads` waits for the pending uploads.
+    """
+    def run():
+        tmp_dir = tempfile.mkdtemp(prefix="pkvenv-upload-")
+        try:
+            file = os.path.join(tmp_dir, "artifact")
+            pack(file)
+            put(cache, key, file)
+            print("Uploaded %s to remote cache %s (%d bytes)" % (key, cache, os.path.getsize(file)))
+        except Exception as e:
+            print("[Warning] remote cache %s: can not upload %s: %s" % (cache, key, e))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    thread = threading.Thread(target=run, name="upload %s" % key)
+    with _uploads_lock:
+        _uploads.append(thread)
+    thread.start()
+    return thread
+
+
+def wait_for_uploads():
+    with _uploads_lock:
+        threads = list(_uploads)
+        del _uploads[:]
+    pending = [thread for thread in threads if thread.is_alive()]
+    if pending:
+        print("Waiting for %d remote cache uploads" % len(pending))
+    for thread in threads:
+        thread.join()
@@ -0,0 +1,175 @@
+import re
+import json
+import zipfile
+import posixpath
+from .strip import normalize_dist_name
+
+SITE_PACKAGES_RE = re.compile(r"^Python/(Lib|lib/python3\.\d+)/site-packages/")
+SIZE_UNITS = {"": 1, "B": 1, "KB": 1 << 10, "MB": 1 << 20, "GB": 1 << 30}
+
+
+def parse_size(value):
+    # 1048576, "1048576", "300KB", "1.5 MB"
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.match(r"^\s*([\d.]+)\s*([KMG]?B?)\s*$", str(value), re.I)
+    if not match:
+        raise ValueError("invalid size `%s`" % value)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def format_size(size):
+    for unit in ("GB", "MB", "KB"):
+        if size >= SIZE_UNITS[unit]:
+            return "%.2f %s" % (size / SIZE_UNITS[unit], unit)
+    return "%d B" % size
+
+
+def _get_record_owners(names, read, site_packages):
+    """Return {arcname: distribution} from the dist-info RECORD files of the bundle."""
+    owners = {}
+    for name in names:
+        if not (name.startswith(site_packages) and name.endswith(".dist-info/RECORD")):
+            continue
+        dist_info = name[len(site_packages):].split("/")[0]
+        dist = normalize_dist_name(dist_info[:-len(".dist-info")].split("-")[0])
+        for line in read(name).decode("utf-8", "replace").splitlines():
+            path = line.rsplit(",", 2)[0].strip().strip('"')
+            if path:
+                owners[posixpath.normpath(posixpath.join(site_packages, path))] = dist
+        owners[site_packages + dist_info] = dist
+    return owners
+
+
+def _get_group(arcname, site_packages, owners):
+    # 返回 (分类, 分组)
+    if site_packages and arcname.startswith(site_packages):
+        path = arcname[len(site_packages):]
+        top = path.split("/")[0]
+        if top == "pkvenv_package":
+            parts = path.split("/")
+            return "pkvenv_package", parts[1] if len(parts) > 2 else "(files)"
+        if top == "pkvenv_main":
+            return "pkvenv_main", "pkvenv_main"
+        if arcname in owners:
+            return "distributions", owners[arcname]
+        if top.endswith(".dist-info"):
+            return "distributions", owners.get(site_packages + top, top)
+        return "site-packages (no RECORD)", top.split(".")[0]
+    if arcname.startswith("Python/"):
+        # 按前三级路径分组, 例如 python39.zip, DLLs/_ssl.pyd, lib/python3.11/encodings
+        return "runtime", "/".join(arcname[len("Python/"):].split("/")[:3])
+    return "launchers", posixpath.basename(arcname)
+
+
+def _analyze(name, files, read):
+    """Group ``files`` [(arcname, raw bytes, compressed bytes)] into the size tree."""
+    root = {"name": name, "size": 0, "compressed": 0, "children": {}}
+    names = [arcname for arcname, _, _ in files]
+    site_packages = None
+    for arcname in names:
+        match = SITE_PACKAGES_RE.match(arcname)
+        if match:
+            site_packages = match.group(0)
+            break
+    owners = _get_record_owners(names, read, site_packages) if site_packages else {}
+    for arcname, size, compressed in files:
+        category, group = _get_group(arcname, site_packages, owners)
+        node = root
+        for key in (category, group):
+            node["size"] += size
+            node["compressed"] += compressed
+            node = node["children"].setdefault(key, {"name": key, "size": 0, "compressed": 0, "children": {}})
+        node["size"] += size
+        node["compressed"] += compressed
+        node["children"][arcname] = {"name": arcname, "size": size, "compressed": compressed}
+    return root
+
+
+def analyze_zip(zip_file):
+    """Return the size tree of a bundle zip: category -> group -> files, with raw and compressed bytes."""
+    with zipfile.ZipFile(zip_file) as zf:
+        files = [(info.filename, info.file_size, info.compress_size) for info in zf.infolist() if not info.is_dir()]
+        return _analyze(zip_file, files, zf.read)
+
+
+def analyze_tree(tree, zip_file=None, name=None):
+    """Return the size tree of a ``BundleTree``: raw bytes of the files of the tree, compressed bytes of the
+    same entries of ``zip_file`` (0 without a zip, eg: a staged bundle directory)."""
+    compressed = {}
+    if zip_file:
+        with zipfile.ZipFile(zip_file) as zf:
+            compressed = dict((info.filename, info.compress_size) for info in zf.infolist())
+    files = [(arcname, entry.size, compressed.get(arcname, 0)) for arcname, entry in tree.iter_files()]
+    return _analyze(name or zip_file or "bundle tree", files, tree.read)
+
+
+def to_treemap(node):
+    """Convert the size tree into the nested {name, size, compressed, children: []} treemap format."""
+    item = {"name": node["name"], "size": node["size"], "compressed": node["compressed"]}
+    if "children" in node:
+        item["children"] = [to_treemap(child) for child in
+                            sorted(node["children"].values(), key=lambda child: -child["compressed"])]
+    return item
+
+
+def get_group_sizes(tree):
+    """Return [(category, group, raw bytes, compressed bytes)] sorted by compressed size."""
+    groups = []
+    for category in tree["children"].values():
+        for group in category["children"].values():
+            groups.append((category["name"], group["name"], group["size"], group["compressed"]))
+    return sorted(groups, key=lambda item: -item[3])
+
+
+def print_size_report(tree, top=20):
+    print("Size: %s, %s raw, %s compressed" % (tree["name"], format_size(tree["size"]),
+                                               format_size(tree["compressed"])))
+    key = "compressed" if tree["compressed"] else "size"  # 没有zip时按原始大小排序
+    for category in sorted(tree["children"].values(), key=lambda item: -item[key]):
+        print("  %-50s %12s %12s" % (category["name"], format_size(category["size"]),
+                                     format_size(category["compressed"])))
+    print("Top %d:" % top)
+    groups = get_group_sizes(tree)
+    if not tree["compressed"]:
+        groups.sort(key=lambda item: -item[2])
+    for category, group, size, compressed in groups[:top]:
+        print("  %-50s %12s %12s  %5.1f%%" % ("%s [%s]" % (group, category), format_size(size),
+                                              format_size(compressed),
+                                              (compressed * 100.0 / tree["compressed"]) if tree["compressed"]
+                                              else (size * 100.0 / tree["size"] if tree["size"] else 0)))
+
+
+def check_size_budget(tree, budget):
+    """Return the list of exceeded limits of the `size_budget` config (compressed bytes).
+
+    "size_budget": {"total": "200MB", "runtime": "30MB", "distribution": "50MB",
+                    "distributions": {"numpy": "80MB"}, "package": "20MB"}
+    """
+    errors = []
+
+    def check(name, size, limit):
+        if limit is not None and size > parse_size(limit):
+            errors.append("%s is %s, over the budget of %s" % (name, format_size(size), format_size(parse_size(limit))))
+
+    unknown = set(budget) - set(["total", "runtime", "distribution", "distributions", "package"])
+    if unknown:
+        raise ValueError("unknown keys in `size_budget`: %s" % ", ".join(sorted(unknown)))
+    categories = tree["children"]
+    check("bundle", tree["compressed"], budget.get("total"))
+    if "runtime" in categories:
+        check("runtime", categories["runtime"]["compressed"], budget.get("runtime"))
+    if "package" in budget:
+        package = categories.get("pkvenv_package")
+        check("pkvenv_package", package["compressed"] if package else 0, budget["package"])
+    overrides = dict((normalize_dist_name(name), limit) for name, limit in budget.get("distributions", {}).items())
+    for category in ("distributions", "site-packages (no RECORD)"):
+        for group in categories.get(category, {"children": {}})["children"].values():
+            limit = overrides.get(normalize_dist_name(group["name"]), budget.get("distribution"))
+            check("distribution `%s`" % group["name"], group["compressed"], limit)
+    return errors
+
+
+def write_treemap(tree, output):
+    with open(output, "w") as f:
+        json.dump(to_treemap(tree), f, indent=1)
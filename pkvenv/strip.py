@@ -0,0 +1,239 @@
+import re
+import ast
+import fnmatch
+import warnings
+import posixpath
+
+# 打包后运行时用不到的文件. dirs/files 匹配 site-packages 中的目录名/文件名,
+# dists 为需要整体删除的发行包(根据 dist-info/RECORD 删除).
+# 匹配的目录(包括有 __init__.py 的测试包)被其他保留的模块导入时不会删除, 例如 botocore.docs
+STRIP_PROFILES = {
+    "none": {},
+    "safe": {
+        "scripts": True,
+        "dists": ["pip", "wheel"],
+        "dirs": ["tests", "docs", "examples"],
+        "files": ["*.pyi", "*.c", "*.h", "*.pyx", "*.pxd", "py.typed"],
+    },
+    "aggressive": {
+        "scripts": True,
+        "dists": ["pip", "wheel", "setuptools"],
+        "dirs": ["tests", "test", "docs", "doc", "examples", "example", "samples", "benchmarks"],
+        "files": ["*.pyi", "*.c", "*.h", "*.pyx", "*.pxd", "py.typed", "*.lib", "*.a", "*.pdb",
+                  "distutils-precedence.pth"],
+        "dist_info_keep": ["METADATA", "RECORD", "entry_points.txt", "top_level.txt", "LICENSE*", "COPYING*",
+                           "NOTICE*", "licenses/*"],
+    },
+}
+
+ALWAYS_KEEP = ("pkvenv_main", "pkvenv_package")
+
+
+def get_strip_rules(strip_configs):
+    # "strip": "safe" 或 {"profile": "safe", "dists": [], "exclude": [], "keep": []}
+    if not strip_configs:
+        strip_configs = {}
+    elif isinstance(strip_configs, str):
+        strip_configs = {"profile": strip_configs}
+    profile = strip_configs["profile"] if "profile" in strip_configs else "safe"
+    if profile not in STRIP_PROFILES:
+        raise ValueError("unknown strip profile `%s`, available: %s" % (profile, ", ".join(STRIP_PROFILES)))
+    rules = dict(STRIP_PROFILES[profile])
+    rules["dists"] = list(rules.get("dists", [])) + list(strip_configs.get("dists", []))
+    rules["exclude"] = list(strip_configs.get("exclude", []))
+    rules["keep"] = list(strip_configs.get("keep", []))
+    return rules
+
+
+def normalize_dist_name(name):
+    return re.sub(r"[-_.]+", "_", name).lower()
+
+
+def _find_dist_files(tree, site_packages, dist_names):
+    dist_names = set(normalize_dist_name(name) for name in dist_names)
+    found = {}
+    for dist_info in set(arcname[len(site_packages) + 1:].split("/")[0] for arcname, _ in tree.iter_files(site_packages + "/")):
+        if not dist_info.endswith(".dist-info"):
+            continue
+        dist_name = normalize_dist_name(dist_info[:-len(".dist-info")].split("-")[0])
+        if dist_name not in dist_names:
+            continue
+        dist_info_path = posixpath.join(site_packages, dist_info)
+        files = set()
+        record_file = posixpath.join(dist_info_path, "RECORD")
+        if record_file in tree:
+            for line in tree.read(record_file).decode("utf-8").splitlines():
+                path = line.rsplit(",", 2)[0].strip().strip('"')
+                if path:
+                    files.add(posixpath.normpath(posixpath.join(site_packages, path)))
+        files.update(arcname for arcname, _ in tree.iter_files(dist_info_path + "/"))
+        for file in files:
+            found[file] = "dist:" + dist_name
+    return found
+
+
+def _is_script(entry):
+    if entry.data is not None:
+        return entry.data[:2] == b"#!"
+    with open(entry.path, "rb") as f:
+        return f.read(2) == b"#!"
+
+
+# importlib.import_module("x.y") 和 __import__("x.y")
+DYNAMIC_IMPORT_RE = re.compile(br"""(?:import_module|__import__)\(\s*["']([\w.]+)["']""")
+
+
+def _iter_statements(body):
+    # 只遍历语句(import可以在函数, if, try等中), 不遍历表达式
+    for node in body:
+        yield node
+        for field in ("body", "orelse", "finalbody", "handlers", "cases"):
+            children = getattr(node, field, None)
+            if isinstance(children, list):
+                for child in _iter_statements(children):
+                    yield child
+
+
+def _get_imported_names(source, package):
+    """Return the dotted names imported by a module of ``package``, with the imported names of
+    ``from x import y`` as ``x.y`` (they may be submodules)."""
+    names = set(name.decode("utf-8") for name in DYNAMIC_IMPORT_RE.findall(source))
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")  # 无效的转义字符等
+            module = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return names
+    for node in _iter_statements(module.body):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = package.split(".")[:len(package.split(".")) - node.level + 1] if node.level else []
+            base = ".".join(base + ([node.module] if node.module else []))
+            names.add(base)
+            names.update(base + "." + alias.name for alias in node.names)
+    return names
+
+
+def _find_imports(tree, site_packages, dirs):
+    """Return {module path: matched dirs it imports} for the modules importing any of ``dirs``
+    (paths relative to site-packages) from outside of the dir."""
+    imports = {}
+    keywords = set(path.rsplit("/", 1)[-1].encode("utf-8") for path in dirs)
+    # 只解析import语句或import_module中出现目录名的模块
+    pattern = re.compile(br"^[ \t]*(?:from|import)[ \t][^\n]*\b(?:%s)\b|(?:import_module|__import__)\("
+                         % b"|".join(sorted(re.escape(keyword) for keyword in keywords)), re.MULTILINE)
+    for arcname, entry in tree.iter_files(site_packages + "/"):
+        path = arcname[len(site_packages) + 1:]
+        if not path.endswith(".py"):
+            continue
+        source = entry.read()
+        if not any(keyword in source for keyword in keywords) or not pattern.search(source):
+            continue
+        names = _get_imported_names(source, path.rsplit("/", 1)[0].replace("/", ".") if "/" in path else "")
+        for dir_path in dirs:
+            module = dir_path.replace("/", ".")
+            if not path.startswith(dir_path + "/") \
+                    and any(name == module or name.startswith(module + ".") for name in names):
+                imports.setdefault(path, set()).add(dir_path)
+    return imports
+
+
+def _find_kept_dirs(tree, site_packages, dir_names):
+    """Return the matched dirs (paths relative to site-packages) imported by the modules that are kept."""
+    dirs = set()
+    for arcname, _ in tree.iter_files(site_packages + "/"):
+        parts = arcname[len(site_packages) + 1:].split("/")
+        if parts[-1].endswith(".py"):
+            dirs.update("/".join(parts[:i + 1]) for i, part in enumerate(parts[:-1]) if part in dir_names)
+    if not dirs:
+        return set()
+
+    def is_removed(path, kept):
+        return any(path.startswith(dir_path + "/") and not any(path.startswith(k + "/") for k in kept)
+                   for dir_path in dirs)
+
+    # 被删除的目录中的模块(例如测试之间)的导入不算, 直到被导入的目录确定保留
+    imports = _find_imports(tree, site_packages, dirs)
+    kept = set()
+    while True:
+        found = set()
+        for path, imported in imports.items():
+            if not is_removed(path, kept):
+                found.update(imported)
+        if found <= kept:
+            return kept
+        kept |= found
+
+
+def collect_strip_files(tree, python_path, site_packages, rules):
+    """Return {arcname: category} for every file of the bundle tree the rules would remove."""
+    found = {}
+    if rules.get("scripts"):
+        for arcname, _ in tree.iter_files(python_path + "/Scripts/"):
+            found[arcname] = "scripts"
+        # linux: bin中pip安装的脚本(#!), 不包括python解释器本身
+        for arcname, entry in tree.iter_files(python_path + "/bin/"):
+            if _is_script(entry):
+                found[arcname] = "scripts"
+    if rules["dists"]:
+        found.update(_find_dist_files(tree, site_packages, rules["dists"]))
+
+    dir_names = set(rules.get("dirs", []))
+    kept_dirs = _find_kept_dirs(tree, site_packages, dir_names) if dir_names else set()
+    file_patterns = rules.get("files", [])
+    dist_info_keep = rules.get("dist_info_keep")
+    for arcname, _ in tree.iter_files(site_packages + "/"):
+        path = arcname[len(site_packages) + 1:]
+        parts = path.split("/")
+        name = parts.pop()
+        if parts and parts[0] in ALWAYS_KEEP:
+            continue
+        in_dir = next((i for i, part in enumerate(parts) if part in dir_names
+                       and "/".join(parts[:i + 1]) not in kept_dirs), None)
+        if in_dir is not None:
+            category = "dir:" + parts[in_dir]
+        elif any(fnmatch.fnmatch(name, pattern) for pattern in file_patterns):
+            category = next("file:" + pattern for pattern in file_patterns if fnmatch.fnmatch(name, pattern))
+        elif dist_info_keep is not None and parts and parts[0].endswith(".dist-info") \
+                and not any(fnmatch.fnmatch("/".join(parts[1:] + [name]), pattern) for pattern in dist_info_keep):
+            category = "dist-info"
+        elif any(fnmatch.fnmatch(path, pattern) for pattern in rules["exclude"]):
+            category = "exclude"
+        else:
+            continue
+        found.setdefault(arcname, category)
+
+    for arcname in list(found):
+        path = arcname[len(site_packages) + 1:]
+        if arcname not in tree or not arcname.startswith(python_path + "/") \
+                or arcname.startswith(site_packages + "/") and path.split("/")[0] in ALWAYS_KEEP \
+                or any(fnmatch.fnmatch(path, pattern) for pattern in rules["keep"]):
+            del found[arcname]
+    return found
+
+
+def print_strip_report(tree, found, dry_run):
+    categories = {}
+    for arcname, category in found.items():
+        count, size = categories.get(category, (0, 0))
+        categories[category] = (count + 1, size + tree.entries[arcname].size)
+    total = sum(size for _, size in categories.values())
+    print("Strip%s: %d files, %.2f MB" % (" (dry run)" if dry_run else "", len(found), total / 1024 / 1024))
+    for category, (count, size) in sorted(categories.items(), key=lambda item: -item[1][1]):
+        print("  %-28s %6d files %10.2f MB" % (category, count, size / 1024 / 1024))
+
+
+def strip_files(tree, python_path, site_packages, strip_configs, dry_run=False):
+    """Remove the non-runtime files from the bundle tree.
+
+    ``python_path`` and ``site_packages`` are archive paths such as "Python" and
+    "Python/Lib/site-packages".
+    """
+    rules = get_strip_rules(strip_configs)
+    found = collect_strip_files(tree, python_path, site_packages, rules)
+    print_strip_report(tree, found, dry_run)
+    if not dry_run:
+        for arcname in found:
+            tree.remove(arcname)
+    return found
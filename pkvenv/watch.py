@@ -0,0 +1,308 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import shutil
+import argparse
+from .main import CONFIG_FILE_NAME, PYTHON_ARCNAME, parse_venv_configs, find_bundle_site_packages, copy_files, \
+    gen_launch_file, gen_fork_server_files, zip_files
+from .api import BuildConfig, BuildOptions, PkvenvError, build
+from .bundle import BundleTree
+from .archive import CompressionPolicy
+
+DEFAULT_STAGE_DIR = os.path.join("build", "pkvenv")
+# 这些配置变化时需要完整构建, 其他配置(include, entry_points)只影响app文件
+RUNTIME_CONFIG_ATTRS = ("venv_path", "target", "targets", "python_standalone", "pip_args", "strip")
+
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+def _iter_watch_dirs(paths):
+    # 目录递归监视, 文件监视其所在的目录
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, _ in os.walk(path):
+                yield dirpath
+        else:
+            yield os.path.dirname(path)
+
+
+class InotifyWatcher(object):
+    """Wait for changes under a set of files and dirs with inotify (linux only)."""
+
+    def __init__(self, paths):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}  # wd -> dir
+        for path in set(_iter_watch_dirs(paths)):
+            self._add_watch(path)
+
+    def _add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), INOTIFY_MASK)
+        if wd >= 0:
+            self.dirs[wd] = path
+
+    def _read_events(self):
+        data = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0")
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wd in self.dirs:
+                for path in _iter_watch_dirs([os.path.join(self.dirs[wd], os.fsdecode(name))]):
+                    self._add_watch(path)
+
+    def wait(self, timeout=None, settle=0.05):
+        """Block until something changed (True) or ``timeout`` passed (False)."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        self._read_events()
+        # 编辑器保存时通常有多个事件, 等待事件停止后再同步
+        while select.select([self.fd], [], [], settle)[0]:
+            self._read_events()
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Wait for changes by comparing the mtime and size of all files every ``interval`` seconds."""
+
+    def __init__(self, paths, interval=0.5):
+        self.paths = paths
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for path in self.paths:
+            files = [path] if not os.path.isdir(path) else \
+                [os.path.join(dirpath, name) for dirpath, _, names in os.walk(path) for name in names]
+            for file in files:
+                try:
+                    stat = os.stat(file)
+                except OSError:
+                    continue
+                snapshot[file] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def wait(self, timeout=None):
+        start = time.time()
+        while timeout is None or time.time() - start < timeout:
+            time.sleep(self.interval)
+            snapshot = self._scan()
+            if snapshot != self.snapshot:
+                self.snapshot = snapshot
+                return True
+        return False
+
+    def close(self):
+        pass
+
+
+def create_watcher(paths, poll=False, interval=0.5):
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(paths)
+        except OSError as e:
+            print("[Warning] can not use inotify (%s), fall back to polling" % e)
+    return PollingWatcher(paths, interval)
+
+
+def _get_signature(entry):
+    if entry.data is not None:
+        return entry.data
+    stat = os.stat(entry.path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _get_staged_signatures(tree, stage_dir, site_packages):
+    """Signatures of the files already staged, as if they were copied from the current tree."""
+    signatures = {}
+    package_path = os.path.join(stage_dir, *site_packages.split("/")) + os.sep + "pkvenv_package"
+    for dirpath, _, filenames in os.walk(package_path):
+        for name in filenames:
+            arcname = os.path.relpath(os.path.join(dirpath, name), stage_dir).replace(os.sep, "/")
+            signatures[arcname] = None  # 不在tree中的文件会被删除
+    for arcname, entry in tree.iter_files():
+        output = os.path.join(stage_dir, *arcname.split("/"))
+        if not os.path.isfile(output):
+            continue
+        if entry.data is not None:
+            with open(output, "rb") as f:
+                signatures[arcname] = f.read()
+        else:
+            stat = os.stat(output)  # copy2保留了源文件的mtime
+            signatures[arcname] = (stat.st_mtime_ns, stat.st_size)
+    return signatures
+
+
+def sync_tree(tree, stage_dir, previous):
+    """Write the files of ``tree`` whose signature differs from ``previous`` into ``stage_dir``
+    and remove the files that are gone. Return (new signatures, changed, removed)."""
+    signatures = {}
+    changed = 0
+    for arcname, entry in tree.iter_files():
+        try:
+            signature = signatures[arcname] = _get_signature(entry)
+        except OSError:
+            continue  # 同步时被删除的文件
+        if previous.get(arcname) == signature:
+            continue
+        output = os.path.join(stage_dir, *arcname.split("/"))
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        if entry.data is not None:
+            with open(output, "wb") as f:
+                f.write(entry.data)
+        else:
+            shutil.copy2(entry.path, output)
+        if entry.mode is not None:
+            os.chmod(output, entry.mode)
+        changed += 1
+    removed = 0
+    for arcname in set(previous) - set(signatures):
+        output = os.path.join(stage_dir, *arcname.split("/"))
+        if os.path.isfile(output):
+            os.remove(output)
+            removed += 1
+    return signatures, changed, removed
+
+
+class Watcher(object):
+    """Keep the staged bundle (and optionally the zip) of a project in sync with its app files."""
+
+    def __init__(self, project_dir, stage_dir=DEFAULT_STAGE_DIR, update_zip=False, poll=False, interval=0.5):
+        self.project_dir = os.path.abspath(project_dir)
+        self.stage_root = os.path.abspath(os.path.join(self.project_dir, stage_dir))
+        self.update_zip = update_zip
+        self.poll = poll
+        self.interval = interval
+        self.config_file = os.path.join(self.project_dir, CONFIG_FILE_NAME)
+        self.load_config()
+
+    def load_config(self):
+        self.config = BuildConfig.load(self.project_dir)
+        if self.config.import_archive is not None:
+            # 同步的是文件, 归档中的同名模块会优先于它们被导入
+            print("[Warning] `import_archive` is ignored in watch mode")
+            self.config.import_archive = None
+        venv_configs = parse_venv_configs(self.config.venv_path)
+        if "version" not in venv_configs:
+            raise ValueError("Can not find python version is venv config file!")
+        # 有`targets`时只同步第一个variant
+        self.variant = self.config.get_variants(venv_configs["version"])[0]
+        self.stage_dir = os.path.join(self.stage_root, self.variant.name) if self.variant.matrix else self.stage_root
+        self.runtime_configs = dict((key, getattr(self.config, key)) for key in RUNTIME_CONFIG_ATTRS)
+
+    def full_build(self):
+        print("Full build to", self.stage_dir)
+        build(self.config, BuildOptions(no_trace=True, incremental=True, stage_dir=self.stage_root))
+
+    def get_app_tree(self):
+        tree = BundleTree()
+        copy_files(self.config.include_files, tree, self.config.entry_points, self.site_packages, self.config.target,
+                   self.config.fork_server is not None)
+        gen_launch_file(tree, self.config.entry_points, self.site_packages)
+        if self.config.fork_server is not None:
+            # hash随app文件变化, 正在运行的fork server不会再使用旧的代码
+            gen_fork_server_files(tree, self.config.entry_points, self.site_packages,
+                                  idle_timeout=self.config.fork_server["idle_timeout"])
+        return tree
+
+    def sync(self):
+        start = time.perf_counter()
+        tree = self.get_app_tree()
+        self.signatures, changed, removed = sync_tree(tree, self.stage_dir, self.signatures)
+        if not changed and not removed:
+            return
+        print("Sync: %d changed, %d removed (%.0f ms)" % (changed, removed, (time.perf_counter() - start) * 1000))
+        if self.update_zip:
+            start = time.perf_counter()
+            bundle = BundleTree()
+            bundle.add_tree(PYTHON_ARCNAME, os.path.join(self.stage_dir, PYTHON_ARCNAME))
+            for name in os.listdir(self.stage_dir):
+                if name != PYTHON_ARCNAME and os.path.isfile(os.path.join(self.stage_dir, name)):
+                    bundle.add_file(name, os.path.join(self.stage_dir, name))
+            bundle.update(tree)  # 保留launcher的mode
+            zip_files(bundle, self.config.get_zip_file(self.variant), policy=CompressionPolicy.from_configs(
+                self.config.compression), incremental=True, variant=self.variant.name)
+            print("Zip updated (%.0f ms)" % ((time.perf_counter() - start) * 1000))
+
+    def reload(self):
+        runtime_configs = self.runtime_configs
+        self.load_config()
+        if self.runtime_configs != runtime_configs:
+            self.full_build()
+            self.prepare()
+
+    def prepare(self):
+        if not os.path.isdir(self.stage_dir):
+            self.full_build()
+        self.site_packages = os.path.relpath(find_bundle_site_packages(self.stage_dir),
+                                             self.stage_dir).replace(os.sep, "/")
+        self.signatures = _get_staged_signatures(self.get_app_tree(), self.stage_dir, self.site_packages)
+        self.sync()
+
+    def run(self):
+        self.prepare()
+        while True:
+            paths = self.config.include_files + [self.config_file]
+            config_mtime = os.stat(self.config_file).st_mtime_ns
+            watcher = create_watcher([path for path in paths if os.path.exists(path)], self.poll, self.interval)
+            print("Watching %d paths (%s), Ctrl+C to stop" % (len(paths), type(watcher).__name__))
+            try:
+                while True:
+                    watcher.wait()
+                    if os.stat(self.config_file).st_mtime_ns != config_mtime:
+                        break  # 配置变化后重新加载并重建监视列表
+                    try:
+                        self.sync()
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+            finally:
+                watcher.close()
+            try:
+                self.reload()
+            except (PkvenvError, ValueError) as e:
+                print("Error: %s" % e)  # 继续使用之前的配置, 等待下一次修改
+            self.sync()
+
+
+def watch_main(argv):
+    argparser = argparse.ArgumentParser(prog="pkvenv watch")
+    argparser.add_argument("project_dir", help="project dir")
+    argparser.add_argument("--stage-dir", default=DEFAULT_STAGE_DIR,
+                           help="staged bundle to keep in sync (relative to project dir), default is %s" % DEFAULT_STAGE_DIR)
+    argparser.add_argument("--zip", action="store_true", help="also update build/<name>.zip incrementally after each change")
+    argparser.add_argument("--poll", action="store_true", help="poll for changes instead of using inotify")
+    argparser.add_argument("--interval", type=float, default=0.5, help="polling interval in seconds")
+    arguments = argparser.parse_args(argv)
+
+    try:
+        watcher = Watcher(arguments.project_dir, arguments.stage_dir, arguments.zip, arguments.poll, arguments.interval)
+        watcher.run()
+    except (PkvenvError, ValueError) as e:
+        print("Error: %s" % e)
+        exit(-1)
+    except KeyboardInterrupt:
+        pass
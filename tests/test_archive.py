@@ -0,0 +1,161 @@
+import os
+import json
+import zlib
+import random
+import zipfile
+import pytest
+from pkvenv import archive
+from pkvenv.archive import ZipWriter, CompressionPolicy, crc32_combine, MANIFEST_SUFFIX
+
+
+def random_text(rng, size):
+    # 可压缩的内容, 避免被熵探测改为不压缩
+    words = [b"alpha", b"beta", b"gamma", b"delta", b"\n", b"    ", b"0123456789"]
+    return b"".join(rng.choice(words) for _ in range(size // 5))[:size]
+
+
+@pytest.mark.parametrize("len1,len2", [(0, 0), (0, 10), (10, 0), (1, 1), (1000, 3), (3, 1 << 20), (12345, 67890)])
+def test_crc32_combine(len1, len2):
+    rng = random.Random(len1 * 31 + len2)
+    a = bytes(rng.getrandbits(8) for _ in range(len1))
+    b = bytes(rng.getrandbits(8) for _ in range(min(len2, 4096))) * (len2 // 4096 or 1)
+    b = b[:len2]
+    assert crc32_combine(zlib.crc32(a), zlib.crc32(b), len(b)) == zlib.crc32(a + b)
+
+
+@pytest.fixture
+def source_dir(tmp_path):
+    rng = random.Random(0)
+    root = tmp_path / "src"
+    (root / "pkg" / "sub").mkdir(parents=True)
+    (root / "empty").mkdir()
+    files = {
+        "pkg/__init__.py": b"",
+        "pkg/big.txt": random_text(rng, 50000),
+        "pkg/sub/data.bin": bytes(rng.getrandbits(8) for _ in range(20000)),
+        "pkg/sub/small.txt": b"hello",
+        "run.sh": b"#!/bin/sh\n",
+    }
+    for path, data in files.items():
+        (root / path).write_bytes(data)
+    os.chmod(str(root / "run.sh"), 0o755)
+    return root, files
+
+
+def write_zip(file, root, **kwargs):
+    writer = ZipWriter(str(file), workers=kwargs.pop("workers", 4), **kwargs)
+    writer.add_tree(str(root))
+    writer.add_bytes("generated.txt", b"generated" * 100, 1600000000)
+    return writer.close()
+
+
+def check_zip(file, files):
+    with zipfile.ZipFile(str(file)) as zf:
+        assert zf.testzip() is None
+        for path, data in files.items():
+            assert zf.read(path) == data
+        assert zf.read("generated.txt") == b"generated" * 100
+
+
+@pytest.mark.parametrize("method", ["deflate", "store", "bzip2", "lzma"])
+def test_chunked(tmp_path, source_dir, method):
+    root, files = source_dir
+    # 小分块: 大文件分成多个分块并发压缩, CRC由各分块合并
+    write_zip(tmp_path / "out.zip", root, chunk_size=4096, policy=CompressionPolicy(method))
+    check_zip(tmp_path / "out.zip", files)
+
+
+def test_zip64(tmp_path, source_dir, monkeypatch):
+    root, files = source_dir
+    # 降低限制以使用zip64扩展字段(大小和偏移)
+    monkeypatch.setattr(archive, "ZIP64_LIMIT", 1000)
+    write_zip(tmp_path / "out.zip", root, chunk_size=4096)
+    check_zip(tmp_path / "out.zip", files)
+    with zipfile.ZipFile(str(tmp_path / "out.zip")) as zf:
+        assert zf.getinfo("pkg/big.txt").extract_version >= 45
+
+
+def test_zip64_file_count(tmp_path):
+    writer = ZipWriter(str(tmp_path / "many.zip"))
+    for i in range(archive.ZIP_FILECOUNT_LIMIT + 10):
+        writer.add_bytes("f/%d" % i, b"", 1600000000)
+    writer.close()
+    with zipfile.ZipFile(str(tmp_path / "many.zip")) as zf:
+        assert len(zf.infolist()) == archive.ZIP_FILECOUNT_LIMIT + 10
+        assert zf.testzip() is None
+
+
+def test_incremental(tmp_path, source_dir):
+    root, files = source_dir
+    output = tmp_path / "out.zip"
+    assert write_zip(output, root, incremental=True).reused == 0
+    files["pkg/sub/small.txt"] = b"changed"
+    (root / "pkg" / "sub" / "small.txt").write_bytes(files["pkg/sub/small.txt"])
+    writer = write_zip(output, root, incremental=True)
+    assert writer.reused == len(files)  # 4个未变化的文件和 generated.txt
+    check_zip(output, files)
+    # 不使用增量时删除manifest
+    write_zip(output, root)
+    assert not os.path.exists(str(output) + MANIFEST_SUFFIX)
+
+
+def test_incremental_interrupted(tmp_path, source_dir, monkeypatch):
+    root, files = source_dir
+    output = tmp_path / "out.zip"
+    write_zip(output, root, incremental=True)
+    (root / "pkg" / "sub" / "small.txt").write_bytes(b"changed")
+
+    def interrupt(self):
+        raise KeyboardInterrupt
+
+    # 替换zip之后, 写入manifest之前中断: 旧的manifest不能用于新的zip
+    monkeypatch.setattr(ZipWriter, "_write_manifest", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        write_zip(output, root, incremental=True)
+    assert not os.path.exists(str(output) + MANIFEST_SUFFIX)
+    monkeypatch.undo()
+    assert write_zip(output, root, incremental=True).reused == 0
+    check_zip(output, dict(files, **{"pkg/sub/small.txt": b"changed"}))
+
+
+@pytest.mark.parametrize("manifest", ['{"version": 1}', '{"entries": []}', '[]', '{"entries": {"run.sh": 1}}',
+                                      "not json"])
+def test_incremental_bad_manifest(tmp_path, source_dir, manifest):
+    root, files = source_dir
+    output = tmp_path / "out.zip"
+    write_zip(output, root, incremental=True)
+    with open(str(output) + MANIFEST_SUFFIX, "w") as f:
+        f.write(manifest)
+    # 无法识别的manifest按缓存未命中处理
+    assert write_zip(output, root, incremental=True).reused == 0
+    check_zip(output, files)
+    with open(str(output) + MANIFEST_SUFFIX) as f:
+        assert len(json.load(f)["entries"]) == len(files) + 1
+
+
+def test_add_tree_order(tmp_path, source_dir, monkeypatch):
+    root, files = source_dir
+    walk = os.walk
+
+    def reversed_walk(top):
+        # 模拟按创建顺序等非字母顺序返回的文件系统
+        for dirpath, dirnames, filenames in walk(top):
+            dirnames.reverse()
+            filenames.reverse()
+            yield dirpath, dirnames, filenames
+
+    write_zip(tmp_path / "a.zip", root, source_date_epoch=315532800)
+    monkeypatch.setattr(archive.os, "walk", reversed_walk)
+    write_zip(tmp_path / "b.zip", root, source_date_epoch=315532800)
+    assert (tmp_path / "a.zip").read_bytes() == (tmp_path / "b.zip").read_bytes()
+
+
+def test_reproducible(tmp_path, source_dir):
+    root, files = source_dir
+    write_zip(tmp_path / "a.zip", root, source_date_epoch=315532800, workers=1, chunk_size=4096)
+    for path in files:
+        os.utime(str(root / path), (1700000000, 1700000000))
+    os.chmod(str(root / "pkg" / "__init__.py"), 0o600)
+    write_zip(tmp_path / "b.zip", root, source_date_epoch=315532800, workers=8, chunk_size=4096)
+    assert (tmp_path / "a.zip").read_bytes() == (tmp_path / "b.zip").read_bytes()
+    check_zip(tmp_path / "a.zip", files)
@@ -0,0 +1,32 @@
+import os
+import json
+import pytest
+from pkvenv import batch
+
+
+def make_project(root, dirname, name, version="3.11.7"):
+    project_dir = root / dirname
+    (project_dir / "venv").mkdir(parents=True)
+    (project_dir / "venv" / "pyvenv.cfg").write_text("home = /usr/bin\nversion = %s\n" % version)
+    (project_dir / "pkvenv.json").write_text(json.dumps({"name": name, "venv": "venv", "include": [],
+                                                         "entry_points": [{"name": name, "entry_point": "main:main"}]}))
+    return str(project_dir)
+
+
+def test_invalid_apps(tmp_path, monkeypatch):
+    make_project(tmp_path, "a", "app")
+    make_project(tmp_path, "b", "app")
+    make_project(tmp_path, "c", "bad", version="311")
+    built = []
+    monkeypatch.setattr(batch, "build_app", lambda app, *args: built.append(app))
+    report_file = str(tmp_path / "report.json")
+    # 配置错误和重名的app都在构建之前记为失败
+    with pytest.raises(SystemExit):
+        batch.build_all_main([str(tmp_path), "--report", report_file])
+    assert built == []
+    with open(report_file) as f:
+        results = dict((os.path.basename(result["project_dir"]), result) for result in json.load(f)["results"])
+    assert sorted(results) == ["a", "b", "c"]
+    assert all(result["status"] == "failed" for result in results.values())
+    assert results["a"]["error"] == "duplicate app name app in a, b"
+    assert "invalid python version 311" in results["c"]["error"]
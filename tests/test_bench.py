@@ -0,0 +1,24 @@
+import os
+import sys
+import builtins
+import pytest
+from pkvenv import bench
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="linux only")
+def test_drop_page_cache_falls_back_to_fadvise(tmp_path, monkeypatch):
+    (tmp_path / "module.py").write_text("x = 1\n")
+    real_open = builtins.open
+    advised = []
+
+    def open_proc(file, *args, **kwargs):
+        if file == "/proc/sys/vm/drop_caches":
+            raise PermissionError(30, "Read-only file system", file)  # 容器中的root
+        return real_open(file, *args, **kwargs)
+
+    monkeypatch.setattr(os, "geteuid", lambda: 0)
+    monkeypatch.setattr(builtins, "open", open_proc)
+    monkeypatch.setattr(os, "posix_fadvise", lambda fd, offset, length, advice: advised.append(advice),
+                        raising=False)
+    assert bench.drop_page_cache(str(tmp_path))
+    assert advised == [os.POSIX_FADV_DONTNEED]
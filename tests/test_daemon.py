@@ -0,0 +1,26 @@
+import os
+import stat
+import threading
+from pkvenv import daemon
+from pkvenv.daemon import Daemon
+
+
+def test_socket_permissions(tmp_path, monkeypatch):
+    path = str(tmp_path / "daemon.sock")
+    server = Daemon(path)
+    peers = []
+    is_same_user = daemon._is_same_user
+    monkeypatch.setattr(daemon, "_is_same_user", lambda conn: peers.append(is_same_user(conn)) or peers[-1])
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    while not os.path.exists(path) and thread.is_alive():
+        thread.join(0.05)
+    # 创建时就只有当前用户可以访问
+    assert stat.S_IMODE(os.stat(path).st_mode) & 0o077 == 0
+    sock = daemon._connect(path)
+    with sock, sock.makefile("rb") as f:
+        daemon._send(sock, {"command": "stop"})
+        assert f.readline()
+    thread.join()
+    assert peers == [True]
+    assert not os.path.exists(path)
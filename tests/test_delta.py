@@ -0,0 +1,173 @@
+import os
+import stat
+import random
+import zipfile
+import pytest
+from pkvenv import delta_apply
+from pkvenv.delta import make_diff, make_delta
+from pkvenv.delta_apply import apply_diff, apply_delta, JOURNAL_NAME
+
+
+def random_bytes(rng, size):
+    return bytes(rng.getrandbits(8) for _ in range(size))
+
+
+@pytest.mark.parametrize("case", ["same", "insert", "replace", "delete", "unrelated", "empty_old", "empty_new",
+                                  "zeros", "text"])
+def test_diff_round_trip(case):
+    rng = random.Random(case)
+    old = random_bytes(rng, 200000)
+    if case == "same":
+        new = old
+    elif case == "insert":
+        new = bytearray(old)
+        for _ in range(20):
+            pos = rng.randrange(len(new))
+            new[pos:pos] = random_bytes(rng, rng.randrange(1, 100))
+    elif case == "replace":
+        new = bytearray(old)
+        for _ in range(20):
+            pos = rng.randrange(len(new) - 8)
+            new[pos:pos + 4] = random_bytes(rng, 4)
+    elif case == "delete":
+        new = old[:1000] + old[50000:150000] + old[160000:]
+    elif case == "unrelated":
+        new = random_bytes(rng, 150000)
+    elif case == "empty_old":
+        old, new = b"", old
+    elif case == "empty_new":
+        new = b""
+    elif case == "zeros":
+        old = bytes(300000)
+        new = old[:5000] + b"x" + old[5000:]
+    else:
+        old = "".join("line %d: %s\n" % (i, "x" * (i % 50)) for i in range(5000)).encode()
+        new = old.replace(b"line 12", b"line twelve")
+    new = bytes(new)
+    diff = make_diff(old, new)
+    assert apply_diff(old, diff) == new
+    if case in ("same", "insert", "replace", "delete", "zeros"):
+        assert len(diff) < len(new) // 10 + 100
+
+
+def test_apply_diff_invalid():
+    with pytest.raises(ValueError):
+        apply_diff(b"", b"not a diff")
+
+
+def write_zip(path, files):
+    with zipfile.ZipFile(path, "w") as zf:
+        for name, data in sorted(files.items()):
+            zf.writestr(name, data)
+
+
+@pytest.fixture
+def versions(tmp_path):
+    rng = random.Random(0)
+    binary = random_bytes(rng, 100000)
+    old = {
+        "Python/python.exe": b"python",
+        "app/main.py": b"print('1.0')\n",
+        "app/lib.bin": binary,
+        "app/removed/old.py": b"old",
+    }
+    new = {
+        "Python/python.exe": b"python",
+        "app/main.py": b"print('1.1')\n",
+        "app/lib.bin": binary[:5000] + b"patch" + binary[5000:],
+        "app/moved.py": b"old",
+        "app/added.txt": b"added",
+    }
+    old_zip, new_zip, patch = str(tmp_path / "old.zip"), str(tmp_path / "new.zip"), str(tmp_path / "patch.zip")
+    write_zip(old_zip, old)
+    write_zip(new_zip, new)
+    stats = make_delta(old_zip, new_zip, patch)
+    assert stats == {"copy": 2, "diff": 1, "full": 2}
+    bundle_dir = str(tmp_path / "bundle")
+    with zipfile.ZipFile(old_zip) as zf:
+        zf.extractall(bundle_dir)
+    with open(os.path.join(bundle_dir, "user.log"), "w") as f:
+        f.write("user data")
+    return patch, bundle_dir, new
+
+
+def read_tree(root):
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            with open(path, "rb") as f:
+                files[os.path.relpath(path, root).replace(os.sep, "/")] = f.read()
+    return files
+
+
+def test_apply_delta(versions):
+    patch, bundle_dir, new = versions
+    python_inode = os.stat(os.path.join(bundle_dir, "Python", "python.exe")).st_ino
+    apply_delta(patch, bundle_dir)
+    assert read_tree(bundle_dir) == dict(new, **{"user.log": b"user data"})
+    assert not os.path.exists(os.path.join(bundle_dir, "app", "removed"))
+    # 未变化的文件保留在原处
+    assert os.stat(os.path.join(bundle_dir, "Python", "python.exe")).st_ino == python_inode
+    assert not os.path.exists(bundle_dir + ".pkvenv-old")
+    assert not os.path.exists(bundle_dir + ".pkvenv-update")
+
+
+def test_apply_delta_rollback(versions, monkeypatch):
+    patch, bundle_dir, _ = versions
+    before = read_tree(bundle_dir)
+    replace = os.replace
+
+    def locked_replace(src, dst):
+        if dst.endswith("main.py") and "pkvenv-update" in src:
+            raise PermissionError("locked: %s" % dst)
+        replace(src, dst)
+
+    monkeypatch.setattr(delta_apply.os, "replace", locked_replace)
+    with pytest.raises(PermissionError):
+        apply_delta(patch, bundle_dir)
+    assert read_tree(bundle_dir) == before
+    assert not os.path.exists(bundle_dir + ".pkvenv-old")
+
+
+def test_apply_delta_interrupted(versions):
+    patch, bundle_dir, new = versions
+    # 模拟在移走 app/main.py 之后中断
+    backup_dir = bundle_dir + ".pkvenv-old"
+    os.makedirs(os.path.join(backup_dir, "files", "app"))
+    os.replace(os.path.join(bundle_dir, "app", "main.py"), os.path.join(backup_dir, "files", "app", "main.py"))
+    with open(os.path.join(backup_dir, JOURNAL_NAME), "w") as f:
+        f.write('["moved", "app/main.py"]\n["added", "app/ma')
+    # 先回滚中断的更新, 再正常更新
+    apply_delta(patch, bundle_dir)
+    assert read_tree(bundle_dir) == dict(new, **{"user.log": b"user data"})
+    assert not os.path.exists(backup_dir)
+
+
+def write_zip_modes(path, files):
+    with zipfile.ZipFile(path, "w") as zf:
+        for name, (data, mode) in sorted(files.items()):
+            info = zipfile.ZipInfo(name)
+            info.external_attr = (0o100000 | mode) << 16
+            zf.writestr(info, data)
+
+
+@pytest.mark.skipif(os.name == "nt", reason="posix file modes")
+def test_apply_delta_modes(tmp_path):
+    old = {"bin/tool": (b"tool", 0o644), "lib/a.py": (b"a", 0o644)}
+    new = {"bin/tool": (b"tool", 0o644), "bin/tool2": (b"tool", 0o755),
+           "lib/a.py": (b"a", 0o755), "lib/b.py": (b"a", 0o644)}
+    old_zip, new_zip, patch = str(tmp_path / "old.zip"), str(tmp_path / "new.zip"), str(tmp_path / "patch.zip")
+    write_zip_modes(old_zip, old)
+    write_zip_modes(new_zip, new)
+    make_delta(old_zip, new_zip, patch)
+    bundle_dir = str(tmp_path / "bundle")
+    for path, (data, mode) in old.items():
+        os.makedirs(os.path.dirname(os.path.join(bundle_dir, path)), exist_ok=True)
+        with open(os.path.join(bundle_dir, path), "wb") as f:
+            f.write(data)
+        os.chmod(os.path.join(bundle_dir, path), mode)
+    apply_delta(patch, bundle_dir)
+    # 权限不同的副本不能与源文件共享inode
+    for path, (data, mode) in new.items():
+        assert stat.S_IMODE(os.stat(os.path.join(bundle_dir, path)).st_mode) == mode, path
@@ -0,0 +1,126 @@
+import os
+import sys
+import subprocess
+import importlib.util
+import pytest
+from pkvenv.bundle import BundleTree
+from pkvenv.import_archive import IMPORT_ARCHIVE_NAME, write_import_archive, find_archive_tops, _get_pth_imports
+
+SITE_PACKAGES = "lib/site-packages"
+PY_VERSION = sys.version_info[:2]
+
+
+def build_site_packages(tmp_path, tree, exclude=()):
+    """Archive ``tree`` and materialize it; return the site-packages dir of the bundle."""
+    tree.add_bytes(SITE_PACKAGES + "/pkvenv_main/__init__.py", "")
+    write_import_archive(tree, SITE_PACKAGES, str(tmp_path / IMPORT_ARCHIVE_NAME), PY_VERSION, exclude)
+    stage_dir = str(tmp_path / "stage")
+    tree.materialize(stage_dir)
+    return os.path.join(stage_dir, *SITE_PACKAGES.split("/"))
+
+
+def run_isolated(site_packages, code):
+    # -I -S: 只有打包的site-packages, 与宿主环境隔离
+    script = "import site, sys; site.addsitedir(%r)\n%s" % (site_packages, code)
+    return subprocess.run([sys.executable, "-I", "-S", "-c", script], stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True).stdout
+
+
+@pytest.fixture
+def demo_tree():
+    tree = BundleTree()
+    tree.add_bytes(SITE_PACKAGES + "/demo/__init__.py", "from . import util\nVALUE = util.VALUE\n")
+    tree.add_bytes(SITE_PACKAGES + "/demo/util.py", "VALUE = 42\n")
+    tree.add_bytes(SITE_PACKAGES + "/demo/data/config.json", '{"a": 1}')
+    tree.add_bytes(SITE_PACKAGES + "/demo/ns/mod.py", "NAME = __name__\n")
+    tree.add_bytes(SITE_PACKAGES + "/single.py", "X = 1\n")
+    tree.add_bytes(SITE_PACKAGES + "/native/__init__.py", "")
+    tree.add_bytes(SITE_PACKAGES + "/native/_ext.so", b"\x7fELF")
+    return tree
+
+
+def test_find_archive_tops(demo_tree):
+    assert find_archive_tops(demo_tree, SITE_PACKAGES) == ["demo", "single"]
+    assert find_archive_tops(demo_tree, SITE_PACKAGES, exclude=["single"]) == ["demo"]
+
+
+def test_pth_imports():
+    tree = BundleTree()
+    tree.add_bytes(SITE_PACKAGES + "/a.pth", "import os; var = 'X'; enabled = os.environ.get(var, 'local') == 'local'; "
+                                             "enabled and __import__('_distutils_hack').add_shim();\n")
+    tree.add_bytes(SITE_PACKAGES + "/b.pth", "import a.b, c\n./some/dir\nimport importlib; "
+                                             "importlib.import_module('d.e')\nimport from broken\n")
+    assert _get_pth_imports(tree, SITE_PACKAGES) == {"os", "_distutils_hack", "a", "c", "importlib", "d"}
+
+
+def test_finder(tmp_path, demo_tree):
+    site_packages = build_site_packages(tmp_path, demo_tree)
+    assert sorted(os.listdir(site_packages)) == ["_pkvenv_importer.pth", "native", IMPORT_ARCHIVE_NAME, "pkvenv_main"]
+    archive = os.path.join(site_packages, IMPORT_ARCHIVE_NAME)
+    output = run_isolated(site_packages, """
+import json, pkgutil, importlib.resources
+import demo, demo.ns.mod, single
+print(demo.VALUE, single.X, demo.ns.mod.NAME)
+print(demo.__file__)
+print(list(demo.ns.__path__))
+print(json.loads(pkgutil.get_data("demo", "data/config.json")))
+print(importlib.resources.files("demo").joinpath("data/config.json").read_text())
+print(sorted(path.name for path in importlib.resources.files("demo").iterdir()))
+""")
+    assert output.splitlines() == [
+        "42 1 demo.ns.mod",
+        os.path.join(archive, "demo", "__init__.py"),
+        str([os.path.join(archive, "demo", "ns")]),
+        "{'a': 1}",
+        '{"a": 1}',
+        str(sorted(["__init__.py", "util.py", "data", "ns"])),
+    ]
+
+
+def test_finder_uses_parent_path(tmp_path, demo_tree):
+    # 以其他名字导入的包, 子模块按它的__path__在归档中查找
+    site_packages = build_site_packages(tmp_path, demo_tree)
+    output = run_isolated(site_packages, """
+import sys, importlib.util, demo
+spec = importlib.util.spec_from_file_location("alias", demo.__file__,
+                                              submodule_search_locations=list(demo.__path__))
+sys.modules["alias"] = importlib.util.module_from_spec(spec)
+import alias.util
+print(alias.util.__name__, alias.util.VALUE, alias.util.__file__ == demo.util.__file__)
+""")
+    assert output.split() == ["alias.util", "42", "True"]
+
+
+@pytest.mark.skipif(importlib.util.find_spec("_distutils_hack") is None, reason="setuptools without _distutils_hack")
+def test_setuptools(tmp_path):
+    import setuptools
+    host_site_packages = os.path.dirname(os.path.dirname(setuptools.__file__))
+    tree = BundleTree()
+    for name in ("setuptools", "pkg_resources", "_distutils_hack"):
+        tree.add_tree(SITE_PACKAGES + "/" + name, os.path.join(host_site_packages, name))
+    for name in os.listdir(host_site_packages):
+        if name == "distutils-precedence.pth":
+            tree.add_file(SITE_PACKAGES + "/" + name, os.path.join(host_site_packages, name))
+    site_packages = build_site_packages(tmp_path, tree)
+    # _distutils_hack在.pth中导入, setuptools 用 __file__ 读取脚本模板等数据文件, 都保留在文件系统中
+    assert sorted(os.listdir(site_packages)) == ["_distutils_hack", "_pkvenv_importer.pth", "distutils-precedence.pth",
+                                                 IMPORT_ARCHIVE_NAME, "pkvenv_main", "setuptools"]
+    output = run_isolated(site_packages, """
+import setuptools, distutils.core
+print(setuptools.__file__)
+print(distutils.core.__file__)
+""")
+    setuptools_file, core_file = output.splitlines()
+    assert setuptools_file == os.path.join(site_packages, "setuptools", "__init__.py")
+    assert core_file == os.path.join(site_packages, "setuptools", "_distutils", "core.py")
+
+
+def test_data_files_by_path(tmp_path, demo_tree):
+    demo_tree.add_bytes(SITE_PACKAGES + "/legacy/__init__.py",
+                        "import os\nwith open(os.path.join(os.path.dirname(__file__), 'data.txt')) as f:\n"
+                        "    DATA = f.read()\n")
+    demo_tree.add_bytes(SITE_PACKAGES + "/legacy/data.txt", "legacy data")
+    demo_tree.add_bytes(SITE_PACKAGES + "/code_only/__init__.py", "NAME = __file__\n")
+    assert find_archive_tops(demo_tree, SITE_PACKAGES) == ["code_only", "demo", "single"]
+    site_packages = build_site_packages(tmp_path, demo_tree)
+    assert run_isolated(site_packages, "import legacy; print(legacy.DATA)").strip() == "legacy data"
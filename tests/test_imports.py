@@ -0,0 +1,16 @@
+import sys
+import subprocess
+
+
+def test_daemon_does_not_import_requests():
+    code = "import sys, pkvenv.daemon; print('requests' in sys.modules, 'pkvenv.api' in sys.modules)"
+    output = subprocess.check_output([sys.executable, "-c", code], universal_newlines=True)
+    assert output.split() == ["False", "False"]
+
+
+def test_lazy_api():
+    import pkvenv
+    from pkvenv import api
+    assert pkvenv.build is api.build
+    assert pkvenv.BuildError is api.BuildError
+    assert sorted(name for name in pkvenv.__all__ if not hasattr(api, name)) == []
@@ -0,0 +1,71 @@
+import time
+import threading
+import pytest
+from pkvenv.pipeline import Pipeline
+
+
+def test_run_order_and_values():
+    pipeline = Pipeline()
+    pipeline.add("download", lambda url: url + ".zip", inputs=["url"], outputs=["zip"], resource="network")
+    pipeline.add("freeze", lambda: ("a==1", "b==2"), outputs=["a", "b"], resource="disk")
+    pipeline.add("install", lambda zip, a, b: "%s:%s,%s" % (zip, a, b), inputs=["zip", "a", "b"],
+                 outputs=["layer"])
+    values = pipeline.run(url="python")
+    assert values["layer"] == "python.zip:a==1,b==2"
+    assert pipeline.failed_stage is None
+
+
+def test_error_propagation():
+    events = []
+    lock = threading.Lock()
+    sibling_done = threading.Event()
+
+    def callback(event, stage):
+        with lock:
+            events.append((event, stage))
+
+    def fail():
+        raise OSError("disk full")
+
+    def slow_sibling():
+        time.sleep(0.05)
+        sibling_done.set()
+
+    pipeline = Pipeline(callback=callback)
+    pipeline.add("sibling", slow_sibling, resource="network")
+    pipeline.add("fail", fail, outputs=["x"], resource="disk")
+    pipeline.add("after", lambda x: x, inputs=["x"], outputs=["y"])
+    with pytest.raises(OSError, match="disk full"):
+        pipeline.run()
+    assert pipeline.failed_stage == "fail"
+    # 出错时等待正在运行的stage结束, 不再启动依赖它的stage
+    assert sibling_done.is_set()
+    assert ("error", "fail") in events
+    assert not any(stage == "after" for _, stage in events)
+
+
+def test_first_error_wins():
+    pipeline = Pipeline(limits={"cpu": 1})
+
+    def first():
+        raise ValueError("first")
+
+    pipeline.add("first", first)
+    pipeline.add("second", lambda: 1 / 0)
+    with pytest.raises(ValueError, match="first"):
+        pipeline.run()
+    assert pipeline.failed_stage == "first"
+
+
+def test_invalid_graph():
+    pipeline = Pipeline()
+    pipeline.add("a", lambda y: y, inputs=["y"], outputs=["x"])
+    with pytest.raises(ValueError, match="missing inputs: y"):
+        pipeline.run()
+    pipeline = Pipeline()
+    pipeline.add("a", lambda: 1, outputs=["x"])
+    pipeline.add("b", lambda: 2, outputs=["x"])
+    with pytest.raises(ValueError, match="more than one stage"):
+        pipeline.run()
+    with pytest.raises(ValueError, match="unknown resource"):
+        pipeline.add("c", lambda: 1, resource="gpu")
@@ -0,0 +1,109 @@
+import io
+import os
+import tarfile
+import threading
+import pytest
+from pkvenv import main as pkvenv_main
+from pkvenv import remote_cache
+from pkvenv.cache_server import CacheServer
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = CacheServer(("127.0.0.1", 0), str(tmp_path / "server"))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def remote(server, tmp_path, monkeypatch):
+    url = "http://127.0.0.1:%d/" % server.server_address[1]
+    monkeypatch.setenv("PKVENV_REMOTE_CACHE", url)
+    monkeypatch.setenv("PKVENV_CACHE_DIR", str(tmp_path / "cache"))
+    return remote_cache.get_remote_cache()
+
+
+def test_round_trip(remote, tmp_path):
+    file = tmp_path / "artifact"
+    file.write_bytes(b"layer" * 1000)
+    assert not remote_cache.fetch(remote, "layers/runtime-1.sha256", str(tmp_path / "out"))
+    remote_cache.put(remote, "layers/runtime-1.sha256", str(file))
+    assert remote_cache.fetch(remote, "layers/runtime-1.sha256", str(tmp_path / "out"))
+    assert (tmp_path / "out").read_bytes() == file.read_bytes()
+
+
+def test_content_mismatch(remote, server, tmp_path):
+    file = tmp_path / "artifact"
+    file.write_bytes(b"layer")
+    remote_cache.put(remote, "layers/runtime-1.sha256", str(file))
+    content_dir = os.path.join(server.root, "layers")
+    for name in os.listdir(content_dir):
+        if name.startswith("sha256-"):
+            with open(os.path.join(content_dir, name), "wb") as f:
+                f.write(b"tampered")
+    with pytest.raises(ValueError):
+        remote_cache.fetch(remote, "layers/runtime-1.sha256", str(tmp_path / "out"))
+
+
+def test_layer_round_trip(remote, tmp_path, monkeypatch):
+    calls = []
+
+    def setup_runtime(python_zip_file, requirements_file, output_path, *args):
+        calls.append(output_path)
+        os.makedirs(os.path.join(output_path, "Python"))
+        with open(os.path.join(output_path, "Python", "python.exe"), "w") as f:
+            f.write("python")
+        os.symlink("python.exe", os.path.join(output_path, "Python", "python3"))
+
+    monkeypatch.setattr(pkvenv_main, "setup_runtime", setup_runtime)
+    requirements_file = tmp_path / "requirements.txt"
+    requirements_file.write_text("requests==2.31.0\n")
+    layer_path = pkvenv_main.get_runtime_layer("python.zip", str(requirements_file), str(tmp_path / "build"))
+    remote_cache.wait_for_uploads()
+    # 新的agent: 本地缓存为空时从远程缓存下载
+    monkeypatch.setenv("PKVENV_CACHE_DIR", str(tmp_path / "cache2"))
+    fetched_path = pkvenv_main.get_runtime_layer("python.zip", str(requirements_file), str(tmp_path / "build"))
+    assert len(calls) == 1
+    assert os.path.basename(fetched_path) == os.path.basename(layer_path)
+    with open(os.path.join(fetched_path, "Python", "python3")) as f:
+        assert f.read() == "python"
+    assert os.readlink(os.path.join(fetched_path, "Python", "python3")) == "python.exe"
+
+
+def make_tar(file, members):
+    with tarfile.open(file, "w:gz") as tf:
+        for info in members:
+            tf.addfile(info, io.BytesIO(b"evil") if info.isfile() else None)
+
+
+def tar_info(name, type=tarfile.REGTYPE, linkname=""):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.linkname = linkname
+    info.size = 4 if type == tarfile.REGTYPE else 0
+    return info
+
+
+@pytest.mark.parametrize("members", [
+    [tar_info("../evil")],
+    [tar_info("/tmp/evil")],
+    [tar_info("link", tarfile.SYMTYPE, "/tmp"), tar_info("link/evil")],
+    [tar_info("link", tarfile.SYMTYPE, "../..")],
+    [tar_info("a/b/d", tarfile.SYMTYPE, "../.."), tar_info("a/b/e", tarfile.SYMTYPE, "d/../../..")],
+    [tar_info("hard", tarfile.LNKTYPE, "../evil")],
+    [tar_info("dev", tarfile.CHRTYPE)],
+    [tar_info("evil"), tar_info("evil")],
+], ids=["parent", "absolute", "through_link", "link_outside", "link_chain", "hard_link", "device", "duplicate"])
+def test_malicious_layer(remote, tmp_path, members):
+    archive_file = str(tmp_path / "layer.tar.gz")
+    make_tar(archive_file, members)
+    remote_cache.put(remote, "layers/runtime-1.sha256", archive_file)
+    (tmp_path / "out").mkdir()
+    output_path = str(tmp_path / "out" / "layer")
+    assert not pkvenv_main.fetch_remote_layer(remote, "layers/runtime-1.sha256", "1", output_path)
+    assert not os.path.exists(output_path)
+    assert os.listdir(str(tmp_path / "out")) == []
@@ -0,0 +1,20 @@
+from pkvenv.bundle import BundleTree
+from pkvenv.main import zip_files
+from pkvenv.metrics import report
+
+
+def test_zip_per_variant(tmp_path):
+    report.reset()
+    tree = BundleTree()
+    tree.add_bytes("a.txt", "hello" * 100)
+    for variant in ("3.11.7-amd64", "3.9.13-win32"):
+        zip_files(tree, str(tmp_path / ("demo-%s.zip" % variant)), variant=variant)
+    build_report = report.to_dict("demo", "success", {})
+    assert sorted(build_report["zip"]) == ["3.11.7-amd64", "3.9.13-win32"]
+    assert build_report["zip"]["3.9.13-win32"]["file"] == str(tmp_path / "demo-3.9.13-win32.zip")
+    metrics_file = str(tmp_path / "metrics.prom")
+    report.write_prometheus(metrics_file, build_report)
+    with open(metrics_file) as f:
+        lines = [line.split(" ")[0] for line in f if line.startswith("pkvenv_zip_files")]
+    assert lines == ['pkvenv_zip_files{project="demo",variant="3.11.7-amd64"}',
+                     'pkvenv_zip_files{project="demo",variant="3.9.13-win32"}']
@@ -0,0 +1,35 @@
+import os
+import pytest
+from pkvenv import main as pkvenv_main
+
+
+@pytest.fixture
+def get_layer(tmp_path, monkeypatch):
+    monkeypatch.setenv("PKVENV_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.delenv("PKVENV_REMOTE_CACHE", raising=False)
+    calls = []
+
+    def setup_runtime(python_zip_file, requirements_file, output_path, *args):
+        calls.append(output_path)
+
+    monkeypatch.setattr(pkvenv_main, "setup_runtime", setup_runtime)
+    requirements_file = tmp_path / "requirements.txt"
+    requirements_file.write_text("requests==2.31.0\n")
+
+    def get_layer(**kwargs):
+        layer_path = pkvenv_main.get_runtime_layer("python-3.11.7-embed-amd64.zip", str(requirements_file),
+                                                   str(tmp_path / "build"), **kwargs)
+        return os.path.basename(layer_path)
+
+    get_layer.calls = calls
+    return get_layer
+
+
+def test_layer_key(get_layer):
+    default = get_layer()
+    assert get_layer() == default
+    assert len(get_layer.calls) == 1
+    keys = {default, get_layer(pip_args=["--no-binary", ":all:"]), get_layer(arch="arm64"),
+            get_layer(target="linux"), get_layer(source_date_epoch=0)}
+    assert len(keys) == 5
+    assert len(get_layer.calls) == 5
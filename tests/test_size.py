@@ -0,0 +1,34 @@
+import zipfile
+from pkvenv.bundle import BundleTree
+from pkvenv.size import analyze_zip, analyze_tree, check_size_budget
+
+SITE_PACKAGES = "Python/Lib/site-packages/"
+
+
+def make_tree():
+    tree = BundleTree()
+    tree.add_bytes("Python/python.exe", b"x" * 1000)
+    tree.add_bytes(SITE_PACKAGES + "demo/__init__.py", b"a" * 5000)
+    tree.add_bytes(SITE_PACKAGES + "demo-1.0.dist-info/RECORD", "demo/__init__.py,,\ndemo-1.0.dist-info/RECORD,,\n")
+    tree.add_bytes(SITE_PACKAGES + "pkvenv_package/app/main.py", b"print(1)\n")
+    return tree
+
+
+def test_analyze_tree(tmp_path):
+    tree = make_tree()
+    zip_file = str(tmp_path / "demo.zip")
+    with zipfile.ZipFile(zip_file, "w", zipfile.ZIP_DEFLATED) as zf:
+        for arcname, entry in tree.iter_files():
+            zf.writestr(arcname, entry.read())
+    from_zip = analyze_zip(zip_file)
+    from_tree = analyze_tree(tree, zip_file)
+    assert from_tree == from_zip
+    groups = from_tree["children"]["distributions"]["children"]
+    assert list(groups) == ["demo"]
+    assert groups["demo"]["size"] == 5000 + len(tree.read(SITE_PACKAGES + "demo-1.0.dist-info/RECORD"))
+    assert 0 < groups["demo"]["compressed"] < 5000
+    assert check_size_budget(from_tree, {"distribution": "1KB"}) == []
+    # 没有zip时只有原始大小
+    raw = analyze_tree(tree)
+    assert raw["size"] == from_zip["size"] and raw["compressed"] == 0
+    assert set(raw["children"]) == {"runtime", "distributions", "pkvenv_package"}
@@ -0,0 +1,87 @@
+import pytest
+from pkvenv.bundle import BundleTree
+from pkvenv.strip import get_strip_rules, collect_strip_files
+
+PYTHON = "Python"
+SITE_PACKAGES = "Python/Lib/site-packages"
+
+
+def make_tree():
+    tree = BundleTree()
+    files = {
+        "pkg/__init__.py": "",
+        "pkg/core.py": "from pkg.test import util\nfrom .docs import shapes\n",
+        "pkg/core.pyi": "",
+        # 被导入的包(例如 botocore.docs)
+        "pkg/docs/__init__.py": "",
+        "pkg/docs/shapes.py": "",
+        "pkg/docs/shapes.json": "{}",
+        # 被导入的没有 __init__.py 的目录
+        "pkg/test/util.py": "",
+        # 只有数据文件
+        "pkg/examples/readme.txt": "",
+        # 测试包
+        "pkg/tests/__init__.py": "",
+        "pkg/tests/test_core.py": "import pkg\nfrom pkg.test import util\n",
+        "pkg/tests/data/input.txt": "",
+        "other/__init__.py": "from .doc import helpers\n",
+        "other/doc/helpers.py": "",
+        "other/doc/index.rst": "",
+        # 只被测试导入
+        "other/examples/helper.py": "",
+        "other/tests/__init__.py": "",
+        "other/tests/test_other.py": "from other.examples import helper\n",
+        "pkvenv_package/tests/test_app.py": "",
+    }
+    for path, data in files.items():
+        tree.add_bytes(SITE_PACKAGES + "/" + path, data)
+    tree.add_bytes(PYTHON + "/Scripts/tool.exe", "")
+    tree.add_bytes(PYTHON + "/bin/python3", b"\x7fELF")
+    tree.add_bytes(PYTHON + "/bin/pip", "#!/usr/bin/env python3\n")
+    return tree
+
+
+def collect(profile):
+    found = collect_strip_files(make_tree(), PYTHON, SITE_PACKAGES, get_strip_rules(profile))
+    return sorted(arcname[len(SITE_PACKAGES) + 1:] if arcname.startswith(SITE_PACKAGES) else arcname
+                  for arcname in found)
+
+
+@pytest.mark.parametrize("profile", ["safe", "aggressive"])
+def test_profiles(profile):
+    # 测试包和只被测试导入的目录被删除, 被其他模块导入的目录(aggressive中的 test/, doc/)保留
+    assert collect(profile) == [
+        "Python/Scripts/tool.exe",
+        "Python/bin/pip",
+        "other/examples/helper.py",
+        "other/tests/__init__.py",
+        "other/tests/test_other.py",
+        "pkg/core.pyi",
+        "pkg/examples/readme.txt",
+        "pkg/tests/__init__.py",
+        "pkg/tests/data/input.txt",
+        "pkg/tests/test_core.py",
+    ]
+
+
+def test_imported_by_kept_test_dir():
+    # pkg/test 被保留的模块导入后, 它导入的目录也保留
+    tree = make_tree()
+    tree.add_bytes(SITE_PACKAGES + "/pkg/test/util.py", "from pkg.examples import data\n")
+    tree.add_bytes(SITE_PACKAGES + "/pkg/examples/data.py", "")
+    found = collect_strip_files(tree, PYTHON, SITE_PACKAGES, get_strip_rules("aggressive"))
+    assert SITE_PACKAGES + "/pkg/examples/data.py" not in found
+    assert SITE_PACKAGES + "/pkg/tests/test_core.py" in found
+
+
+def test_keep_and_exclude():
+    rules = get_strip_rules({"profile": "safe", "exclude": ["pkg/core.py"], "keep": ["pkg/examples/*", "pkg/tests/*"]})
+    found = collect_strip_files(make_tree(), PYTHON, SITE_PACKAGES, rules)
+    assert sorted(path for path, category in found.items() if not category.startswith("dir:")) == [
+        "Python/Lib/site-packages/pkg/core.py",
+        "Python/Lib/site-packages/pkg/core.pyi",
+        "Python/Scripts/tool.exe",
+        "Python/bin/pip",
+    ]
+    assert not any(path.startswith(SITE_PACKAGES + "/pkg/") for path, category in found.items()
+                   if category.startswith("dir:"))
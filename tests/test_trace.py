@@ -0,0 +1,26 @@
+import json
+import pytest
+from pkvenv.main import load_trace, merge_trace
+
+
+@pytest.mark.parametrize("content", ["", '{"files": ["a.py"', "[]", '{"files": 1}'])
+def test_no_run_trace(tmp_path, content):
+    trace_file = tmp_path / "pkvenv.trace.json"
+    trace_file.write_text(json.dumps({"runs": 2, "files": ["a.py"]}))
+    run_trace_file = tmp_path / "run.json"
+    run_trace_file.write_text(content)
+    with pytest.raises(ValueError, match="no trace recorded"):
+        merge_trace(str(trace_file), str(run_trace_file))
+    assert load_trace(str(trace_file)) == (2, {"a.py"})
+
+
+def test_merge_trace(tmp_path):
+    trace_file = tmp_path / "pkvenv.trace.json"
+    run_trace_file = tmp_path / "run.json"
+    run_trace_file.write_text(json.dumps({"files": ["b.py"]}))
+    assert merge_trace(str(trace_file), str(run_trace_file)) == (1, {"b.py"})
+    run_trace_file.write_text(json.dumps({"files": ["a.py"]}))
+    assert merge_trace(str(trace_file), str(run_trace_file)) == (2, {"a.py", "b.py"})
+    trace_file.write_text("not json")
+    with pytest.raises(ValueError, match="not a valid trace file"):
+        merge_trace(str(trace_file), str(run_trace_file))